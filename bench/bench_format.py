@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark for the per-row report/CSV formatting.
+
+Usage: python bench/bench_format.py [rows] [repeat]
+
+Prints the best per-row cost of formatting.format_revs_batch over
+synthetic revisions as JSON.
+"""
+import os
+import sys
+import json
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from formatting import format_revs_batch
+from records import get_columns, get_record_type
+
+
+LANGS = ('en', 'de', 'fr', 'es', 'wikidata')
+TAGS = ('1lib1ref', 'wikiloves', 'edit', 'edita', 'citation', 'wlm2016')
+
+
+def make_rows(count, seed=0):
+    "Report-profile records, as get_hashtags returns them."
+    record_type = get_record_type(get_columns('report'))
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        tags = rng.sample(TAGS, rng.randint(1, 3))
+        comment = 'Added a reference %s & <fixed> typo' % ' '.join('#' + t for t in tags)
+        row = {'htrc_lang': rng.choice(LANGS),
+               'rc_id': i,
+               'htrc_id': i,
+               'rc_user_text': 'User %d' % rng.randint(1, 5000),
+               'rc_title': 'Some_page_title_%d' % i,
+               'rc_new_len': rng.randint(0, 50000),
+               'rc_old_len': rng.randint(0, 50000),
+               'rc_timestamp': '2016%02d%02d%02d%02d%02d' % (
+                   rng.randint(1, 12), rng.randint(1, 28),
+                   rng.randint(0, 23), rng.randint(0, 59),
+                   rng.randint(0, 59)),
+               'rc_this_oldid': 700000000 + i,
+               'rc_last_oldid': 699999999 + i,
+               'rc_comment': comment,
+               'ht_text': tags[0],
+               'ht_id': TAGS.index(tags[0]) + 1}
+        rows.append(record_type(tuple(row[f] for f in record_type.fields)))
+    return rows
+
+
+def main(count=1000, repeat=5):
+    rows = make_rows(count)
+    timer = timeit.Timer(lambda: format_revs_batch(rows))
+    best = min(timer.repeat(repeat=repeat, number=1))
+    print(json.dumps({'benchmark': 'format_revs_batch',
+                      'rows': count,
+                      'best_s': best,
+                      'per_row_us': best / count * 1e6}))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""Compares two bench/run.py reports.
+
+Usage: python bench/compare.py BASELINE.json CANDIDATE.json [--metric p95_ms]
+
+Prints each benchmark's metric in both runs and the relative change;
+negative is faster.
+"""
+import sys
+import json
+import argparse
+
+
+def load(path):
+    with open(path) as f:
+        return dict((r['name'], r) for r in json.load(f)['results'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--metric', default='p50_ms')
+    args = parser.parse_args()
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    print('%-40s %12s %12s %9s' % ('benchmark', 'baseline', 'candidate', 'change'))
+    for name in sorted(set(baseline) | set(candidate)):
+        old = baseline.get(name, {}).get(args.metric)
+        new = candidate.get(name, {}).get(args.metric)
+        if old is None or new is None:
+            print('%-40s %12s %12s %9s' % (name, old, new, 'n/a'))
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        print('%-40s %12.2f %12.2f %+8.1f%%' % (name, old, new, change))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Checks that the hot DAL queries still use indexes.
+
+Usage: python bench/explain.py [--verbose]
+
+Builds each query with the same functions the DAL uses, runs EXPLAIN
+on it against the database built by bench/generate.py (see the HT_DB_*
+environment variables in dal.py), and exits non-zero if any table that
+should be read through an index is instead scanned in full (type ALL,
+or no key). Run it after changing a query or the schema.
+"""
+import os
+import sys
+import json
+import numbers
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dal
+from dal import hashtags_query, hashtag_stats_query, series_tail_query
+from tagexpr import _keys_query
+from run import pick_tags, deep_key
+
+
+def inline_params(sql, params):
+    "EXPLAIN can't be prepared, so the params are quoted into the SQL."
+    parts = sql.split('?')
+    assert len(parts) == len(params) + 1
+    ret = [parts[0]]
+    for param, part in zip(params, parts[1:]):
+        if isinstance(param, numbers.Integral):
+            ret.append(str(param))
+        else:
+            ret.append("'%s'" % str(param).replace('\\', '\\\\').replace("'", "\\'"))
+        ret.append(part)
+    return ''.join(ret)
+
+
+def get_checks(db, busy_tag, rare_tag):
+    "``(name, (sql, params), aliases that must use an index)``"
+    start, end = datetime(2016, 1, 15), datetime(2016, 2, 15)
+    busy_key = deep_key(db, busy_tag)
+    ht_id = db.execute('SELECT ht_id FROM hashtags WHERE ht_text = ?',
+                       (busy_tag,))[0]['ht_id']
+    tagged = ('rc', 'htrc', 'ht')
+    return [
+        ('get_hashtags', hashtags_query(busy_tag)[:2], tagged),
+        ('get_hashtags rare', hashtags_query(rare_tag)[:2], tagged),
+        ('get_hashtags lang+dates',
+         hashtags_query(busy_tag, lang='en', startdate=start, enddate=end)[:2],
+         tagged),
+        ('get_hashtags deep page',
+         hashtags_query(busy_tag, after=busy_key)[:2], tagged),
+        ('get_all_hashtags', hashtags_query()[:2], ('rc', 'htrc', 'vh', 'ht')),
+        ('get_all_hashtags lang',
+         hashtags_query(lang='en')[:2], ('rc', 'htrc', 'vh', 'ht')),
+        ('get_hashtag_stats', hashtag_stats_query(busy_tag), tagged),
+        ('get_hashtag_stats dates',
+         hashtag_stats_query(busy_tag, startdate=start, enddate=end), tagged),
+        ('get_hashtag_series tail',
+         series_tail_query(busy_tag, None, 8, '20160201000000'), tagged),
+        ('tag expression keys',
+         _keys_query(ht_id, (None, None, None)).build(), ('rc', 'htrc')),
+    ]
+
+
+def explain(db, sql, params):
+    return db.execute('EXPLAIN ' + inline_params(sql, params), ())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    db = dal.HashtagDatabaseConnection()
+    busy_tag, rare_tag = pick_tags(db)
+    failures = []
+    for name, (sql, params), indexed in get_checks(db, busy_tag, rare_tag):
+        plan = explain(db, sql, params)
+        bad = [row for row in plan
+               if row['table'] in indexed
+               and (row['type'] == 'ALL' or not row['key'])]
+        status = 'FAIL' if bad else 'ok'
+        sys.stderr.write('%-28s %s\n' % (name, status))
+        if bad or args.verbose:
+            for row in plan:
+                sys.stderr.write('    %-6s %-8s %-14s rows=%s %s\n'
+                                 % (row['table'], row['type'], row['key'],
+                                    row['rows'], row.get('Extra') or ''))
+        if bad:
+            failures.append({'query': name,
+                             'sql': sql,
+                             'tables': [row['table'] for row in bad]})
+    print(json.dumps({'failures': failures}, indent=2, sort_keys=True))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Builds a synthetic hashtag database for benchmarking.
+
+Usage: python bench/generate.py [--revisions N] [--tags N] [--langs N]
+                                [--days N] [--runs N] [--seed N]
+
+Connects with the same HT_DB_HOST / HT_DB_NAME / HT_DB_CONFIG
+environment variables as dal.py, so point those at a local MySQL or
+MariaDB database you don't mind being dropped and recreated. The same
+seed and scale always produce the same data.
+
+The tables derived from the data (valid hashtags, daily rollups and
+their watermarks) are dropped too, and rebuilt after the data is
+written, so benchmarks start from the same state a caught-up
+deployment would have. The result cache (HT_CACHE_DIR) is cleared, and
+the local replica (HT_REPLICA_PATH), if any, is deleted and resynced.
+"""
+import os
+import sys
+import json
+import uuid
+import random
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import oursql
+
+from common import EXCLUDED
+from dal import (DB_CONFIG_PATH, HT_DB_HOST, HT_DB_NAME, REPLICA_PATH,
+                 Cache, HashtagDatabaseConnection)
+from rollup import ROLLUP_TABLE
+from state import STATE_TABLE
+from validity import VALID_TABLE, STAGING_TABLE, OLD_TABLE
+
+
+LANGS = ('en', 'de', 'fr', 'es', 'it', 'ru', 'ja', 'pt', 'zh', 'wikidata')
+WORDS = ('added', 'fixed', 'citation', 'reference', 'typo', 'image',
+         'infobox', 'expanded', 'section', 'cleanup', 'source', 'link')
+INSERT_BATCH = 2000
+
+SCHEMA = ['''
+CREATE TABLE recentchanges (
+  htrc_id INT UNSIGNED NOT NULL PRIMARY KEY,
+  htrc_lang VARBINARY(32) NOT NULL,
+  rc_id INT UNSIGNED NOT NULL,
+  rc_timestamp VARBINARY(14) NOT NULL,
+  rc_user INT UNSIGNED NOT NULL,
+  rc_user_text VARBINARY(255) NOT NULL,
+  rc_namespace INT NOT NULL,
+  rc_title VARBINARY(255) NOT NULL,
+  rc_comment VARBINARY(767) NOT NULL,
+  rc_minor TINYINT UNSIGNED NOT NULL,
+  rc_bot TINYINT UNSIGNED NOT NULL,
+  rc_new TINYINT UNSIGNED NOT NULL,
+  rc_cur_id INT UNSIGNED NOT NULL,
+  rc_this_oldid INT UNSIGNED NOT NULL,
+  rc_last_oldid INT UNSIGNED NOT NULL,
+  rc_type TINYINT UNSIGNED NOT NULL,
+  rc_source VARBINARY(16) NOT NULL,
+  rc_patrolled TINYINT UNSIGNED NOT NULL,
+  rc_old_len INT,
+  rc_new_len INT,
+  rc_deleted TINYINT UNSIGNED NOT NULL,
+  rc_logid INT UNSIGNED NOT NULL,
+  rc_log_type VARBINARY(255),
+  rc_log_action VARBINARY(255),
+  rc_params BLOB,
+  KEY rc_timestamp (rc_timestamp, rc_id),
+  KEY htrc_lang (htrc_lang, rc_timestamp)
+)''', '''
+CREATE TABLE hashtags (
+  ht_id INT UNSIGNED NOT NULL PRIMARY KEY,
+  ht_text VARBINARY(767) NOT NULL,
+  UNIQUE KEY ht_text (ht_text)
+)''', '''
+CREATE TABLE hashtag_recentchanges (
+  htrc_id INT UNSIGNED NOT NULL PRIMARY KEY,
+  ht_id INT UNSIGNED NOT NULL,
+  rc_id INT UNSIGNED NOT NULL,
+  htrc_lang VARBINARY(32) NOT NULL,
+  KEY ht_id (ht_id, htrc_id)
+)''', '''
+CREATE TABLE mentions (
+  mn_id INT UNSIGNED NOT NULL PRIMARY KEY,
+  mn_text VARBINARY(767) NOT NULL,
+  UNIQUE KEY mn_text (mn_text)
+)''', '''
+CREATE TABLE mention_recentchanges (
+  mnrc_id INT UNSIGNED NOT NULL PRIMARY KEY,
+  mn_id INT UNSIGNED NOT NULL,
+  rc_id INT UNSIGNED NOT NULL,
+  mnrc_lang VARBINARY(32) NOT NULL,
+  KEY mn_id (mn_id, mnrc_id)
+)''', '''
+CREATE TABLE start_log (
+  run_uuid VARBINARY(36) NOT NULL PRIMARY KEY,
+  start_timestamp DATETIME NOT NULL,
+  lang VARBINARY(32) NOT NULL,
+  command VARBINARY(255) NOT NULL
+)''', '''
+CREATE TABLE complete_log (
+  run_uuid VARBINARY(36) NOT NULL PRIMARY KEY,
+  complete_timestamp DATETIME NOT NULL,
+  lang VARBINARY(32) NOT NULL,
+  output BLOB NOT NULL,
+  KEY complete_timestamp (complete_timestamp),
+  KEY lang (lang, complete_timestamp)
+)''']
+TABLES = ('recentchanges', 'hashtags', 'hashtag_recentchanges', 'mentions',
+          'mention_recentchanges', 'start_log', 'complete_log')
+DERIVED_TABLES = (VALID_TABLE, STAGING_TABLE, OLD_TABLE, ROLLUP_TABLE,
+                  STATE_TABLE)
+
+
+def make_tags(rng, count):
+    tags = list(EXCLUDED) + ['12', 'x']  # rows the validity rules drop
+    while len(tags) < count:
+        word = rng.choice(WORDS) + str(rng.randint(0, count * 10))
+        if word not in tags:
+            tags.append(word)
+    return tags
+
+
+def pick_rank(rng, count):
+    "Zipf-ish popularity: a few tags get most of the edits."
+    return min(int(rng.paretovariate(1.1)) - 1, count - 1)
+
+
+def generate(connection, revisions, tags, langs, days, runs, seed):
+    rng = random.Random(seed)
+    cursor = connection.cursor()
+    for table in TABLES + DERIVED_TABLES:
+        cursor.execute('DROP TABLE IF EXISTS %s' % table, ())
+    for query in SCHEMA:
+        cursor.execute(query, ())
+
+    tag_texts = make_tags(rng, tags)
+    cursor.executemany('INSERT INTO hashtags (ht_id, ht_text) VALUES (?, ?)',
+                       [(i + 1, t) for i, t in enumerate(tag_texts)])
+    users = ['User %d' % i for i in range(max(revisions // 20, 10))]
+    mentioned = min(len(users), 200)
+    cursor.executemany('INSERT INTO mentions (mn_id, mn_text) VALUES (?, ?)',
+                       [(i + 1, u.replace(' ', '_'))
+                        for i, u in enumerate(users[:mentioned])])
+    lang_names = LANGS[:langs]
+    end = datetime(2016, 1, 1) + timedelta(days=days)
+    rc_rows, htrc_rows, mnrc_rows = [], [], []
+    htrc_id = 0
+
+    def flush(force=False):
+        if rc_rows and (force or len(rc_rows) >= INSERT_BATCH):
+            cursor.executemany('INSERT INTO recentchanges VALUES (%s)'
+                               % ', '.join(['?'] * 25), rc_rows)
+            cursor.executemany('INSERT INTO hashtag_recentchanges '
+                               'VALUES (?, ?, ?, ?)', htrc_rows)
+            if mnrc_rows:
+                cursor.executemany('INSERT INTO mention_recentchanges '
+                                   'VALUES (?, ?, ?, ?)', mnrc_rows)
+            del rc_rows[:], htrc_rows[:], mnrc_rows[:]
+
+    # revisions are generated oldest first, so htrc_ids increase with time
+    step = days * 86400.0 / max(revisions, 1)
+    for rc_id in range(1, revisions + 1):
+        timestamp = (end - timedelta(seconds=(revisions - rc_id) * step)
+                     ).strftime('%Y%m%d%H%M%S')
+        lang = rng.choice(lang_names)
+        user_id = rng.randint(0, len(users) - 1)
+        title = 'Page_%d' % pick_rank(rng, revisions // 5 + 1)
+        old_len = rng.randint(0, 80000)
+        new_len = max(old_len + int(rng.gauss(200, 2000)), 0)
+        ht_ids = set(pick_rank(rng, len(tag_texts)) + 1
+                     for i in range(rng.randint(1, 3)))
+        comment = '%s %s' % (' '.join(rng.sample(WORDS, 3)),
+                             ' '.join('#' + tag_texts[i - 1] for i in ht_ids))
+        mention = None
+        if rng.random() < 0.05:
+            mention = rng.randint(1, mentioned)
+            comment += ' @' + users[mention - 1].replace(' ', '_')
+        for ht_id in ht_ids:
+            htrc_id += 1
+            rc_rows.append((htrc_id, lang, rc_id, timestamp, user_id,
+                            users[user_id], 0, title, comment,
+                            int(rng.random() < 0.2), int(rng.random() < 0.05),
+                            int(rng.random() < 0.1), rc_id,
+                            rc_id * 10, rc_id * 10 - 1,
+                            0 if rng.random() < 0.95 else 1, 'mw.edit',
+                            0, old_len, new_len, 0, 0, None, None, ''))
+            htrc_rows.append((htrc_id, ht_id, rc_id, lang))
+            if mention:
+                mnrc_rows.append((htrc_id, mention, rc_id, lang))
+        flush()
+    flush(force=True)
+
+    run_time = datetime.now() - timedelta(days=3)
+    for i in range(runs):
+        lang = lang_names[i % len(lang_names)]
+        run_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+        run_time += timedelta(seconds=rng.randint(60, 600))
+        output = json.dumps({'changes_added': rng.randint(0, 500),
+                             'tags_added': rng.randint(0, 20),
+                             'mentions_added': rng.randint(0, 20),
+                             'total_tags': rng.randint(0, 1000),
+                             'total_mentions': rng.randint(0, 200),
+                             'total_changes': rng.randint(0, 5000)})
+        cursor.execute('INSERT INTO start_log VALUES (?, ?, ?, ?)',
+                       (run_uuid, run_time, lang, 'python update.py --lang ' + lang))
+        cursor.execute('INSERT INTO complete_log VALUES (?, ?, ?, ?)',
+                       (run_uuid, run_time + timedelta(seconds=rng.randint(5, 120)),
+                        lang, output))
+    connection.commit()
+    cursor.close()
+    return {'revisions': revisions, 'rc_rows': htrc_id, 'tags': len(tag_texts),
+            'langs': len(lang_names), 'days': days, 'runs': runs, 'seed': seed}
+
+
+def build_derived():
+    """Builds what the app's background refreshes would: the valid
+    hashtags, the daily rollups and the replica. Returns the number of
+    valid hashtags and of rows rolled up.
+    """
+    Cache.clear()
+    if REPLICA_PATH:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(REPLICA_PATH + suffix):
+                os.remove(REPLICA_PATH + suffix)
+    db = HashtagDatabaseConnection()
+    db.valid_hashtags.refresh()
+    rolled_up = db.rollups.update()
+    if db.replica is not None:
+        db.replica.sync()
+    return {'valid_tags': len(db.valid_hashtags.ids),
+            'rolled_up': rolled_up}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--revisions', type=int, default=100000)
+    parser.add_argument('--tags', type=int, default=2000)
+    parser.add_argument('--langs', type=int, default=len(LANGS))
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--runs', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    connection = oursql.connect(db=HT_DB_NAME,
+                                host=HT_DB_HOST,
+                                read_default_file=DB_CONFIG_PATH,
+                                charset=None,
+                                use_unicode=False)
+    summary = generate(connection,
+                       revisions=args.revisions,
+                       tags=args.tags,
+                       langs=args.langs,
+                       days=args.days,
+                       runs=args.runs,
+                       seed=args.seed)
+    summary.update(build_derived())
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
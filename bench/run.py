@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Times the DAL methods and the routes of create_app().
+
+Usage: python bench/run.py [--iterations N] [--cold] [--only SUBSTRING]
+                           [--output FILE]
+
+Run against a database built by bench/generate.py (see the
+HT_DB_* environment variables in dal.py); HT_CACHE_DIR should point
+somewhere scratch. With --cold, the result cache is cleared before
+every iteration, so each one hits the database.
+
+Writes one JSON document with p50/p95/p99 latencies and rows/sec per
+benchmark; compare two of them with bench/compare.py.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+import dal
+import server
+from common import is_valid_hashtag
+from utils import encode_cursor
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(pct / 100.0 * (len(sorted_values) - 1))),
+                len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize(name, kind, timings, rows):
+    timings = sorted(timings)
+    total = sum(timings)
+    return {'name': name,
+            'kind': kind,
+            'iterations': len(timings),
+            'p50_ms': percentile(timings, 50) * 1000,
+            'p95_ms': percentile(timings, 95) * 1000,
+            'p99_ms': percentile(timings, 99) * 1000,
+            'mean_ms': total / len(timings) * 1000,
+            'rows': rows,
+            'rows_per_sec': (rows * len(timings) / total) if total else 0.0}
+
+
+def count_rows(result):
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return 1 if result else 0
+
+
+def run_one(func, iterations, cold):
+    timings = []
+    rows = 0
+    for i in range(iterations):
+        if cold:
+            dal.Cache.clear()
+        start = time.time()
+        result = func()
+        timings.append(time.time() - start)
+        rows = count_rows(result)
+    return timings, rows
+
+
+def pick_tags(db):
+    rows = db.execute('''
+    SELECT ht.ht_text, COUNT(*) AS count
+    FROM hashtag_recentchanges AS htrc
+    JOIN hashtags AS ht
+    ON ht.ht_id = htrc.ht_id
+    GROUP BY ht.ht_text
+    ORDER BY count DESC''', ())
+    valid = [r['ht_text'] for r in rows if is_valid_hashtag(r['ht_text'])]
+    return valid[0], valid[-1]
+
+
+def deep_key(db, tag, depth=2000):
+    "The pagination key of the row *depth* rows into *tag*'s results."
+    deep = db.get_hashtags(tag, limit=depth)
+    if not deep:
+        return None
+    return (deep[-1]['rc_timestamp'], deep[-1]['rc_id'], deep[-1]['htrc_id'])
+
+
+def dal_benchmarks(db, busy_tag, rare_tag):
+    start = datetime(2016, 1, 15)
+    end = datetime(2016, 2, 15)
+    busy_key = deep_key(db, busy_tag)
+    both = busy_tag + b'+' + rare_tag
+    either = busy_tag + b'|' + rare_tag
+    return [
+        ('get_hashtags busy', lambda: db.get_hashtags(busy_tag)),
+        ('get_hashtags busy deep page',
+         lambda: db.get_hashtags(busy_tag, after=busy_key)),
+        ('get_hashtags busy deep page back',
+         lambda: db.get_hashtags(busy_tag, before=busy_key)),
+        ('get_hashtags rare', lambda: db.get_hashtags(rare_tag)),
+        ('get_hashtags busy lang+dates',
+         lambda: db.get_hashtags(busy_tag, lang='en',
+                                 startdate=start, enddate=end)),
+        ('get_all_hashtags', lambda: db.get_all_hashtags()),
+        ('get_hashtags busy+rare', lambda: db.get_hashtags(both)),
+        ('get_hashtags busy|rare', lambda: db.get_hashtags(either)),
+        ('get_hashtag_stats busy+rare', lambda: db.get_hashtag_stats(both)),
+        ('get_hashtag_stats busy', lambda: db.get_hashtag_stats(busy_tag)),
+        ('get_hashtag_stats rare', lambda: db.get_hashtag_stats(rare_tag)),
+        ('get_all_hashtag_stats', lambda: db.get_all_hashtag_stats()),
+        ('get_top_hashtags', lambda: db.get_top_hashtags()),
+        ('get_leaderboard busy users',
+         lambda: db.get_leaderboard(busy_tag, 'users')),
+        ('get_leaderboard busy pages by bytes',
+         lambda: db.get_leaderboard(busy_tag, 'pages', 'bytes')),
+        ('get_leaderboard busy+rare',
+         lambda: db.get_leaderboard(both, 'users')),
+        ('get_suggestions', lambda: db.get_suggestions(busy_tag[:2])),
+        ('get_langs', lambda: db.get_langs()),
+        ('get_hashtag_series day',
+         lambda: db.get_hashtag_series(busy_tag, unit='day')),
+        ('get_mentions', lambda: db.get_mentions('User_1')),
+        ('get_run_log', lambda: db.get_run_log()),
+        ('get_lang_run_log', lambda: db.get_lang_run_log('en')),
+        ('iter_hashtags busy (export)',
+         lambda: list(db.iter_hashtags(busy_tag))),
+    ]
+
+
+def route_benchmarks(client, db, busy_tag, rare_tag):
+    busy, rare = busy_tag.decode('utf8'), rare_tag.decode('utf8')
+    key = deep_key(db, busy_tag)
+    cursor = encode_cursor(key, 'after', 2000) if key else ''
+
+    def get(path):
+        def _get():
+            resp = client.get(path)
+            body = resp.data
+            if resp.status_code != 200:
+                raise RuntimeError('%s returned %s' % (path, resp.status))
+            return body.count(b'\n')
+        return _get
+
+    return [('GET /', get('/')),
+            ('GET /search/<busy>', get('/search/%s' % busy)),
+            ('GET /search/<busy>?lang=en', get('/search/%s?lang=en' % busy)),
+            ('GET /search/<rare>', get('/search/%s' % rare)),
+            ('GET /search/<busy>/<cursor>',
+             get('/search/%s/%s' % (busy, cursor))),
+            ('GET /search/<busy>+<rare>', get('/search/%s+%s' % (busy, rare))),
+            ('GET /search/<busy>|<rare>', get('/search/%s|%s' % (busy, rare))),
+            ('GET /search/all', get('/search/all')),
+            ('GET /tags/100', get('/tags/100')),
+            ('GET /suggest', get('/suggest?q=%s' % busy[:2])),
+            ('GET /top/<busy>', get('/top/%s' % busy)),
+            ('GET /top/<busy>+<rare>', get('/top/%s+%s' % (busy, rare))),
+            ('GET /csv/<busy>', get('/csv/%s' % busy)),
+            ('GET /series/<busy>', get('/series/%s' % busy)),
+            ('GET /stats/<busy>', get('/stats/%s' % busy)),
+            ('GET /logs', get('/logs')),
+            ('GET /logs/en', get('/logs/en'))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--cold', action='store_true')
+    parser.add_argument('--only', default='')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    db = server.Database
+    busy_tag, rare_tag = pick_tags(db)
+    client = Client(server.create_app(), BaseResponse)
+    benchmarks = ([(name, 'dal', func) for name, func
+                   in dal_benchmarks(db, busy_tag, rare_tag)]
+                  + [(name, 'route', func) for name, func
+                     in route_benchmarks(client, db, busy_tag, rare_tag)])
+    results = []
+    for name, kind, func in benchmarks:
+        if args.only not in name:
+            continue
+        func()  # warm up connections, and the cache unless --cold
+        timings, rows = run_one(func, args.iterations, args.cold)
+        result = summarize(name, kind, timings, rows)
+        results.append(result)
+        sys.stderr.write('%-40s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms\n'
+                         % (name, result['p50_ms'], result['p95_ms'],
+                            result['p99_ms']))
+    report = {'meta': {'date': datetime.now().isoformat(),
+                       'host': platform.node(),
+                       'python': platform.python_version(),
+                       'db_host': dal.HT_DB_HOST,
+                       'db_name': dal.HT_DB_NAME,
+                       'iterations': args.iterations,
+                       'cold': args.cold,
+                       'tags': {'busy': busy_tag.decode('utf8'),
+                                'rare': rare_tag.decode('utf8')}},
+              'results': results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
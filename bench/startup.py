@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Times importing the app, as a WSGI worker does on startup.
+
+Usage: python bench/startup.py [--iterations N] [--output FILE]
+
+Each iteration imports app.py in a fresh interpreter, in a scratch
+directory, with HT_DB_HOST pointed at an address that never answers,
+so any connection attempt at import would show up as a stall. Also
+fails (exit 1) if an import opened a database connection, started a
+thread or created server.log.
+
+Writes the same JSON as bench/run.py, so bench/compare.py can compare
+two runs.
+"""
+import os
+import ast
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, _ROOT)
+
+from run import summarize
+
+
+UNREACHABLE_HOST = '192.0.2.1'  # TEST-NET-1, reserved for documentation
+
+CHILD = '''
+import sys
+import time
+import threading
+start = time.time()
+import app
+duration = time.time() - start
+import server
+sys.stdout.write('%r\\n' % ((duration,
+                            server.Database.get_pool_stats()['created'],
+                            threading.active_count()),))
+'''
+
+
+def run_once(workdir):
+    env = dict(os.environ,
+               PYTHONPATH=os.path.abspath(_ROOT),
+               HT_DB_HOST=UNREACHABLE_HOST,
+               HT_CACHE_DIR=os.path.join(workdir, 'cache'))
+    output = subprocess.check_output([sys.executable, '-c', CHILD],
+                                     cwd=workdir, env=env)
+    duration, connections, threads = ast.literal_eval(output.strip())
+    opened_log = os.path.exists(os.path.join(workdir, 'server.log'))
+    return duration, connections, threads, opened_log
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    timings, problems = [], []
+    for i in range(args.iterations):
+        workdir = tempfile.mkdtemp(prefix='ht-startup-')
+        try:
+            duration, connections, threads, opened_log = run_once(workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        timings.append(duration)
+        if connections:
+            problems.append('opened %s connections' % connections)
+        if threads > 1:
+            problems.append('started %s threads' % (threads - 1))
+        if opened_log:
+            problems.append('created server.log')
+    result = summarize('import app', 'startup', timings, 0)
+    sys.stderr.write('%-40s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms\n'
+                     % (result['name'], result['p50_ms'], result['p95_ms'],
+                        result['p99_ms']))
+    for problem in sorted(set(problems)):
+        sys.stderr.write('FAIL: importing the app %s\n' % problem)
+    report = {'meta': {'date': datetime.now().isoformat(),
+                       'host': platform.node(),
+                       'python': platform.python_version(),
+                       'iterations': args.iterations,
+                       'problems': sorted(set(problems))},
+              'results': [result]}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
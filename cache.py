@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+'''
+Result cache
+~~~~~~~~~~~~
+Two tiers: a bounded in-process LRU (by entry count and approximate
+bytes) in front of a directory of files shared between worker
+processes, bounded by their total size. Entries found only on disk are
+promoted to memory. On disk, values are stored in the compact,
+column-oriented format of codec.py, behind a small header with the
+codec version and expiry times.
+
+Empty results are cached too ("negative caching"), with their own,
+shorter timeout, so that repeated searches for nonexistent tags don't
+each hit the database.
+
+Concurrent misses for the same key are computed once per process, and
+hot keys can be served stale while they're recomputed, or kept warm by
+a background thread so they don't expire at all (see get_or_compute).
+'''
+import os
+import re
+import time
+import struct
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from codec import CODEC_VERSION, encode, decode
+from metrics import Metrics
+
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_FILE_BYTES = 1024 * 1024 * 1024
+PRUNE_TO = 0.8  # fraction of max_file_bytes that pruning gets back under
+RECOUNT_INTERVAL = 5 * 60  # seconds between re-measuring the directory
+DEFAULT_TIMEOUT = 5 * 60
+NEGATIVE_TIMEOUT = 60
+WARM_INTERVAL = 10  # seconds between checks for warm keys about to expire
+WARM_AHEAD = 30  # seconds before expiry that warm keys are recomputed
+# codec version, expires, keep_until, and the size to count in memory
+_HEADER = struct.Struct('!HddQ')
+_SAFE_KEY_RE = re.compile(r'^[\w-]{1,200}$')
+
+
+def make_key(name, *parts):
+    digest = hashlib.sha1(repr(parts).encode('utf8')).hexdigest()
+    return '%s-%s' % (name, digest)
+
+
+def copy_results(results):
+    """Callers (format_stats, for one) modify result dicts in place, so each
+    get returns fresh row containers around the shared values.
+    """
+    if isinstance(results, list):
+        return [dict(r) if isinstance(r, dict) else r for r in results]
+    return results
+
+
+class LRUCache(object):
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires, size, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            expires, size, value = entry
+            if expires < time.time():
+                self.size_bytes -= size
+                return default
+            self._entries[key] = entry  # most recently used goes last
+            return value
+
+    def set(self, key, value, timeout, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size_bytes -= old[1]
+            self._entries[key] = (time.time() + timeout, size, value)
+            self.size_bytes += size
+            while (len(self._entries) > self.max_entries
+                   or self.size_bytes > self.max_bytes):
+                _, (_, old_size, _) = self._entries.popitem(last=False)
+                self.size_bytes -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileCache(object):
+    """One file per key, replaced atomically. When the files add up to
+    more than *max_bytes*, the least recently used (by mtime, which
+    reads refresh) are removed until they're under PRUNE_TO of it.
+    The total is estimated from this process's writes, and re-measured
+    when pruning and every RECOUNT_INTERVAL, to account for other
+    processes'.
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_FILE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size_bytes = None
+        self.evictions = 0
+        self._last_count = 0
+        self._lock = threading.Lock()
+        self._prune_lock = threading.Lock()
+
+    def _path(self, key):
+        if not _SAFE_KEY_RE.match(key):
+            key = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def set(self, key, data):
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                pass  # made by another process, or the write fails below
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self._path(key))
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            due = (self.size_bytes is None
+                   or time.time() - self._last_count > RECOUNT_INTERVAL)
+            if not due:
+                self.size_bytes += len(data)
+                due = self.size_bytes > self.max_bytes
+        if due:
+            self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def prune(self):
+        "Measures the directory, removing the oldest files if it's too big."
+        if not self._prune_lock.acquire(False):
+            return  # another thread is on it
+        try:
+            entries, total = [], 0
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            if total > self.max_bytes:
+                entries.sort()
+                target = self.max_bytes * PRUNE_TO
+                for _, size, path in entries:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                    total -= size
+                    self.evictions += 1
+            with self._lock:
+                self.size_bytes = total
+                self._last_count = time.time()
+        finally:
+            self._prune_lock.release()
+
+    def clear(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for name in os.listdir(self.cache_dir):
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+        with self._lock:
+            self.size_bytes = 0
+
+
+class TieredCache(object):
+    def __init__(self, cache_dir,
+                 max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES,
+                 max_file_bytes=DEFAULT_MAX_FILE_BYTES,
+                 negative_timeout=NEGATIVE_TIMEOUT,
+                 warm_interval=WARM_INTERVAL):
+        self.memory = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self.files = FileCache(cache_dir, max_bytes=max_file_bytes)
+        self.negative_timeout = negative_timeout
+        self.warm_interval = warm_interval
+        self._counts = {'memory_hits': 0,
+                        'file_hits': 0,
+                        'misses': 0,
+                        'stale': 0,
+                        'sets': 0,
+                        'coalesced': 0,
+                        'warmed': 0}
+        self._count_lock = threading.Lock()
+        self._flights = {}  # key -> _Flight, for computations under way
+        self._flight_lock = threading.Lock()
+        self._warm = {}  # key -> [func, timeout, stale_timeout, read since]
+        self._warm_lock = threading.Lock()
+        self._warmer = None
+
+    def _incr(self, name, key):
+        with self._count_lock:
+            self._counts[name] += 1
+        # keys from make_key start with the method name
+        Metrics.inc('ht_cache_requests_total',
+                    method=key.rsplit('-', 1)[0], result=name)
+
+    def get(self, key):
+        """Returns ``(hit, value)``, since None and [] are both valid
+        cached values. Expired entries still kept around to be served
+        stale count as "stale" misses.
+        """
+        entry = self._lookup(key)
+        if entry is None or entry[1] <= time.time():
+            return False, None
+        return True, entry[0]
+
+    def _lookup(self, key):
+        """Returns ``(value, expires)`` for *key*, or None. The value may
+        be past *expires*, if it was set with a stale_timeout.
+        """
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is not None and entry[1] > now:
+            self._incr('memory_hits', key)
+            return copy_results(entry[0]), entry[1]
+        # a stale entry in memory may have been refreshed on disk by
+        # another process
+        payload = self.files.get(key)
+        header = self._read_header(key, payload)
+        if header is not None and header[1] > now:
+            expires, keep_until, size = header
+            value = decode(payload[_HEADER.size:])
+            self.memory.set(key, (value, expires), keep_until - now, size)
+            self._incr('file_hits' if expires > now else 'stale', key)
+            return copy_results(value), expires
+        if entry is not None:
+            self._incr('stale', key)
+            return copy_results(entry[0]), entry[1]
+        self._incr('misses', key)
+        return None
+
+    def _get_expires(self, key):
+        "Like _lookup, but only the expiry, and without counting."
+        entry = self.memory.get(key)
+        if entry is not None:
+            return entry[1]
+        header = self._read_header(key, self.files.get(key))
+        if header is not None:
+            return header[0]
+        return None
+
+    def _read_header(self, key, payload):
+        """Returns ``(expires, keep_until, size)`` from a file's *payload*,
+        or None if there isn't one, or it's from another codec version
+        (in which case it's removed).
+        """
+        if payload is None:
+            return None
+        if len(payload) >= _HEADER.size:
+            header = _HEADER.unpack_from(payload)
+            if header[0] == CODEC_VERSION:
+                return header[1:]
+        self.files.delete(key)
+        return None
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, stale_timeout=0):
+        """Caches *value* for *timeout* seconds, and keeps it for another
+        *stale_timeout* to be served stale by get_or_compute.
+        """
+        if not value:
+            timeout = min(timeout, self.negative_timeout)
+            stale_timeout = 0
+        now = time.time()
+        expires = now + timeout
+        keep_until = expires + stale_timeout
+        data, size = encode(value)
+        payload = _HEADER.pack(CODEC_VERSION, expires, keep_until, size) + data
+        self.memory.set(key, (copy_results(value), expires),
+                        timeout + stale_timeout, size)
+        self.files.set(key, payload)
+        self._incr('sets', key)
+
+    def get_or_compute(self, key, func, timeout=DEFAULT_TIMEOUT,
+                       stale_timeout=0, warm=False):
+        """Returns the value cached for *key*, computing and caching it
+        with *func* on a miss. Concurrent misses for the same key in
+        this process are coalesced: one caller runs *func*, and the rest
+        wait for its result.
+
+        With a *stale_timeout*, an expired value that's still kept is
+        returned right away, and recomputed in the background. Keys
+        looked up with *warm* are also recomputed in the background
+        shortly before they expire, for as long as they're being read
+        (see warm()).
+        """
+        if warm:
+            with self._warm_lock:
+                self._warm[key] = [func, timeout, stale_timeout, True]
+                if self._warmer is None:
+                    self._warmer = _start_thread(self._warm_loop,
+                                                 'cache-warmer')
+        entry = self._lookup(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.time():
+                return value
+            if stale_timeout:
+                self._refresh(key, func, timeout, stale_timeout)
+                return value
+        return self._compute(key, func, timeout, stale_timeout)
+
+    def _compute(self, key, func, timeout, stale_timeout):
+        with self._flight_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self._incr('coalesced', key)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy_results(flight.value)
+        try:
+            value = flight.value = func()
+            self.set(key, value, timeout=timeout, stale_timeout=stale_timeout)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flight_lock:
+                del self._flights[key]
+            flight.done.set()
+        return value
+
+    def _refresh(self, key, func, timeout, stale_timeout):
+        "Recomputes *key* in a background thread, unless it already is."
+        with self._flight_lock:
+            if key in self._flights:
+                return
+
+        def _run():
+            try:
+                self._compute(key, func, timeout, stale_timeout)
+            except Exception:
+                pass  # the stale value is served until the next try
+
+        _start_thread(_run, 'cache-refresh')
+
+    def _warm_loop(self):
+        while True:
+            time.sleep(self.warm_interval)
+            self.warm()
+
+    def warm(self):
+        """Recomputes the warm keys due to expire within WARM_AHEAD
+        seconds (or half their timeout, if that's shorter). A key that
+        hasn't been read since it was last recomputed is dropped
+        instead, so parameters nobody asks for anymore aren't kept warm.
+        """
+        with self._warm_lock:
+            items = list(self._warm.items())
+        for key, spec in items:
+            func, timeout, stale_timeout, read = spec
+            expires = self._get_expires(key)
+            ahead = min(WARM_AHEAD, timeout / 2.0)
+            if expires is not None and expires - time.time() > ahead:
+                continue
+            if not read:
+                with self._warm_lock:
+                    if self._warm.get(key) is spec:
+                        del self._warm[key]
+                continue
+            spec[3] = False
+            try:
+                self._compute(key, func, timeout, stale_timeout)
+            except Exception:
+                continue  # retried next round, if it's still read
+            self._incr('warmed', key)
+
+    def clear(self):
+        self.memory.clear()
+        self.files.clear()
+
+    def stats(self):
+        with self._count_lock:
+            ret = dict(self._counts)
+        misses = ret['misses'] + ret['stale']
+        lookups = ret['memory_hits'] + ret['file_hits'] + misses
+        ret.update({'memory_entries': len(self.memory),
+                    'memory_bytes': self.memory.size_bytes,
+                    'memory_evictions': self.memory.evictions,
+                    'file_bytes': self.files.size_bytes or 0,
+                    'file_evictions': self.files.evictions,
+                    'warm_keys': len(self._warm),
+                    'hit_rate': ((lookups - misses) / float(lookups)
+                                 if lookups else 0.0)})
+        return ret
+
+
+class _Flight(object):
+    "A computation under way, and its outcome once *done* is set."
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def _start_thread(target, name):
+    thread = threading.Thread(target=target, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
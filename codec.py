@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''
+Cache codec
+~~~~~~~~~~~
+A compact encoding for the result cache. Query results are lists of
+rows that all share the same columns, so instead of pickling every
+row (and, for dicts, every column name in every row), they're stored
+column by column. String columns with repeated values (htrc_lang,
+ht_text, user names) store each distinct value once, plus a packed
+array of indexes into them.
+
+Anything that isn't a list of uniform dicts or tuples is pickled
+as-is. The pickle is then compressed; at the fastest level, columns of
+sequential timestamps and ids shrink several-fold.
+
+The format is versioned by CODEC_VERSION, which the cache stores with
+each entry; bump it whenever the encoding changes, and older entries
+are treated as misses.
+'''
+import zlib
+import pickle
+from array import array
+
+
+CODEC_VERSION = 1
+COMPRESS_LEVEL = 1
+_RAW, _DICTS, _TUPLES = 0, 1, 2
+_PLAIN, _INTERNED = 0, 1
+_STRING_TYPES = (bytes, type(u''))
+
+
+def encode(value):
+    """Returns the encoded bytes, and their size before compression,
+    a rough measure of the value's size in memory.
+    """
+    pickled = pickle.dumps(_pack(value), pickle.HIGHEST_PROTOCOL)
+    return zlib.compress(pickled, COMPRESS_LEVEL), len(pickled)
+
+
+def decode(payload):
+    packed = pickle.loads(zlib.decompress(payload))
+    kind = packed[0]
+    if kind == _DICTS:
+        keys, columns = packed[1], [_unpack_column(c) for c in packed[2]]
+        return [dict(zip(keys, row)) for row in zip(*columns)]
+    if kind == _TUPLES:
+        return list(zip(*[_unpack_column(c) for c in packed[1]]))
+    return packed[1]
+
+
+def _pack(value):
+    if not isinstance(value, list) or not value:
+        return (_RAW, value)
+    first = value[0]
+    width = len(first) if isinstance(first, (dict, tuple)) else None
+    if type(first) is dict:
+        keys = list(first)
+        if all(type(row) is dict and len(row) == width for row in value):
+            try:
+                columns = [[row[key] for row in value] for key in keys]
+            except KeyError:
+                return (_RAW, value)
+            return (_DICTS, keys, [_pack_column(c) for c in columns])
+    elif type(first) is tuple and width:
+        if all(type(row) is tuple and len(row) == width for row in value):
+            return (_TUPLES, [_pack_column(list(c)) for c in zip(*value)])
+    return (_RAW, value)
+
+
+def _pack_column(values):
+    "Interns string columns where at least half the values are repeats."
+    kind = None
+    for value in values:
+        if value is None:
+            continue
+        if kind is None:
+            kind = type(value)
+        if type(value) is not kind or kind not in _STRING_TYPES:
+            return (_PLAIN, values)
+    distinct = set(values)
+    if kind is None or len(distinct) * 2 > len(values):
+        return (_PLAIN, values)
+    table = list(distinct)
+    index = dict((value, i) for i, value in enumerate(table))
+    typecode = _typecode(len(table))
+    indexes = _to_bytes(array(typecode, [index[value] for value in values]))
+    return (_INTERNED, table, typecode, indexes)
+
+
+def _unpack_column(column):
+    if column[0] == _PLAIN:
+        return column[1]
+    _, table, typecode, data = column
+    indexes = array(typecode)
+    if hasattr(indexes, 'frombytes'):
+        indexes.frombytes(data)
+    else:
+        indexes.fromstring(data)
+    return [table[i] for i in indexes]
+
+
+def _typecode(size):
+    if size <= 0xff:
+        return 'B'
+    if size <= 0xffff:
+        return 'H'
+    return 'L'
+
+
+def _to_bytes(arr):
+    if hasattr(arr, 'tobytes'):
+        return arr.tobytes()
+    return arr.tostring()
@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-
 '''
 Excluded tags
 ~~~~~~~~~~~~~
@@ -10,6 +9,9 @@ hashtags.
 Other MediaWiki magic words and parser functions may contain the
 hashmark: https://www.mediawiki.org/wiki/Help:Magic_words
 '''
+import zlib
+
+
 EXCLUDED = ('redirect',
             'weiterleitung',
             'redirection',
@@ -19,6 +21,33 @@ EXCLUDED = ('redirect',
             'if',
             'rs')
 
+
+def is_valid_hashtag(text):
+    """Rules for hashtags:
+    1. Does not include MediaWiki magic words
+    (like #REDIRECT) or parser functions
+    2. Must be longer than one character
+    3. Must contain at least one non-numeric
+    character.
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf8', 'replace')
+    if len(text) < 2:
+        return False
+    if text.lower() in _EXCLUDED_TEXT:
+        return False
+    return any(c.isalpha() for c in text)
+
+
+_EXCLUDED_TEXT = frozenset(t.decode('utf8') if isinstance(t, bytes) else t
+                           for t in EXCLUDED)
+# Bump _RULES_REVISION when is_valid_hashtag changes; changes to
+# EXCLUDED are picked up automatically. Tables precomputed with these
+# rules are rebuilt when the version changes.
+_RULES_REVISION = 1
+RULES_VERSION = zlib.crc32(repr((_RULES_REVISION,) + tuple(sorted(EXCLUDED)))
+                           .encode('utf8')) & 0xffffffff
+
 # Number of results to display per page
 PAGINATION = 50
 MAX_DB_ROW = 18446744073709551615  # "some large number" for all rows
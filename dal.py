@@ -1,97 +1,607 @@
 # -*- coding: utf-8 -*-
 import os
+import time
+import threading
+
 import oursql
-import werkzeug.contrib.cache
-from common import (EXCLUDED, PAGINATION)
+from common import PAGINATION
 
 
 from log import tlog
+from cache import TieredCache, make_key
+from metrics import Metrics, count_bytes
+from records import (DEFAULT_PROFILE, HASHTAG_COLUMNS, MENTION_COLUMNS,
+                     get_columns, get_record_type)
+from replica import Replica, REPLICA_ERRORS
+from pool import ConnectionPool, PoolTimeout
+from query import Query, seek_clause
+from rollup import RollupStore
+from runlog import RunLogAggregator, WINDOW_DAYS as RUN_LOG_WINDOW_DAYS
+from series import (UNITS, UNIT_WIDTHS, DEFAULT_UNIT, first_open_bucket,
+                    fold_weeks, filter_buckets)
+from suggest import SuggestIndex
+from tagexpr import (is_tag_expression, parse_tag_expression, get_tag_names,
+                     find_page, matching_query)
+from textindex import parse_terms, match_terms, SearchUnavailable
+from topk import TopHashtagTracker
+from validity import ValidHashtags, VALID_TABLE, match_rules
 
-DB_CONFIG_PATH = os.path.expanduser('~/replica.my.cnf')
-HT_DB_HOST = 'tools.db.svc.eqiad.wmflabs'
-HT_DB_NAME = 's52467__new_hashtags'
+# The environment overrides are for pointing the app at a local
+# database, e.g. the one bench/generate.py builds
+DB_CONFIG_PATH = os.path.expanduser(os.environ.get('HT_DB_CONFIG', '~/replica.my.cnf'))
+HT_DB_HOST = os.environ.get('HT_DB_HOST', 'tools.db.svc.eqiad.wmflabs')
+HT_DB_NAME = os.environ.get('HT_DB_NAME', 's52467__new_hashtags')
+# Optional local SQLite mirror to read from, see replica.py
+REPLICA_PATH = os.environ.get('HT_REPLICA_PATH')
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 8
+# At most this many mention queries use the shared database at once,
+# so a burst of them can't take every connection from hashtag pages
+MAX_MENTION_QUERIES = POOL_MAX_SIZE // 2
+MENTION_METHODS = ('get_mentions', 'get_all_mentions', 'get_mention_stats',
+                   'get_mention_leaderboard')
+RECONNECT_ERRORS = (oursql.OperationalError, oursql.InterfaceError)
+# What a failed or starved query can raise, for callers that degrade
+# instead of failing the request
+DB_ERRORS = (oursql.Error, PoolTimeout) + REPLICA_ERRORS
+# Queries slower than this many seconds are written to the log, with
+# their SQL and params. Off unless set.
+SLOW_QUERY_SECONDS = float(os.environ.get('HT_SLOW_QUERY_SECONDS', 0)) or None
 
 
 CACHE_EXPIRATION = 5 * 60
+CHUNK_SIZE = 1000  # rows per query when streaming exports
+ID_CHUNK_SIZE = 1000  # ids per IN (...) list
+# Per-method cache timeouts, in seconds. Methods not listed use
+# CACHE_EXPIRATION.
+CACHE_TIMEOUTS = {'get_hashtags': 60,
+                  'get_all_hashtags': 60,
+                  'get_hashtag_stats': 2 * 60,
+                  'get_all_hashtag_stats': 2 * 60,
+                  'get_leaderboard': 2 * 60,
+                  'get_mentions': 60,
+                  'get_all_mentions': 60,
+                  'get_mention_stats': 2 * 60,
+                  'get_langs': 60 * 60,
+                  'get_run_log': 60,
+                  'get_lang_run_log': 60,
+                  'get_tag_sizes': 60 * 60}
+SERIES_CACHE_EXPIRATION = 24 * 60 * 60  # closed buckets don't change
+# What the top users and pages of a tag are grouped by, and ranked by
+LEADERBOARD_GROUPS = {'users': ('rc.rc_user_text',),
+                      'pages': ('rc.htrc_lang', 'rc.rc_title')}
+LEADERBOARD_ORDERS = ('revisions', 'bytes')
+LEADERBOARD_LIMIT = 10
+# The homepage's queries are kept warm by the cache's background
+# thread, and served stale for up to HOT_STALE_TIMEOUT while they're
+# recomputed, so visitors don't wait on them (see cache.py)
+HOT_METHODS = ('get_top_hashtags', 'get_langs')
+HOT_STALE_TIMEOUT = 60 * 60
 _cur_dir = os.path.dirname(__file__)
-_cache_dir = os.path.join(_cur_dir, '../cache')
-Cache = werkzeug.contrib.cache.FileSystemCache(_cache_dir)
+_cache_dir = os.environ.get('HT_CACHE_DIR', os.path.join(_cur_dir, '../cache'))
+_cache_max_bytes = int(os.environ.get('HT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+Cache = TieredCache(_cache_dir, max_file_bytes=_cache_max_bytes)
+
+
+def is_mention(tag):
+    "Whether *tag* is an @mention, e.g. '@Example', or '@' for all of them."
+    return bool(tag) and tag[0] == '@'
+
+
+def _tagged_revisions(tag, with_text=True, valid_ready=True):
+    """recentchanges joined to the rows for *tag*, or with no tag, to
+    every valid hashtag's, excluding log entries. Without *with_text*,
+    the all-tags query skips joining hashtags. Unless *valid_ready*,
+    it checks the rules inline instead of joining the valid_hashtags
+    table (MySQL only). A mention *tag* joins the mention tables
+    instead.
+    """
+    if is_mention(tag):
+        return _mentioned_revisions(tag[1:], with_text)
+    query = Query('recentchanges AS rc')
+    query.join('hashtag_recentchanges AS htrc', 'htrc.htrc_id = rc.htrc_id')
+    if not tag and valid_ready:
+        query.join('%s AS vh' % VALID_TABLE, 'vh.ht_id = htrc.ht_id')
+    if tag or with_text or not valid_ready:
+        query.join('hashtags AS ht', 'ht.ht_id = htrc.ht_id')
+    if tag:
+        query.where('ht.ht_text = ?', tag)
+    else:
+        query.where('rc.rc_type = 0')
+        if not valid_ready:
+            match_rules(query)
+    return query
+
+
+def _mentioned_revisions(name, with_text=True):
+    """recentchanges joined to the rows mentioning *name*, or anyone.
+    A revision has a row per hashtag, and each has a mention row, so
+    only the first (lowest htrc_id) of each revision is kept. That's
+    checked per row (see _EARLIER_MENTION), so a page seeking on rc
+    only reads the rows it returns, not every mention.
+    """
+    query = Query('recentchanges AS rc')
+    query.join('mention_recentchanges AS mnrc', 'mnrc.mnrc_id = rc.htrc_id')
+    if name or with_text:
+        query.join('mentions AS mn', 'mn.mn_id = mnrc.mn_id')
+    if name:
+        query.where('mn.mn_text = ?', name)
+        query.where('NOT EXISTS (%s\n            AND earlier.mn_id = mnrc.mn_id)'
+                    % _EARLIER_MENTION)
+    else:
+        query.where('NOT EXISTS (%s)' % _EARLIER_MENTION)
+    return query
+
+
+# An earlier mention row of the revision of the row ``rc``. Its rows
+# are found by the rc_timestamp index, since they share it.
+_EARLIER_MENTION = """SELECT 1
+            FROM recentchanges AS earlier_rc
+            JOIN mention_recentchanges AS earlier
+            ON earlier.mnrc_id = earlier_rc.htrc_id
+            WHERE earlier_rc.rc_timestamp = rc.rc_timestamp
+            AND earlier_rc.rc_id = rc.rc_id
+            AND earlier_rc.htrc_lang = rc.htrc_lang
+            AND earlier_rc.htrc_id < rc.htrc_id"""
+
+
+def _expression_revisions(matched):
+    """recentchanges joined to the one row of each revision that
+    *matched* (a tagexpr.matching_query) selects.
+    """
+    sql, params = matched.build()
+    query = Query('recentchanges AS rc')
+    query.join('(%s) AS matched' % sql, 'matched.htrc_id = rc.htrc_id',
+               *params)
+    return query
+
+
+def hashtags_query(tag=None,
+                   lang=None,
+                   limit=PAGINATION,
+                   after=None,
+                   before=None,
+                   startdate=None,
+                   enddate=None,
+                   profile=DEFAULT_PROFILE,
+                   terms=(),
+                   valid_ready=True):
+    """The page query behind get_hashtags (or with no *tag*,
+    get_all_hashtags, or for a mention, get_mentions). Returns ``(sql,
+    params, record_type)``. See _tagged_revisions for *valid_ready*.
+
+    With *terms*, only revisions whose comments have all of them are
+    selected, using the replica's index of them (see textindex.py).
+    """
+    seek, seek_params, order = seek_clause(after, before)
+    columns = get_columns(profile, MENTION_COLUMNS if is_mention(tag)
+                          else HASHTAG_COLUMNS)
+    query = _tagged_revisions(tag, valid_ready=valid_ready)
+    query.select(*columns)
+    query.where_lang('rc.htrc_lang', lang)
+    query.where_dates('rc.rc_timestamp', startdate, enddate)
+    match_terms(query, terms)
+    if seek:
+        query.where(seek, *seek_params)
+    query.order_by('rc.rc_timestamp %s' % order, 'rc.rc_id %s' % order,
+                   'rc.htrc_id %s' % order)
+    query.limit(limit)
+    return query.build() + (get_record_type(columns),)
+
+
+def _page_queries(tag, terms, **kw):
+    """hashtags_query's ``(sql, params, record_type)``, plus what to
+    pass execute as *replica_only*: with *terms*, the query only works
+    on the replica.
+    """
+    query, params, record_type = hashtags_query(tag, terms=terms, **kw)
+    return query, params, record_type, bool(terms)
+
+
+def hashtag_stats_query(tag=None, lang=None, startdate=None, enddate=None,
+                        matched=None, valid_ready=True):
+    """The aggregate query behind get_hashtag_stats, over *tag* or the
+    revisions *matched* by a tag expression (see _expression_revisions).
+    Returns ``(sql, params)``.
+    """
+    if matched:
+        query = _expression_revisions(matched)
+    else:
+        query = _tagged_revisions(tag, with_text=False,
+                                  valid_ready=valid_ready)
+    query.select('COUNT(*) AS revisions',
+                 'COUNT(DISTINCT rc.rc_user) AS users',
+                 'COUNT(DISTINCT rc.rc_title) AS pages',
+                 'COUNT(DISTINCT rc.htrc_lang) AS langs',
+                 'MIN(rc.rc_timestamp) AS oldest',
+                 'MAX(rc.rc_timestamp) AS newest',
+                 'SUM(ABS(rc.rc_new_len - rc.rc_old_len)) AS bytes')
+    query.where_lang('rc.htrc_lang', lang)
+    query.where_dates('rc.rc_timestamp', startdate, enddate)
+    return query.build()
+
+
+def series_tail_query(tag, lang, width, since):
+    "The bucketed counts behind get_hashtag_series. Returns ``(sql, params)``."
+    query = _tagged_revisions(tag)
+    query.select('SUBSTR(rc.rc_timestamp, 1, ?) AS bucket',
+                 'COUNT(*) AS revisions',
+                 'SUM(ABS(rc.rc_new_len - rc.rc_old_len)) AS bytes',
+                 params=(width,))
+    query.where_lang('rc.htrc_lang', lang)
+    query.where_dates('rc.rc_timestamp', since)
+    query.group_by('bucket')
+    query.order_by('bucket')
+    return query.build()
+
+
+def leaderboard_query(tag=None, group='users', order='revisions',
+                      limit=LEADERBOARD_LIMIT, lang=None, startdate=None,
+                      enddate=None, matched=None, valid_ready=True):
+    """The grouped counts behind get_leaderboard: the top *limit*
+    users or pages (see LEADERBOARD_GROUPS) of *tag* (or the revisions
+    *matched* by a tag expression) by revisions or bytes changed.
+    Returns ``(sql, params)``.
+    """
+    columns = LEADERBOARD_GROUPS[group]
+    if matched:
+        query = _expression_revisions(matched)
+    else:
+        query = _tagged_revisions(tag, with_text=False,
+                                  valid_ready=valid_ready)
+    query.select(*columns)
+    query.select('COUNT(*) AS revisions',
+                 'SUM(ABS(rc.rc_new_len - rc.rc_old_len)) AS bytes')
+    query.where_lang('rc.htrc_lang', lang)
+    query.where_dates('rc.rc_timestamp', startdate, enddate)
+    query.group_by(*columns)
+    # ties are broken by name, so the same filters give the same list
+    query.order_by('%s DESC' % order, *columns)
+    query.limit(limit)
+    return query.build()
 
 
 class HashtagDatabaseConnection(object):
-    def __init__(self):
-        self.connect()
+    def __init__(self, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE):
+        self.pool = ConnectionPool(self.connect,
+                                   min_size=min_size,
+                                   max_size=max_size)
+        self.rollups = RollupStore(self)
+        self.valid_hashtags = ValidHashtags(self)
+        self.top_hashtags = TopHashtagTracker(self)
+        self.suggestions = SuggestIndex(self)
+        self.run_logs = RunLogAggregator(self)
+        self.replica = Replica(self, REPLICA_PATH) if REPLICA_PATH else None
+        self._warm_started = False
+        self._warm_lock = threading.Lock()
+        self._mention_slots = threading.BoundedSemaphore(MAX_MENTION_QUERIES)
 
     def connect(self, read_default_file=DB_CONFIG_PATH):
         with tlog.critical('connect') as rec:
-            self.connection = oursql.connect(db=HT_DB_NAME,
-                                             host=HT_DB_HOST,
-                                             read_default_file=read_default_file,
-                                             charset=None,
-                                             use_unicode=False,
-                                             autoping=True)
-
-    def execute(self, query, params, cache_name=None, show_tables=False):
-        if cache_name:
-            results = Cache.get(cache_name)
-            if results:
-                return results
-        if not self.connection:
-            self.connect()
-        cursor = self.connection.cursor(oursql.DictCursor, show_table=show_tables)
-        try:
-            cursor.execute(query, params)
-        except Exception as e:
-            self.connect()  # Reconnecting
-            cursor = self.connection.cursor(oursql.DictCursor, show_table=show_tables)
-            cursor.execute(query, params)
-        results = cursor.fetchall()
+            return oursql.connect(db=HT_DB_NAME,
+                                  host=HT_DB_HOST,
+                                  read_default_file=read_default_file,
+                                  charset=None,
+                                  use_unicode=False,
+                                  autoping=True)
+
+    def execute(self, query, params, cache_name=None, show_tables=False,
+                record_type=None, replica=False, replica_only=False,
+                name=None):
+        """Runs a read query. If *cache_name* (usually the calling method's
+        name) is given, results are cached under a key derived from the
+        query and its params, for that method's timeout.
+
+        Rows are dicts, unless a *record_type* (see records.py) is given,
+        in which case they're fetched and cached as plain tuples and
+        wrapped in it on the way out.
+
+        Queries passed with *replica* only use the mirrored tables and
+        SQL that SQLite understands, and are read from the local replica
+        while it's fresh (see replica.py). Queries passed with
+        *replica_only* use what only the replica has, and raise
+        SearchUnavailable rather than go to the shared database.
+
+        Metrics are labeled with *name*, which defaults to *cache_name*.
+        """
+        name = name or cache_name
+        as_tuples = record_type is not None
         if cache_name:
-            Cache.set(cache_name, results, timeout=CACHE_EXPIRATION)
+            key = make_key(cache_name, query, params, show_tables, as_tuples)
+            hot = cache_name in HOT_METHODS
+            ret = Cache.get_or_compute(
+                key,
+                lambda: self._execute_retry(query, params, show_tables,
+                                            as_tuples, name=name,
+                                            replica=replica,
+                                            replica_only=replica_only),
+                timeout=CACHE_TIMEOUTS.get(cache_name, CACHE_EXPIRATION),
+                stale_timeout=HOT_STALE_TIMEOUT if hot else 0,
+                warm=hot)
+        else:
+            ret = self._execute_retry(query, params, show_tables, as_tuples,
+                                      name=name, replica=replica,
+                                      replica_only=replica_only)
+        if as_tuples:
+            ret = [record_type(row) for row in ret]
+        return ret
+
+    def _execute_retry(self, query, params, show_tables=False,
+                       as_tuples=False, name=None, replica=False,
+                       replica_only=False):
+        name = name or 'uncached'
+        start = time.time()
+        results = None
+        if replica_only and not self.can_search_comments():
+            raise SearchUnavailable('the comment index is unavailable')
+        if (replica and not show_tables and self.replica is not None
+                and self.replica.is_fresh()):
+            try:
+                results = self.replica.execute(query, params, as_tuples)
+                source = 'replica'
+            except REPLICA_ERRORS:
+                Metrics.inc('ht_replica_errors_total', method=name)
+                if replica_only:
+                    raise SearchUnavailable('the comment index failed')
+        if results is None:
+            source = 'remote'
+            limited = name in MENTION_METHODS
+            if limited:
+                self._mention_slots.acquire()
+            try:
+                results = self._execute(query, params, show_tables, as_tuples)
+            except RECONNECT_ERRORS:
+                # The borrowed connection was dropped from the pool; retry
+                # once on a fresh one
+                Metrics.inc('ht_db_reconnects_total', method=name)
+                results = self._execute(query, params, show_tables, as_tuples)
+            finally:
+                if limited:
+                    self._mention_slots.release()
+        duration = time.time() - start
+        Metrics.observe('ht_db_query_seconds', duration,
+                        method=name, source=source)
+        Metrics.inc('ht_db_rows_total', len(results), method=name)
+        Metrics.inc('ht_db_bytes_total', count_bytes(results), method=name)
+        if SLOW_QUERY_SECONDS and duration >= SLOW_QUERY_SECONDS:
+            self._log_slow_query(name, query, params, duration, len(results))
         return results
 
+    def _log_slow_query(self, name, query, params, duration, row_count):
+        with tlog.critical('slow_query') as rec:
+            rec.success('{name} took {duration}s for {row_count} rows:'
+                        ' {query} {params}',
+                        name=name,
+                        duration=round(duration, 3),
+                        row_count=row_count,
+                        query=' '.join(query.split()),
+                        params=repr(params))
+
+    def _execute(self, query, params, show_tables=False, as_tuples=False):
+        cursor_class = oursql.Cursor if as_tuples else oursql.DictCursor
+        with self.pool.connection() as connection:
+            cursor = connection.cursor(cursor_class, show_table=show_tables)
+            try:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    def warm_homepage(self):
+        """Loads the homepage's queries in a background thread, so the
+        first visitors don't wait on them. They're kept warm after that
+        (see HOT_METHODS). Only the first call does anything.
+        """
+        with self._warm_lock:
+            if self._warm_started:
+                return
+            self._warm_started = True
+
+        def _run():
+            try:
+                self.get_langs()
+                self.get_top_hashtags()
+            except Exception:
+                pass  # recorded by tlog; the first visitor will retry
+
+        thread = threading.Thread(target=_run, name='warm-homepage')
+        thread.daemon = True
+        thread.start()
+
+    def get_pool_stats(self):
+        return self.pool.stats()
+
+    def can_search_comments(self):
+        "Whether the replica's index of comments is fresh enough to use."
+        return self.replica is not None and self.replica.is_fresh()
+
+    def _valid_ready(self):
+        """Whether all-tags queries can join the valid_hashtags table
+        (see validity.py), kicking off a refresh if one is due. Until
+        they can, they check the rules inline on the shared database,
+        and their results aren't cached.
+        """
+        self.valid_hashtags.maybe_refresh()
+        return self.valid_hashtags.ready
+
+    def get_replica_stats(self):
+        if self.replica is None:
+            return {'enabled': 0}
+        return self.replica.stats()
+
+    def get_cache_stats(self):
+        return Cache.stats()
+
     def get_hashtags(self,
                      tag=None,
                      lang=None,
-                     start=0,
-                     end=PAGINATION,
+                     limit=PAGINATION,
+                     after=None,
+                     before=None,
                      startdate=None,
-                     enddate=None):
+                     enddate=None,
+                     cache=True,
+                     profile=DEFAULT_PROFILE,
+                     text=None):
+        """Revisions tagged with *tag*, newest first. Pages are fetched
+        by seeking on ``(rc_timestamp, rc_id, htrc_id)``: *after* returns the
+        rows older than that key, *before* the rows newer than it, so
+        every page costs the same regardless of how deep it is.
+
+        Only the columns in *profile* ('report' or 'full', see
+        records.py) are selected. With *text*, only revisions whose
+        comments have all of its words are (see textindex.py).
+        """
         if not tag:
             return self.get_all_hashtags(lang=lang,
-                                         start=start,
-                                         end=end,
+                                         limit=limit,
+                                         after=after,
+                                         before=before,
                                          startdate=startdate,
-                                         enddate=enddate)
+                                         enddate=enddate,
+                                         cache=cache,
+                                         profile=profile,
+                                         text=text)
         if tag and tag[0] == '#':
             tag = tag[1:]
-        if not lang:
-            lang = '%'
+        if is_mention(tag):
+            return self.get_mentions(tag,
+                                     lang=lang,
+                                     limit=limit,
+                                     after=after,
+                                     before=before,
+                                     startdate=startdate,
+                                     enddate=enddate,
+                                     cache=cache,
+                                     profile=profile,
+                                     text=text)
+        terms = parse_terms(text)
+        clauses = self._parse_expression(tag)
+        if clauses:
+            return self._get_expression_hashtags(tag, clauses,
+                                                 lang=lang,
+                                                 limit=limit,
+                                                 after=after,
+                                                 before=before,
+                                                 startdate=startdate,
+                                                 enddate=enddate,
+                                                 cache=cache,
+                                                 profile=profile,
+                                                 terms=terms)
+        query, params, record_type, replica_only = _page_queries(
+            tag, terms,
+            lang=lang,
+            limit=limit,
+            after=after,
+            before=before,
+            startdate=startdate,
+            enddate=enddate,
+            profile=profile)
+        with tlog.critical('get_hashtags') as rec:
+            ret = self.execute(query, params,
+                               cache_name='get_hashtags' if cache else None,
+                               record_type=record_type,
+                               replica=True,
+                               replica_only=replica_only)
+            if before:
+                ret = ret[::-1]
+            rec.success('Fetched revisions tagged with {tag}',
+                        tag=tag)
+            return ret
+
+    def _parse_expression(self, tag):
+        """The clauses of *tag* if it's a tag expression (see tagexpr.py),
+        otherwise None. Malformed expressions are searched for as-is,
+        and so find nothing.
+        """
+        if not is_tag_expression(tag):
+            return None
+        try:
+            return parse_tag_expression(tag)
+        except ValueError:
+            return None
+
+    def _match_comments(self, htrc_ids, terms):
+        "The set of *htrc_ids* whose comments have all of *terms*."
+        ret = set()
+        for i in range(0, len(htrc_ids), ID_CHUNK_SIZE):
+            query = Query('recentchanges AS rc')
+            query.select('rc.htrc_id')
+            query.where_in('rc.htrc_id', htrc_ids[i:i + ID_CHUNK_SIZE])
+            match_terms(query, terms)
+            rows = self.execute(*query.build(), replica=True,
+                                replica_only=True)
+            ret.update(row['htrc_id'] for row in rows)
+        return ret
+
+    def _get_expression_hashtags(self, tag, clauses,
+                                 lang=None,
+                                 limit=PAGINATION,
+                                 after=None,
+                                 before=None,
+                                 startdate=None,
+                                 enddate=None,
+                                 cache=True,
+                                 profile=DEFAULT_PROFILE,
+                                 terms=()):
+        keep = None
+        if terms:
+            if not self.can_search_comments():
+                raise SearchUnavailable('the comment index is unavailable')
+            keep = lambda htrc_ids: self._match_comments(htrc_ids, terms)
+
+        def _find_page():
+            return find_page(self, clauses, lang, startdate, enddate,
+                             after=after, before=before, limit=limit,
+                             keep=keep)
+
+        with tlog.critical('get_expression_hashtags') as rec:
+            if cache:
+                page = Cache.get_or_compute(
+                    make_key('get_tag_expression', tag, lang, startdate,
+                             enddate, terms, after and tuple(after),
+                             before and tuple(before), limit),
+                    _find_page,
+                    timeout=CACHE_TIMEOUTS['get_hashtags'])
+            else:
+                page = _find_page()
+            ret = self._get_revisions_by_id([key[2] for key in page],
+                                            cache=cache,
+                                            profile=profile)
+            rec.success('Fetched revisions matching {tag}', tag=tag)
+            return ret
+
+    def _get_revisions_by_id(self, htrc_ids, cache=True,
+                             profile=DEFAULT_PROFILE):
+        "Rows for *htrc_ids*, newest first."
+        if not htrc_ids:
+            return []
+        columns = get_columns(profile, HASHTAG_COLUMNS)
         query = '''
-        SELECT *
+        SELECT %s
         FROM recentchanges AS rc
         JOIN hashtag_recentchanges AS htrc
         ON htrc.htrc_id = rc.htrc_id
         JOIN hashtags AS ht
         ON ht.ht_id = htrc.ht_id
-        WHERE ht.ht_text = ?
-        AND rc.htrc_lang LIKE ?
-        AND rc.rc_timestamp BETWEEN ? AND ?
-        ORDER BY rc.rc_timestamp DESC
-        LIMIT ?, ?'''
-        params = (tag, lang, startdate, enddate, start, end)
-        with tlog.critical('get_hashtags') as rec:
-            ret = self.execute(query, params)
-            rec.success('Fetched revisions tagged with {tag}',
-                        tag=tag)
-            return ret
+        WHERE rc.htrc_id IN (%s)
+        ORDER BY rc.rc_timestamp DESC, rc.rc_id DESC, rc.htrc_id DESC''' % (
+            ', '.join(columns), ', '.join(['?'] * len(htrc_ids)))
+        return self.execute(query, tuple(htrc_ids),
+                            cache_name='get_hashtags' if cache else None,
+                            record_type=get_record_type(columns),
+                            replica=True)
 
     def get_all_hashtags(self,
                          lang=None,
-                         start=0,
-                         end=PAGINATION,
+                         limit=PAGINATION,
+                         after=None,
+                         before=None,
                          startdate=None,
-                         enddate=None):
+                         enddate=None,
+                         cache=True,
+                         profile=DEFAULT_PROFILE,
+                         text=None):
         """Rules for hashtags:
         1. Does not include MediaWiki magic words
         (like #REDIRECT) or parser functions
@@ -99,65 +609,201 @@ class HashtagDatabaseConnection(object):
         3. Must contain at least one non-numeric
         character.
         """
-        if not lang:
-            lang = '%'
-        query = '''
-        SELECT *
-        FROM recentchanges AS rc
-        JOIN hashtag_recentchanges AS htrc
-        ON htrc.htrc_id = rc.htrc_id
-        JOIN hashtags AS ht
-        ON ht.ht_id = htrc.ht_id
-        WHERE rc.rc_type = 0
-        AND rc.htrc_lang LIKE ?
-        AND ht.ht_text NOT IN(%s)
-        AND ht.ht_text REGEXP '[[:alpha:]]+'
-        AND CHAR_LENGTH(ht.ht_text) > 1
-        AND rc.rc_timestamp BETWEEN ? AND ?
-        ORDER BY rc.rc_id DESC
-        LIMIT ?, ?''' % ', '.join(['?' for i in range(len(EXCLUDED))])
-        params = (lang,) + EXCLUDED + (startdate, enddate, start, end)
+        ready = self._valid_ready()
+        terms = parse_terms(text)
+        if terms and not ready:
+            # the replica can't check the rules inline
+            raise SearchUnavailable('the valid hashtags are being built')
+        query, params, record_type, replica_only = _page_queries(
+            None, terms,
+            lang=lang,
+            limit=limit,
+            after=after,
+            before=before,
+            startdate=startdate,
+            enddate=enddate,
+            profile=profile,
+            valid_ready=ready)
         with tlog.critical('get_all_hashtags') as rec:
-            ret = self.execute(query, params)
-            rec.success('Fetched all hashtags starting at {start}',
-                        start=start)
+            ret = self.execute(query, params,
+                               cache_name=('get_all_hashtags'
+                                           if cache and ready else None),
+                               record_type=record_type,
+                               replica=ready,
+                               replica_only=replica_only)
+            if before:
+                ret = ret[::-1]
+            rec.success('Fetched all hashtags after {after}',
+                        after=after)
             return ret
 
+    def iter_hashtags(self,
+                      tag=None,
+                      lang=None,
+                      limit=None,
+                      startdate=None,
+                      enddate=None,
+                      chunk_size=CHUNK_SIZE,
+                      profile='full',
+                      text=None):
+        """Yields every revision tagged with *tag*, newest first, fetching
+        *chunk_size* rows at a time by seeking from the last row of the
+        previous chunk. Only one chunk is held in memory at once.
+        """
+        after = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = chunk_size
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            chunk = self.get_hashtags(tag,
+                                      lang=lang,
+                                      limit=size,
+                                      after=after,
+                                      startdate=startdate,
+                                      enddate=enddate,
+                                      cache=False,
+                                      profile=profile,
+                                      text=text)
+            for rev in chunk:
+                yield rev
+            if len(chunk) < size:
+                return
+            last = chunk[-1]
+            after = (last['rc_timestamp'], last['rc_id'], last['htrc_id'])
+
     def get_top_hashtags(self, limit=10, recent_count=100000, nobots=True):
         """Gets the top hashtags from an arbitrarily "recent" group of edits
-        (not all time).
+        (not all time). Answered by the incremental tracker when it can;
+        the query is the fallback while it warms up.
         """
-        excluded_p = ', '.join(['?' for i in range(len(EXCLUDED))])
         if nobots:
-            bot_condition = 'AND rc_bot = 0'
-        else:
-            bot_condition = ''
-        query_tmpl = '''
-        SELECT ht.ht_text,
-               COUNT(ht.ht_text) AS count
-        FROM   recentchanges AS rc
-               JOIN hashtag_recentchanges AS htrc
-                 ON htrc.htrc_id = rc.htrc_id
-                    AND rc.htrc_id > (SELECT MAX(htrc_id)
-                                      FROM   recentchanges) - ?
-               JOIN hashtags AS ht
-                 ON ht.ht_id = htrc.ht_id
-        WHERE  ht.ht_text REGEXP '[[:alpha:]]{1}[[:alnum:]]+'
-        AND    ht.ht_text NOT IN (%s)
-        %s
-        GROUP  BY ht.ht_text
-        ORDER  BY count DESC
-        LIMIT  ?;'''
-        query = query_tmpl % (excluded_p, bot_condition)
-        params = (recent_count,) + EXCLUDED + (limit,)
+            ret = self.top_hashtags.top(limit=limit, recent_count=recent_count)
+            if ret is not None:
+                return ret
+        ready = self._valid_ready()
+        query = Query('recentchanges AS rc')
+        query.select('ht.ht_text', 'COUNT(ht.ht_text) AS count')
+        query.join('hashtag_recentchanges AS htrc',
+                   'htrc.htrc_id = rc.htrc_id')
+        if ready:
+            query.join('%s AS vh' % VALID_TABLE, 'vh.ht_id = htrc.ht_id')
+        query.join('hashtags AS ht', 'ht.ht_id = htrc.ht_id')
+        query.where('rc.htrc_id > (SELECT MAX(htrc_id) '
+                    'FROM recentchanges) - ?', recent_count)
+        if nobots:
+            query.where('rc.rc_bot = 0')
+        if not ready:
+            match_rules(query)
+        query.group_by('ht.ht_text')
+        query.order_by('count DESC')
+        query.limit(limit)
         # This query is cached because it's loaded for each visit to
-        # the index page
+        # the index page (once the valid hashtags are ready)
         with tlog.critical('get_top_hashtags') as rec:
-            ret = self.execute(query, params, cache_name='top-tags-%s-%s' % (nobots, limit))
+            ret = self.execute(*query.build(),
+                               cache_name=('get_top_hashtags' if ready
+                                           else None),
+                               replica=ready)
             rec.success('Fetched top tags with limit of {limit}',
                         limit=limit)
             return ret
 
+    def get_hashtag_series(self,
+                           tag,
+                           lang=None,
+                           unit=DEFAULT_UNIT,
+                           startdate=None,
+                           enddate=None):
+        """Revision and byte counts for *tag* per hour, day or week, as
+        ``(bucket, revisions, bytes)`` tuples. Closed buckets are cached
+        for the tag and lang; each call only queries the open tail.
+        """
+        if unit not in UNITS:
+            unit = DEFAULT_UNIT
+        if unit == 'week':
+            days = self.get_hashtag_series(tag,
+                                           lang=lang,
+                                           unit='day',
+                                           startdate=startdate,
+                                           enddate=enddate)
+            return fold_weeks(days)
+        if tag and tag[0] == '#':
+            tag = tag[1:]
+        width = UNIT_WIDTHS[unit]
+        key = make_key('get_hashtag_series', tag, lang, unit)
+        with tlog.critical('get_hashtag_series') as rec:
+            hit, closed = Cache.get(key)
+            if not hit:
+                closed = {'until': '', 'buckets': []}
+            boundary = first_open_bucket(unit)
+            tail = self._get_series_tail(tag, lang, width, closed['until'])
+            if closed['until'] != boundary:
+                closed = {'until': boundary,
+                          'buckets': (closed['buckets']
+                                      + [b for b in tail if b[0] < boundary])}
+                Cache.set(key, closed, timeout=SERIES_CACHE_EXPIRATION)
+            buckets = closed['buckets'] + [b for b in tail if b[0] >= boundary]
+            rec.success('Fetched {unit} series for {tag}', unit=unit, tag=tag)
+            return filter_buckets(buckets, startdate, enddate)
+
+    def _get_series_tail(self, tag, lang, width, since):
+        since = since + '0' * (14 - len(since))
+        query, params = series_tail_query(tag, lang, width, since)
+        rows = self.execute(query, params, replica=True)
+        return [(r['bucket'], r['revisions'], int(r['bytes'] or 0))
+                for r in rows]
+
+    def get_last_change(self, tag=None):
+        """The ``(htrc_id, rc_timestamp)`` of the newest revision tagged
+        with *tag* (with any of its tags, for a tag expression), or of
+        the newest revision at all if there's no tag. None if there
+        isn't one. Cheap enough to run on every request: each is a
+        single descent of an index, and isn't cached.
+        """
+        if not tag:
+            query = '''
+            SELECT htrc_id, rc_timestamp
+            FROM recentchanges
+            ORDER BY htrc_id DESC
+            LIMIT 1'''
+            params = ()
+        elif is_mention(tag):
+            query = '''
+            SELECT rc.htrc_id, rc.rc_timestamp
+            FROM recentchanges AS rc
+            WHERE rc.htrc_id = (
+                SELECT MAX(mnrc.mnrc_id)
+                FROM mention_recentchanges AS mnrc
+                JOIN mentions AS mn
+                ON mn.mn_id = mnrc.mn_id
+                WHERE mn.mn_text = ?)'''
+            params = (tag[1:],)
+        else:
+            if tag[0] == '#':
+                tag = tag[1:]
+            clauses = self._parse_expression(tag)
+            names = get_tag_names(clauses) if clauses else [tag]
+            query = '''
+            SELECT rc.htrc_id, rc.rc_timestamp
+            FROM recentchanges AS rc
+            WHERE rc.htrc_id = (
+                SELECT MAX(htrc.htrc_id)
+                FROM hashtag_recentchanges AS htrc
+                JOIN hashtags AS ht
+                ON ht.ht_id = htrc.ht_id
+                WHERE ht.ht_text IN (%s))''' % ', '.join(['?'] * len(names))
+            params = tuple(names)
+        rows = self.execute(query, params, replica=True)
+        if not rows:
+            return None
+        return rows[0]['htrc_id'], rows[0]['rc_timestamp']
+
+    def get_suggestions(self, prefix, limit=10):
+        "Valid hashtags starting with *prefix*, most used first. See suggest.py."
+        return self.suggestions.suggest(prefix, limit=limit)
+
     def get_langs(self):
         query = '''
         SELECT htrc_lang
@@ -165,7 +811,8 @@ class HashtagDatabaseConnection(object):
         GROUP BY htrc_lang'''
         params = ()
         with tlog.critical('get_langs') as rec:
-            ret = self.execute(query, params, cache_name='langs')
+            ret = self.execute(query, params, cache_name='get_langs',
+                               replica=True)
             rec.success('Fetched available languages')
             return ret
 
@@ -178,87 +825,178 @@ class HashtagDatabaseConnection(object):
             return self.get_all_hashtag_stats(lang=lang, startdate=startdate, enddate=enddate)
         if tag and tag[0] == '#':
             tag = tag[1:]
-        if not lang:
-            lang = '%'
-        query = '''
-        SELECT COUNT(*) as revisions,
-        COUNT(DISTINCT rc_user) as users,
-        COUNT(DISTINCT rc_title) as pages,
-        COUNT(DISTINCT htrc_lang) as langs,
-        MIN(rc_timestamp) as oldest,
-        MAX(rc_timestamp) as newest,
-        SUM(ABS(rc_new_len - rc_old_len)) as bytes
-        FROM recentchanges AS rc
-        JOIN hashtag_recentchanges AS htrc
-        ON htrc.htrc_id = rc.htrc_id
-        JOIN hashtags AS ht
-        ON ht.ht_id = htrc.ht_id
-        WHERE ht.ht_text = ?
-        AND rc.htrc_lang LIKE ?
-        AND rc.rc_timestamp BETWEEN ? AND ?
-        ORDER BY rc.rc_id DESC'''
-        params = (tag, lang, startdate, enddate)
+        query, params = hashtag_stats_query(tag, lang, startdate, enddate)
+        if is_mention(tag):
+            # mentions aren't rolled up, and can't be combined
+            with tlog.critical('get_mention_stats') as rec:
+                ret = self.execute(query, params,
+                                   cache_name='get_mention_stats',
+                                   replica=True)
+                rec.success('Fetched stats for {tag}', tag=tag)
+                return ret
+        def _get_stats():
+            clauses = self._parse_expression(tag)
+            if clauses:
+                # expressions aren't rolled up
+                matched = matching_query(self, clauses, lang,
+                                         startdate, enddate)
+                return self.execute(*hashtag_stats_query(lang=lang,
+                                                         startdate=startdate,
+                                                         enddate=enddate,
+                                                         matched=matched),
+                                    replica=True)
+            ret = self.rollups.get_stats(tag,
+                                         lang=lang,
+                                         startdate=startdate,
+                                         enddate=enddate)
+            if ret is None:
+                ret = self.execute(query, params, replica=True)
+            return ret
+
         with tlog.critical('get_hashtag_stats') as rec:
-            ret = self.execute(query, params)
+            ret = Cache.get_or_compute(
+                make_key('get_hashtag_stats', tag, lang, startdate, enddate),
+                _get_stats,
+                timeout=CACHE_TIMEOUTS['get_hashtag_stats'])
             rec.success('Fetched stats for {tag}',
                         tag=tag)
             return ret
 
     def get_all_hashtag_stats(self, lang=None, startdate=None, enddate=None):
-        # TODO: Add conditions here
-        if not lang:
-            lang = '%'
-        query = '''
-        SELECT COUNT(*) as revisions,
-        COUNT(DISTINCT rc_user) as users,
-        COUNT(DISTINCT rc_title) as pages,
-        MIN(rc_timestamp) as oldest,
-        MAX(rc_timestamp) as newest,
-        SUM(ABS(rc_new_len - rc_old_len)) as bytes
-        FROM recentchanges AS rc
-        JOIN hashtag_recentchanges AS htrc
-        ON htrc.htrc_id = rc.htrc_id
-        JOIN hashtags AS ht
-        ON ht.ht_id = htrc.ht_id
-        WHERE rc.rc_type = 0
-        AND rc.htrc_lang LIKE ?
-        AND rc.rc_timestamp BETWEEN ? AND ?
-        AND ht.ht_text NOT IN(%s)
-        AND ht.ht_text REGEXP '[[:alpha:]]+' ''' % ', '.join(['?' for i in range(len(EXCLUDED))])
+        ready = self._valid_ready()
+        query, params = hashtag_stats_query(None, lang, startdate, enddate,
+                                            valid_ready=ready)
+        def _get_stats():
+            ret = None
+            if ready:
+                # the rollups' tail is filtered by the table too
+                ret = self.rollups.get_stats(lang=lang,
+                                             startdate=startdate,
+                                             enddate=enddate)
+            if ret is None:
+                ret = self.execute(query, params, replica=ready)
+            return ret
+
         with tlog.critical('get_all_hashtag_stats') as rec:
-            ret = self.execute(query, (lang, startdate, enddate,) + EXCLUDED)
+            if ready:
+                ret = Cache.get_or_compute(
+                    make_key('get_all_hashtag_stats', lang, startdate,
+                             enddate),
+                    _get_stats,
+                    timeout=CACHE_TIMEOUTS['get_all_hashtag_stats'])
+            else:
+                ret = _get_stats()
             rec.success('Fetched all hashtag stats')
             return ret
 
-    def get_mentions(self, name=None, start=0, end=PAGINATION):
-        if not name:
-            return self.get_all_mentions(start, end)
-        if name and name[0] == '@':
+    def get_leaderboard(self,
+                        tag,
+                        group='users',
+                        order='revisions',
+                        limit=LEADERBOARD_LIMIT,
+                        lang=None,
+                        startdate=None,
+                        enddate=None):
+        """The top *limit* users or pages (*group*) of *tag*, or of every
+        valid tag if there's none, by *order* ('revisions' or 'bytes').
+        Rows are dicts of the group's columns plus revisions and bytes.
+        """
+        if group not in LEADERBOARD_GROUPS:
+            raise ValueError('expected group in %r, not %r'
+                             % (sorted(LEADERBOARD_GROUPS), group))
+        if order not in LEADERBOARD_ORDERS:
+            raise ValueError('expected order in %r, not %r'
+                             % (LEADERBOARD_ORDERS, order))
+        if tag and tag[0] == '#':
             tag = tag[1:]
-        query = '''
-        SELECT *
-        FROM recentchanges AS rc
-        JOIN mention_recentchanges AS mnrc
-        ON mnrc.mnrc_id = rc.htrc_id
-        JOIN mentions AS mn
-        ON mn.mn_id = mnrc.mn_id
-        WHERE mn.mn_text = ?
-        ORDER BY rc.rc_id DESC
-        LIMIT ?, ?'''
-        params = (name, start, end)
-        return self.execute(query, params)
-
-    def get_all_mentions(self, start=0, end=PAGINATION):
-        query = '''
-        SELECT *
-        FROM recentchanges AS rc
-        JOIN mention_recentchanges AS mnrc
-        ON mnrc.mnrc_id = rc.htrc_id
-        JOIN mentions AS mn
-        ON mn.mn_id = mnrc.mn_id
-        ORDER BY rc.rc_id DESC
-        LIMIT ?, ?'''
-        return self.execute(query, (start, end))
+        ready = bool(tag) or self._valid_ready()
+        mention = is_mention(tag)
+        clauses = None if mention else self._parse_expression(tag)
+        def _get_leaderboard():
+            matched = None
+            if clauses:
+                matched = matching_query(self, clauses, lang,
+                                         startdate, enddate)
+            query, params = leaderboard_query(tag, group, order, limit,
+                                              lang, startdate, enddate,
+                                              matched=matched,
+                                              valid_ready=ready)
+            rows = self.execute(query, params, replica=ready,
+                                name='get_mention_leaderboard' if mention
+                                else None)
+            for row in rows:
+                row['bytes'] = int(row['bytes'] or 0)
+            return rows
+
+        with tlog.critical('get_leaderboard') as rec:
+            if ready:
+                ret = Cache.get_or_compute(
+                    make_key('get_leaderboard', tag, group, order, limit,
+                             lang, startdate, enddate),
+                    _get_leaderboard,
+                    timeout=CACHE_TIMEOUTS['get_leaderboard'])
+            else:
+                ret = _get_leaderboard()
+            rec.success('Fetched top {group} for {tag}',
+                        group=group,
+                        tag=tag or 'all tags')
+            return ret
+
+    def get_mentions(self,
+                     name=None,
+                     lang=None,
+                     limit=PAGINATION,
+                     after=None,
+                     before=None,
+                     startdate=None,
+                     enddate=None,
+                     cache=True,
+                     profile=DEFAULT_PROFILE,
+                     text=None):
+        """Revisions mentioning *name* (with or without its "@"), or
+        anyone if there's no name, newest first. Paged, filtered and
+        cached like get_hashtags.
+        """
+        if name and name[0] == '@':
+            name = name[1:]
+        method = 'get_mentions' if name else 'get_all_mentions'
+        query, params, record_type, replica_only = _page_queries(
+            '@' + (name or ''), parse_terms(text),
+            lang=lang,
+            limit=limit,
+            after=after,
+            before=before,
+            startdate=startdate,
+            enddate=enddate,
+            profile=profile)
+        with tlog.critical(method) as rec:
+            ret = self.execute(query, params,
+                               cache_name=method if cache else None,
+                               record_type=record_type,
+                               replica=True,
+                               replica_only=replica_only,
+                               name=method)
+            if before:
+                ret = ret[::-1]
+            rec.success('Fetched revisions mentioning {name}',
+                        name=name or 'anyone')
+            return ret
+
+    def get_all_mentions(self, **kw):
+        return self.get_mentions(None, **kw)
+
+    def get_run_log_summaries(self):
+        "Per-language totals of the last three days' runs. See runlog.py."
+        return self.run_logs.get_summaries()
+
+    def get_recent_lang_runs(self, lang, limit=None, days=RUN_LOG_WINDOW_DAYS):
+        """Runs for *lang* over the last *days*, newest first, or None if
+        that's longer than the aggregator keeps, in which case the caller
+        should use get_lang_run_log.
+        """
+        if days > self.run_logs.window_days:
+            return None
+        return self.run_logs.get_runs(lang, limit=limit, days=days)
 
     def get_run_log(self, limit=50000):
         query = '''
@@ -270,7 +1008,9 @@ class HashtagDatabaseConnection(object):
         ORDER BY cl.complete_timestamp DESC
         LIMIT ?'''
         with tlog.critical('get_run_log') as rec:
-            return self.execute(query, (limit,), show_tables=True)
+            return self.execute(query, (limit,),
+                                cache_name='get_run_log',
+                                show_tables=True)
 
     def get_lang_run_log(self, lang, limit=50000, days=3):
         query = '''
@@ -283,4 +1023,6 @@ class HashtagDatabaseConnection(object):
         ORDER BY cl.complete_timestamp DESC
         LIMIT ?'''
         with tlog.critical('get_run_log') as rec:
-            return self.execute(query, (lang, days, limit), show_tables=True)
+            return self.execute(query, (lang, days, limit),
+                                cache_name='get_lang_run_log',
+                                show_tables=True)
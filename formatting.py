@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+'''
+Formatting
+~~~~~~~~~~
+Turns revision rows from the DAL into what report.html and the CSV
+export display. This runs on every row of every page and export, so
+it avoids per-row work that can be done once: URL prefixes are built
+once per language, timestamps are sliced rather than strptime'd, and
+hashtags are linked in a single regex pass over each comment.
+'''
+import re
+
+from ashes import escape_html
+
+from utils import to_unicode
+
+
+# Same pattern as boltons.strutils.find_hashtags, with the leading
+# whitespace captured so it can be preserved when linking
+HASHTAG_RE = re.compile(u"(^|\\s)[＃#](\\w+)", re.UNICODE)
+TAG_LINK = u'%s<a href="/hashtags/search/%s">#%s</a>'
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+_url_prefixes = {}
+
+
+def _get_url_prefixes(lang):
+    try:
+        return _url_prefixes[lang]
+    except KeyError:
+        pass
+    if lang == 'wikidata':
+        base = 'https://www.wikidata.org/wiki/'
+    else:
+        base = 'https://%s.wikipedia.org/wiki/' % lang
+    ret = _url_prefixes[lang] = (base + '?diff=', base + 'User:', base)
+    return ret
+
+
+def format_timestamp(timestamp, inc_time=True):
+    """Formats an rc_timestamp (YYYYMMDDHHMMSS) like strftime's
+    '%e %b %Y %H:%M:%S', by slicing rather than parsing.
+    """
+    date = '%2d %s %s' % (int(timestamp[6:8]),
+                          MONTHS[int(timestamp[4:6]) - 1],
+                          timestamp[:4])
+    if not inc_time:
+        return date
+    return '%s %s:%s:%s' % (date, timestamp[8:10], timestamp[10:12],
+                            timestamp[12:14])
+
+
+def link_hashtags(comment):
+    """Links every hashtag in *comment* in one pass. Returns the linked
+    comment and the list of tags found.
+    """
+    tags = []
+
+    def _link(match):
+        space, tag = match.groups()
+        tags.append(tag)
+        return TAG_LINK % (space, tag, tag)
+
+    # TODO: Turn @mentions into links
+    return HASHTAG_RE.sub(_link, comment), tags
+
+
+def format_revs(rev):
+    """Returns a new dict of *rev*'s columns (rev may be a dict or a
+    record from records.py) plus the display fields.
+    """
+    rev = dict(rev.items())
+    lang = rev['htrc_lang']
+    diff_prefix, user_prefix, _ = _get_url_prefixes(lang)
+    rev['rc_user_url'] = user_prefix + rev['rc_user_text']
+    rev['spaced_title'] = rev.get('rc_title', '').replace('_', ' ')
+    rev['diff_size'] = rev['rc_new_len'] - rev['rc_old_len']
+    rev['date'] = format_timestamp(rev['rc_timestamp'])
+    rev['diff_url'] = '%s%s&oldid=%s' % (diff_prefix,
+                                         rev['rc_this_oldid'],
+                                         rev['rc_last_oldid'])
+    try:
+        rev['rc_comment'] = escape_html(rev['rc_comment'])
+    except Exception as e:
+        pass
+    rev['rc_comment_plain'] = rev['rc_comment']
+    rev['rc_comment'], rev['tags'] = link_hashtags(to_unicode(rev['rc_comment']))
+    return rev
+
+
+def format_revs_batch(revs):
+    "Formats a whole result set into dicts; see format_revs."
+    return [format_revs(rev) for rev in revs]
+
+
+def format_stats(stats):
+    stats['bytes'] = '{:,}'.format(int(stats['bytes']))
+    stats['revisions'] = '{:,}'.format(stats['revisions'])
+    stats['pages'] = '{:,}'.format(stats['pages'])
+    stats['users'] = '{:,}'.format(stats['users'])
+    stats['newest'] = format_timestamp(stats['newest'], inc_time=False)
+    stats['oldest'] = format_timestamp(stats['oldest'], inc_time=False)
+    return stats
+
+
+def format_leaderboard(rows, default_lang=None):
+    """Formats get_leaderboard's rows for display: links to each user
+    (on *default_lang*'s wiki, or English's, since users are counted
+    across languages) or page, and thousands separators.
+    """
+    ret = []
+    for row in rows:
+        row = dict(row)
+        if 'rc_title' in row:
+            page_prefix = _get_url_prefixes(row['htrc_lang'])[2]
+            row['url'] = page_prefix + row['rc_title']
+            row['name'] = row['rc_title'].replace('_', ' ')
+        else:
+            user_prefix = _get_url_prefixes(default_lang or 'en')[1]
+            row['url'] = user_prefix + row['rc_user_text']
+            row['name'] = row['rc_user_text']
+        row['revisions'] = '{:,}'.format(row['revisions'])
+        row['bytes'] = '{:,}'.format(row['bytes'])
+        ret.append(row)
+    return ret
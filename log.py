@@ -1,4 +1,5 @@
 import os
+import threading
 
 from lithoxyl import Logger, SensibleSink, SensibleFormatter, StreamEmitter, SensibleFilter
 from lithoxyl.emitters import FileEmitter
@@ -8,13 +9,37 @@ class FixedFileEmitter(FileEmitter):
         self.encoding = encoding
         super(FixedFileEmitter, self).__init__(filepath, encoding, **kwargs)
 
+class LazyFileEmitter(object):
+    """Opens the log file on the first entry rather than at import, so
+    importing the app (or anything that logs) doesn't touch the disk.
+    """
+    def __init__(self, filepath, encoding=None, **kwargs):
+        self.filepath = filepath
+        self.encoding = encoding
+        self.kwargs = kwargs
+        self._emitter = None
+        self._lock = threading.Lock()
+
+    def _get_emitter(self):
+        if self._emitter is None:
+            with self._lock:
+                if self._emitter is None:
+                    self._emitter = FixedFileEmitter(self.filepath,
+                                                     self.encoding,
+                                                     **self.kwargs)
+        return self._emitter
+
+    def __getattr__(self, name):
+        # only called for what isn't set above, i.e. the emitter's API
+        return getattr(self._get_emitter(), name)
+
 LOGFILE = 'server.log'  # TODO: where?
 
 tlog = Logger('toplog')
 
 file_fmt = SensibleFormatter('{status_char}{end_local_iso8601_noms_notz} - {duration_s\
 ecs}s - {record_name} - {message}')
-file_emt = FixedFileEmitter(LOGFILE)
+file_emt = LazyFileEmitter(LOGFILE)
 file_filter = SensibleFilter(success='debug',
                               failure='debug',
                               exception='debug')
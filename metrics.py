@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+Metrics
+~~~~~~~
+In-process counters and latency histograms for the DAL and the route
+handlers, rendered in the Prometheus text exposition format at
+/meta/metrics. Values are per-process; Prometheus sums across
+workers.
+'''
+import threading
+from bisect import bisect_left
+
+
+# Latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._help = {}
+        self._gauge_funcs = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+            hist.observe(value)
+
+    def add_gauges(self, func):
+        """Registers *func*, which returns ``{name: value}``, to be called
+        at render time, for values (pool size, cache entries) that are
+        tracked elsewhere.
+        """
+        self._gauge_funcs.append(func)
+
+    def render(self):
+        lines = []
+        seen = set()
+
+        def _header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self._help:
+                lines.append('# HELP %s %s' % (name, self._help[name]))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda kv: kv[0])
+            histograms = [(key, (list(h.counts), h.sum, h.count, h.buckets))
+                          for key, h in histograms]
+        for (name, labels), value in counters:
+            _header(name, 'counter')
+            lines.append('%s%s %s' % (name, _format_labels(labels), value))
+        for (name, labels), (counts, total, count, buckets) in histograms:
+            _header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                bucket_labels = labels + (('le', str(bound)),)
+                lines.append('%s_bucket%s %s' % (name, _format_labels(bucket_labels),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), total))
+            lines.append('%s_count%s %s' % (name, _format_labels(labels), count))
+        for func in self._gauge_funcs:
+            for name, value in sorted(func().items()):
+                _header(name, 'gauge')
+                lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf8', 'replace')
+    return (u'%s' % value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def count_bytes(rows):
+    "Approximate size of a result set: the length of its string values."
+    total = 0
+    for row in rows:
+        values = row.values() if isinstance(row, dict) else row
+        for value in values:
+            if isinstance(value, (bytes, type(u''))):
+                total += len(value)
+            else:
+                total += 8
+    return total
+
+
+Metrics = MetricsRegistry()
+Metrics.describe('ht_db_query_seconds', 'Time spent running DAL queries')
+Metrics.describe('ht_db_rows_total', 'Rows returned by DAL queries')
+Metrics.describe('ht_db_bytes_total', 'Approximate bytes fetched by DAL queries')
+Metrics.describe('ht_db_reconnects_total', 'Queries retried on a fresh connection')
+Metrics.describe('ht_replica_errors_total', 'Replica reads that failed and fell back to the database')
+Metrics.describe('ht_cache_requests_total', 'Result cache lookups and stores, by method and result')
+Metrics.describe('ht_route_seconds', 'Time spent handling requests, by route')
+Metrics.describe('ht_route_requests_total', 'Requests handled, by route and status')
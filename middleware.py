@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+'''
+HTTP middleware
+~~~~~~~~~~~~~~~
+Conditional requests and response compression.
+
+ConditionalMiddleware tags responses with a weak ETag (and a
+Last-Modified) derived from the newest revision relevant to the
+request, as reported by a *get_last_change* callback, and answers a
+matching ``If-None-Match`` or ``If-Modified-Since`` with a 304 before
+the route runs, so polling clients don't cost a round of DAL queries.
+
+The DAL's result caches can lag the newest revision by a couple of
+minutes, so a response generated right after a change may not show it
+yet. Until a URL's newest revision has been seen for SETTLE_SECONDS,
+its ETag also changes every minute (and no Last-Modified is sent), so
+that clients come back for the settled version.
+
+GzipMiddleware compresses HTML, CSV and JSON bodies for clients that
+accept it. Streamed responses (CSV downloads) are compressed as they're
+sent.
+'''
+import time
+import zlib
+import hashlib
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+from clastic import Middleware, Response
+
+
+SETTLE_SECONDS = 3 * 60
+MAX_TRACKED_URLS = 10000
+COMPRESSIBLE_TYPES = ('text/html', 'text/csv', 'application/json')
+MIN_GZIP_SIZE = 1024  # bytes, below which compression isn't worth it
+GZIP_LEVEL = 6
+_TS_FMT = '%Y%m%d%H%M%S'
+
+
+class ConditionalMiddleware(Middleware):
+    """*get_last_change* is called with the request and its route
+    pattern, for the routes in *patterns*, and returns the
+    ``(id, rc_timestamp)`` of the newest revision the response depends
+    on, or None.
+    """
+    def __init__(self, get_last_change, patterns,
+                 settle_seconds=SETTLE_SECONDS):
+        self.get_last_change = get_last_change
+        self.patterns = frozenset(patterns)
+        self.settle_seconds = settle_seconds
+        self._first_seen = OrderedDict()  # url -> (id, time first seen)
+        self._lock = threading.Lock()
+
+    def request(self, next, request, _route):
+        if (_route.pattern not in self.patterns
+                or request.method not in ('GET', 'HEAD')):
+            return next()
+        try:
+            change = self.get_last_change(request, _route.pattern)
+        except Exception:
+            # validators are only an optimization; the route can still
+            # answer (or degrade) without them
+            return next()
+        etag, last_modified = self._get_validators(request, change)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        elif request.if_modified_since and last_modified:
+            not_modified = last_modified <= request.if_modified_since
+        else:
+            not_modified = False
+        if not_modified:
+            resp = Response(status=304)
+        else:
+            resp = next()
+            if getattr(resp, 'status_code', 200) != 200:
+                return resp
+        resp.set_etag(etag, weak=True)
+        if last_modified:
+            resp.last_modified = last_modified
+        # always revalidate, rather than guess a freshness lifetime
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp
+
+    def _get_validators(self, request, change):
+        "Returns ``(etag, last_modified)``; last_modified may be None."
+        url = request.path + '?' + request.query_string
+        change_id, timestamp = change or (0, None)
+        now = time.time()
+        with self._lock:
+            seen = self._first_seen.pop(url, None)
+            if seen is None or seen[0] != change_id:
+                seen = (change_id, now)
+            self._first_seen[url] = seen
+            while len(self._first_seen) > MAX_TRACKED_URLS:
+                self._first_seen.popitem(last=False)
+        if now - seen[1] < self.settle_seconds:
+            parts = (url, change_id, int(now // 60))
+            last_modified = None
+        else:
+            parts = (url, change_id)
+            last_modified = _parse_timestamp(timestamp)
+        etag = hashlib.sha1(repr(parts).encode('utf8')).hexdigest()[:20]
+        return etag, last_modified
+
+
+def _parse_timestamp(timestamp):
+    try:
+        return datetime.strptime(timestamp, _TS_FMT)
+    except (TypeError, ValueError):
+        return None
+
+
+class GzipMiddleware(Middleware):
+    def __init__(self, min_size=MIN_GZIP_SIZE, level=GZIP_LEVEL):
+        self.min_size = min_size
+        self.level = level
+
+    def request(self, next, request):
+        resp = next()
+        status = getattr(resp, 'status_code', None)
+        if status == 304:
+            resp.vary.add('Accept-Encoding')
+            return resp
+        if status != 200 or resp.mimetype not in COMPRESSIBLE_TYPES:
+            return resp
+        resp.vary.add('Accept-Encoding')
+        if ('Content-Encoding' in resp.headers
+                or not request.accept_encodings['gzip']):
+            return resp
+        if resp.is_streamed:
+            resp.response = iter_gzip(resp.response, self.level)
+            resp.headers.pop('Content-Length', None)
+        else:
+            data = resp.get_data()
+            if len(data) < self.min_size:
+                return resp
+            resp.set_data(b''.join(iter_gzip([data], self.level)))
+        resp.headers['Content-Encoding'] = 'gzip'
+        return resp
+
+
+def iter_gzip(chunks, level=GZIP_LEVEL):
+    """Gzips an iterable of byte strings as it's consumed. It's closed
+    when done, as the WSGI server would have closed it.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
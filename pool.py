@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+'''
+Connection pool
+~~~~~~~~~~~~~~~
+A small, bounded, thread-safe pool of database connections. Callers
+borrow a connection for the duration of one query and give it back,
+so concurrent requests each get their own socket instead of queueing
+behind a single shared connection.
+
+Connections are health-checked (pinged) when they've been idle for a
+while, closed when they've been idle or alive too long, and checkouts
+wait at most ``timeout`` seconds for a free connection.
+
+Checkouts are LIFO, so surplus connections sink to the bottom of the
+idle stack where checkout never looks at them. Every PRUNE_INTERVAL
+seconds a checkin runs prune(), which closes the expired ones wherever
+they sit and tops the pool back up to ``min_size``.
+
+Nothing is opened until the first checkout, so creating a pool (and
+importing the app) never touches the network; forked workers each open
+their own connections once they're serving, and the first checkin
+fills the pool to ``min_size``.
+'''
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+DEFAULT_MIN_SIZE = 1
+DEFAULT_MAX_SIZE = 8
+DEFAULT_TIMEOUT = 10  # seconds to wait for a free connection
+DEFAULT_MAX_IDLE = 5 * 60  # close connections unused for this long
+DEFAULT_MAX_AGE = 60 * 60  # recycle connections older than this
+DEFAULT_PING_AFTER = 30  # ping connections idle for longer than this
+PRUNE_INTERVAL = 60  # seconds between prunes, run from checkin
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class _PooledConnection(object):
+    __slots__ = ('conn', 'created', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = self.last_used = time.time()
+
+
+class ConnectionPool(object):
+    def __init__(self,
+                 connect,
+                 min_size=DEFAULT_MIN_SIZE,
+                 max_size=DEFAULT_MAX_SIZE,
+                 timeout=DEFAULT_TIMEOUT,
+                 max_idle=DEFAULT_MAX_IDLE,
+                 max_age=DEFAULT_MAX_AGE,
+                 ping_after=DEFAULT_PING_AFTER):
+        if min_size > max_size:
+            raise ValueError('min_size must not exceed max_size')
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.ping_after = ping_after
+
+        self._idle = deque()
+        self._size = 0
+        self._waiting = 0
+        self._last_prune = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._count_lock = threading.Lock()
+        self._counts = {'created': 0,
+                        'closed': 0,
+                        'checkouts': 0,
+                        'timeouts': 0,
+                        'failed_checks': 0,
+                        'discarded': 0}
+
+    def fill(self):
+        "Opens connections until the pool holds at least min_size."
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                pooled = self._create()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append(pooled)
+                self._cond.notify()
+
+    def _incr(self, name):
+        with self._count_lock:
+            self._counts[name] += 1
+
+    def _create(self):
+        pooled = _PooledConnection(self._connect())
+        self._incr('created')
+        return pooled
+
+    def _close(self, pooled):
+        self._incr('closed')
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+
+    def _is_expired(self, pooled, now):
+        if self.max_idle and now - pooled.last_used > self.max_idle:
+            return True
+        if self.max_age and now - pooled.created > self.max_age:
+            return True
+        return False
+
+    def _is_healthy(self, pooled, now):
+        if not self.ping_after or now - pooled.last_used < self.ping_after:
+            return True
+        try:
+            pooled.conn.ping()
+        except Exception:
+            self._incr('failed_checks')
+            return False
+        return True
+
+    def checkout(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        while True:
+            pooled = None
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._incr('timeouts')
+                        raise PoolTimeout('no connection available after'
+                                          ' %s seconds' % timeout)
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                if self._idle:
+                    # LIFO, so that surplus connections go idle and expire
+                    pooled = self._idle.pop()
+                else:
+                    self._size += 1
+            if pooled is None:
+                try:
+                    pooled = self._create()
+                except Exception:
+                    self._release_slot()
+                    raise
+            else:
+                now = time.time()
+                if self._is_expired(pooled, now) \
+                        or not self._is_healthy(pooled, now):
+                    self._close(pooled)
+                    self._release_slot()
+                    continue
+            self._incr('checkouts')
+            return pooled
+
+    def checkin(self, pooled, discard=False):
+        if discard:
+            self._incr('discarded')
+            self._close(pooled)
+            self._release_slot()
+            return
+        now = pooled.last_used = time.time()
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+            due = now - self._last_prune > PRUNE_INTERVAL
+            if due:
+                self._last_prune = now
+        if due:
+            try:
+                self.prune()
+            except Exception:
+                pass  # couldn't reach min_size; the next prune retries
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Borrow a connection for the duration of the with-block. If the
+        block raises, the connection is closed rather than reused, since
+        its state can't be trusted.
+        """
+        pooled = self.checkout(timeout=timeout)
+        try:
+            yield pooled.conn
+        except Exception:
+            self.checkin(pooled, discard=True)
+            raise
+        else:
+            self.checkin(pooled)
+
+    def prune(self):
+        "Closes expired idle connections, then tops back up to min_size."
+        now = time.time()
+        with self._cond:
+            keep, expired = deque(), []
+            for pooled in self._idle:
+                if self._is_expired(pooled, now):
+                    expired.append(pooled)
+                else:
+                    keep.append(pooled)
+            self._idle = keep
+            self._size -= len(expired)
+        for pooled in expired:
+            self._close(pooled)
+        self.fill()
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+        for pooled in idle:
+            self._close(pooled)
+
+    def stats(self):
+        with self._count_lock:
+            ret = dict(self._counts)
+        with self._cond:
+            ret.update({'size': self._size,
+                        'idle': len(self._idle),
+                        'in_use': self._size - len(self._idle),
+                        'waiting': self._waiting,
+                        'min_size': self.min_size,
+                        'max_size': self.max_size})
+        return ret
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+Query builder
+~~~~~~~~~~~~~
+A small helper for assembling the DAL's SELECTs with their params, so
+that filters which don't apply are left out of the SQL entirely
+instead of being sent as wildcards (``LIKE '%'``, ``BETWEEN 0 AND
+...``) the optimizer can't prune:
+
+- a lang filter is an equality, and is omitted when there's no lang
+- date filters are compared as rc_timestamp strings (YYYYMMDDHHMMSS),
+  so MySQL can range-scan the rc_timestamp index rather than convert
+  every row to a DATETIME; the end date is exclusive, as format_dates
+  intends, and either end may be omitted
+- pages seek from the last row's key (seek_clause) rather than OFFSET,
+  so deep pages read no more rows than the first
+'''
+from datetime import datetime
+
+
+_TS_FMT = '%Y%m%d%H%M%S'
+
+
+def to_rc_timestamp(date):
+    "Normalizes a datetime (or falsy for none) to rc_timestamp's format."
+    if not date:
+        return None
+    if isinstance(date, datetime):
+        return date.strftime(_TS_FMT)
+    return str(date)
+
+
+def seek_clause(after=None, before=None):
+    """Keyset pagination predicate on ``(rc_timestamp, rc_id,
+    htrc_id)``. htrc_id is needed to make the key unique: a revision
+    has a row per hashtag, and rc_ids repeat across wikis. Keys from
+    old cursors may be missing it. Returns the SQL condition (None if
+    there's no key), its params and the sort direction. Rows seeking
+    *before* a key come back oldest first and need reversing.
+    """
+    key, op, order = (after, '<', 'DESC') if after else (before, '>', 'ASC')
+    if not key:
+        return None, (), 'DESC'
+    timestamp, rc_id = key[:2]
+    if len(key) > 2:
+        seek = ('(rc.rc_timestamp {op} ? '
+                'OR (rc.rc_timestamp = ? AND rc.rc_id {op} ?) '
+                'OR (rc.rc_timestamp = ? AND rc.rc_id = ? '
+                'AND rc.htrc_id {op} ?))').format(op=op)
+        params = (timestamp, timestamp, rc_id, timestamp, rc_id, key[2])
+    else:
+        seek = ('(rc.rc_timestamp {op} ? '
+                'OR (rc.rc_timestamp = ? AND rc.rc_id {op} ?))').format(op=op)
+        params = (timestamp, timestamp, rc_id)
+    return seek, params, order
+
+
+class Query(object):
+    def __init__(self, table, *params):
+        "*params* are any the table uses (e.g. as a subquery)."
+        self.table = table
+        self.table_params = list(params)
+        self.columns = []
+        self.joins = []
+        self.conditions = []
+        self.group = []
+        self.having_conditions = []
+        self.order = []
+        self.limit_count = None
+        self.select_params = []
+        self.join_params = []
+        self.where_params = []
+        self.having_params = []
+
+    def select(self, *columns, **kw):
+        "Adds columns, and any *params* they use (e.g. SUBSTR(x, 1, ?))."
+        self.columns.extend(columns)
+        self.select_params.extend(kw.get('params', ()))
+
+    def join(self, table, on, *params):
+        "Adds a join, and any *params* it uses (e.g. in a subquery)."
+        self.joins.append('JOIN %s\n        ON %s' % (table, on))
+        self.join_params.extend(params)
+
+    def where(self, condition, *params):
+        self.conditions.append(condition)
+        self.where_params.extend(params)
+
+    def where_lang(self, column, lang):
+        if lang and lang != '%':
+            self.where('%s = ?' % column, lang)
+
+    def where_dates(self, column, startdate=None, enddate=None):
+        start, end = to_rc_timestamp(startdate), to_rc_timestamp(enddate)
+        if start:
+            self.where('%s >= ?' % column, start)
+        if end:
+            self.where('%s < ?' % column, end)
+
+    def where_in(self, column, values):
+        self.where('%s IN (%s)' % (column, ', '.join(['?'] * len(values))),
+                   *values)
+
+    def group_by(self, *columns):
+        self.group.extend(columns)
+
+    def having(self, condition, *params):
+        self.having_conditions.append(condition)
+        self.having_params.extend(params)
+
+    def order_by(self, *columns):
+        self.order.extend(columns)
+
+    def limit(self, count):
+        self.limit_count = count
+
+    def build(self):
+        "Returns ``(sql, params)``."
+        parts = ['SELECT %s' % ',\n        '.join(self.columns),
+                 'FROM %s' % self.table]
+        parts.extend(self.joins)
+        if self.conditions:
+            parts.append('WHERE %s' % '\n        AND '.join(self.conditions))
+        if self.group:
+            parts.append('GROUP BY %s' % ', '.join(self.group))
+        if self.having_conditions:
+            parts.append('HAVING %s'
+                         % '\n        AND '.join(self.having_conditions))
+        if self.order:
+            parts.append('ORDER BY %s' % ', '.join(self.order))
+        params = (self.select_params + self.table_params + self.join_params
+                  + self.where_params + self.having_params)
+        if self.limit_count is not None:
+            parts.append('LIMIT ?')
+            params.append(self.limit_count)
+        return '\n        '.join(parts), tuple(params)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+'''
+Revision records
+~~~~~~~~~~~~~~~~
+Column profiles for the revision queries, and the compact row type
+they return. Each view selects only the columns it displays: the
+report needs about ten, the CSV export all of them. Rows come back as
+tuples, which are cheaper to fetch, cache and allocate than
+DictCursor's dicts, wrapped in a tuple subclass that can still be
+indexed by column name.
+'''
+
+
+# Columns of recentchanges (and the hashtag or mention) per view
+# rc.htrc_id is selected by every view, as the last part of the
+# pagination key: each hashtag of a revision has its own row, with the
+# same rc_timestamp and rc_id
+REPORT_COLUMNS = ('rc.htrc_lang', 'rc.rc_id', 'rc.htrc_id', 'rc.rc_timestamp',
+                  'rc.rc_user_text', 'rc.rc_title', 'rc.rc_comment',
+                  'rc.rc_this_oldid', 'rc.rc_last_oldid',
+                  'rc.rc_old_len', 'rc.rc_new_len')
+FULL_COLUMNS = REPORT_COLUMNS + ('rc.rc_cur_id', 'rc.rc_namespace',
+                                 'rc.rc_source', 'rc.rc_type',
+                                 'rc.rc_logid', 'rc.rc_log_action',
+                                 'rc.rc_log_type', 'rc.rc_minor',
+                                 'rc.rc_bot', 'rc.rc_patrolled',
+                                 'rc.rc_params', 'rc.rc_new',
+                                 'rc.rc_deleted', 'rc.rc_user')
+PROFILES = {'report': REPORT_COLUMNS, 'full': FULL_COLUMNS}
+DEFAULT_PROFILE = 'report'
+HASHTAG_COLUMNS = ('ht.ht_text', 'ht.ht_id')
+MENTION_COLUMNS = ('mn.mn_text', 'mn.mn_id')
+
+
+class Record(tuple):
+    """A result row. Supports ``row['rc_id']`` and ``row.get()`` like
+    the dicts it replaces, plus plain tuple indexing.
+    """
+    __slots__ = ()
+    fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        if index is None:
+            return default
+        return tuple.__getitem__(self, index)
+
+    def keys(self):
+        return list(self.fields)
+
+    def items(self):
+        return zip(self.fields, self)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % item for item in self.items()))
+
+
+_record_types = {}
+
+
+def get_columns(profile, extra=HASHTAG_COLUMNS):
+    "The select list for *profile*, as qualified column names."
+    return PROFILES[profile] + extra
+
+
+def get_record_type(columns):
+    """Returns the Record subclass for *columns* (qualified names, as
+    from get_columns), creating it on first use.
+    """
+    try:
+        return _record_types[columns]
+    except KeyError:
+        pass
+    fields = tuple(c.rsplit('.', 1)[-1] for c in columns)
+    attrs = {'__slots__': (),
+             'fields': fields,
+             '_index': dict((f, i) for i, f in enumerate(fields))}
+    ret = _record_types[columns] = type('Record', (Record,), attrs)
+    return ret
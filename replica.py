@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+'''
+Local replica
+~~~~~~~~~~~~~
+An optional SQLite mirror of the tables behind the search pages
+(recentchanges, hashtag_recentchanges, hashtags, valid_hashtags, the
+mention tables and the run logs), so reads don't cross the network to
+the shared database. Set ``HT_REPLICA_PATH`` to the file to keep it in.
+
+The mirror is synced incrementally in the background: revisions and
+hashtags by id watermark, the run logs by timestamp. Revisions are
+copied in ``htrc_id`` ranges with their hashtag_recentchanges and
+mention_recentchanges rows (whose mnrc_id is the revision's htrc_id)
+in the same transaction, so joins never see half a range. Revisions the
+source has pruned are pruned here too. The edit summaries of new
+revisions are indexed at the end of each sync (see textindex.py).
+
+The DAL only reads from the mirror for queries that ask for it, and
+only while the last completed sync is less than ``MAX_LAG`` seconds
+old; otherwise, and on any SQLite error, it reads from the source.
+
+Run this module directly to build or catch up the mirror, e.g. before
+the first start.
+'''
+import time
+import sqlite3
+import threading
+from datetime import datetime
+
+from log import tlog
+from records import FULL_COLUMNS
+from state import get_state
+from textindex import (SCHEMA as INDEX_SCHEMA, POSTINGS_TABLE,
+                       iter_postings)
+from validity import VALID_TABLE, RULES_NAME as VALID_RULES_NAME
+
+
+SYNC_INTERVAL = 30
+MAX_LAG = 5 * 60  # seconds since the last sync before reads fall back
+BATCH_SIZE = 20000
+REPLICA_ERRORS = (sqlite3.Error,)
+
+RC_COLUMNS = ('htrc_id',) + tuple(c.split('.', 1)[1] for c in FULL_COLUMNS
+                                  if c != 'rc.htrc_id')
+INT_COLUMNS = frozenset(['htrc_id', 'rc_id', 'rc_user', 'rc_namespace',
+                         'rc_minor', 'rc_bot', 'rc_new', 'rc_cur_id',
+                         'rc_this_oldid', 'rc_last_oldid', 'rc_type',
+                         'rc_patrolled', 'rc_old_len', 'rc_new_len',
+                         'rc_deleted', 'rc_logid'])
+HTRC_COLUMNS = ('htrc_id', 'ht_id', 'rc_id', 'htrc_lang')
+HASHTAG_COLUMNS = ('ht_id', 'ht_text')
+MNRC_COLUMNS = ('mnrc_id', 'mn_id', 'rc_id', 'mnrc_lang')
+MENTION_COLUMNS = ('mn_id', 'mn_text')
+START_LOG_COLUMNS = ('run_uuid', 'start_timestamp', 'lang', 'command')
+COMPLETE_LOG_COLUMNS = ('run_uuid', 'complete_timestamp', 'lang', 'output')
+_EPOCH = datetime(1970, 1, 1)
+
+CREATE_RC_QUERY = '''
+        CREATE TABLE IF NOT EXISTS recentchanges (
+          htrc_id INTEGER PRIMARY KEY,
+          %s
+        )''' % ',\n          '.join('%s %s' % (c, 'INTEGER' if c in INT_COLUMNS
+                                                 else 'TEXT')
+                                       for c in RC_COLUMNS[1:])
+
+SCHEMA = [CREATE_RC_QUERY,
+          'CREATE INDEX IF NOT EXISTS rc_timestamp '
+          'ON recentchanges (rc_timestamp, rc_id)',
+          'CREATE INDEX IF NOT EXISTS htrc_lang '
+          'ON recentchanges (htrc_lang, rc_timestamp)',
+          '''
+        CREATE TABLE IF NOT EXISTS hashtag_recentchanges (
+          htrc_id INTEGER PRIMARY KEY,
+          ht_id INTEGER NOT NULL,
+          rc_id INTEGER NOT NULL,
+          htrc_lang TEXT NOT NULL
+        )''',
+          'CREATE INDEX IF NOT EXISTS ht_id '
+          'ON hashtag_recentchanges (ht_id, htrc_id)',
+          '''
+        CREATE TABLE IF NOT EXISTS hashtags (
+          ht_id INTEGER PRIMARY KEY,
+          ht_text TEXT NOT NULL UNIQUE
+        )''',
+          '''
+        CREATE TABLE IF NOT EXISTS %s (
+          ht_id INTEGER PRIMARY KEY
+        )''' % VALID_TABLE,
+          '''
+        CREATE TABLE IF NOT EXISTS mention_recentchanges (
+          mnrc_id INTEGER PRIMARY KEY,
+          mn_id INTEGER NOT NULL,
+          rc_id INTEGER NOT NULL,
+          mnrc_lang TEXT NOT NULL
+        )''',
+          'CREATE INDEX IF NOT EXISTS mn_id '
+          'ON mention_recentchanges (mn_id, mnrc_id)',
+          '''
+        CREATE TABLE IF NOT EXISTS mentions (
+          mn_id INTEGER PRIMARY KEY,
+          mn_text TEXT NOT NULL UNIQUE
+        )''',
+          '''
+        CREATE TABLE IF NOT EXISTS start_log (
+          run_uuid TEXT PRIMARY KEY,
+          start_timestamp TIMESTAMP NOT NULL,
+          lang TEXT NOT NULL,
+          command TEXT NOT NULL
+        )''',
+          'CREATE INDEX IF NOT EXISTS start_timestamp '
+          'ON start_log (start_timestamp)',
+          '''
+        CREATE TABLE IF NOT EXISTS complete_log (
+          run_uuid TEXT PRIMARY KEY,
+          complete_timestamp TIMESTAMP NOT NULL,
+          lang TEXT NOT NULL,
+          output TEXT NOT NULL
+        )''',
+          'CREATE INDEX IF NOT EXISTS complete_timestamp '
+          'ON complete_log (complete_timestamp)',
+          'CREATE INDEX IF NOT EXISTS lang '
+          'ON complete_log (lang, complete_timestamp)',
+          '''
+        CREATE TABLE IF NOT EXISTS replica_state (
+          name TEXT PRIMARY KEY,
+          value
+        )'''] + INDEX_SCHEMA
+
+
+class Replica(object):
+    def __init__(self, db, path,
+                 sync_interval=SYNC_INTERVAL,
+                 max_lag=MAX_LAG,
+                 batch_size=BATCH_SIZE):
+        self.db = db
+        self.path = path
+        self.sync_interval = sync_interval
+        self.max_lag = max_lag
+        self.batch_size = batch_size
+        self.synced_at = None  # start of the last completed sync, by anyone
+        self.htrc_id = 0  # newest revision copied by then
+        self.remote_htrc_id = 0  # newest revision in the source then
+        self._local = threading.local()  # a connection per thread
+        self._last_check = 0
+        self._sync_lock = threading.Lock()
+
+    def is_fresh(self):
+        "Whether reads can go to the mirror. Syncs it if it's due."
+        self.maybe_sync()
+        return self._lag() is not None and self._lag() <= self.max_lag
+
+    def _lag(self):
+        if self.synced_at is None:
+            return None
+        return time.time() - self.synced_at
+
+    def stats(self):
+        lag = self._lag()
+        return {'enabled': 1,
+                'fresh': int(lag is not None and lag <= self.max_lag),
+                'lag_seconds': -1 if lag is None else round(lag, 1),
+                'htrc_id': self.htrc_id,
+                'remote_htrc_id': self.remote_htrc_id}
+
+    def execute(self, query, params, as_tuples=False):
+        "Runs a read query against the mirror; rows as in the DAL's execute."
+        cursor = self._connect().execute(query, params)
+        try:
+            rows = cursor.fetchall()
+            if as_tuples:
+                return rows
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in rows]
+        finally:
+            cursor.close()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path,
+                                         timeout=30,
+                                         detect_types=sqlite3.PARSE_DECLTYPES)
+            connection.text_factory = str  # bytestrings, like oursql's
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def maybe_sync(self):
+        "Syncs in the background if the last check is older than sync_interval."
+        if time.time() - self._last_check < self.sync_interval:
+            return
+        if not self._sync_lock.acquire(False):
+            return
+        self._last_check = time.time()
+
+        def _run():
+            try:
+                self.sync()
+            except Exception:
+                pass  # recorded by tlog; reads fall back once it's stale
+            finally:
+                self._sync_lock.release()
+
+        thread = threading.Thread(target=_run, name='replica-sync')
+        thread.daemon = True
+        thread.start()
+
+    def sync(self):
+        """Copies everything new from the source. Skipped if another
+        process sharing the file synced it within sync_interval.
+        """
+        with tlog.critical('sync_replica') as rec:
+            local = self._connect()
+            for statement in SCHEMA:
+                local.execute(statement)
+            local.commit()
+            self._load_state(local)
+            if (self._lag() is not None
+                    and self._lag() < self.sync_interval):
+                rec.success('Already synced')
+                return 0
+            started = time.time()
+            self.db.valid_hashtags.maybe_refresh()
+            with self.db.pool.connection() as remote:
+                cursor = remote.cursor()
+                try:
+                    cursor.execute('SELECT MIN(htrc_id), MAX(htrc_id) '
+                                   'FROM recentchanges', ())
+                    oldest, newest = cursor.fetchone()
+                    total = self._copy_hashtags(local, cursor)
+                    total += self._copy_mentions(local, cursor)
+                    total += self._copy_valid(local, cursor)
+                    total += self._copy_revisions(local, cursor, newest or 0)
+                    total += self._copy_log(local, cursor, 'start_log',
+                                            START_LOG_COLUMNS)
+                    total += self._copy_log(local, cursor, 'complete_log',
+                                            COMPLETE_LOG_COLUMNS)
+                finally:
+                    cursor.close()
+            self._index_comments(local)
+            self._prune(local, oldest)
+            htrc_id = local.execute('SELECT MAX(htrc_id) '
+                                    'FROM recentchanges').fetchone()[0]
+            self._set_state(local, synced_at=started,
+                            htrc_id=htrc_id or 0,
+                            remote_htrc_id=newest or 0)
+            local.commit()
+            self._load_state(local)
+            rec.success('Copied {count} rows', count=total)
+            return total
+
+    def _load_state(self, local):
+        state = dict(local.execute('SELECT name, value FROM replica_state'))
+        self.synced_at = state.get('synced_at')
+        self.htrc_id = state.get('htrc_id', 0)
+        self.remote_htrc_id = state.get('remote_htrc_id', 0)
+        return state
+
+    def _set_state(self, local, **values):
+        local.executemany('INSERT OR REPLACE INTO replica_state (name, value) '
+                          'VALUES (?, ?)', values.items())
+
+    def _copy_hashtags(self, local, cursor):
+        last = local.execute('SELECT MAX(ht_id) FROM hashtags').fetchone()[0]
+        return self._copy_ids(local, cursor, 'hashtags', HASHTAG_COLUMNS,
+                              last or 0)
+
+    def _copy_mentions(self, local, cursor):
+        """Copies new mentions. Replicas made before mentions were
+        mirrored also get the links of the revisions they already have.
+        """
+        last = local.execute('SELECT MAX(mn_id) FROM mentions').fetchone()[0]
+        total = self._copy_ids(local, cursor, 'mentions', MENTION_COLUMNS,
+                               last or 0)
+        if not self._load_state(local).get('mention_links_copied'):
+            total += self._copy_ids(local, cursor, 'mention_recentchanges',
+                                    MNRC_COLUMNS, 0)
+            self._set_state(local, mention_links_copied=1)
+            local.commit()
+        return total
+
+    def _copy_valid(self, local, cursor):
+        """Copies new valid ht_ids. When the remote finished a build for
+        other rules, the copy starts over in one transaction, so readers
+        keep the old copy until the new one is complete.
+        """
+        version = get_state(cursor, VALID_RULES_NAME)
+        if self._load_state(local).get('valid_rules_version') != version:
+            local.execute('DELETE FROM %s' % VALID_TABLE)
+            total = self._copy_ids(local, cursor, VALID_TABLE, ('ht_id',),
+                                   0, commit=False)
+            self._set_state(local, valid_rules_version=version)
+            local.commit()
+            return total
+        last = local.execute('SELECT MAX(ht_id) FROM %s'
+                             % VALID_TABLE).fetchone()[0]
+        return self._copy_ids(local, cursor, VALID_TABLE, ('ht_id',),
+                              last or 0)
+
+    def _copy_ids(self, local, cursor, table, columns, last, commit=True):
+        """Copies *table*'s rows past *last*, by its first (id) column,
+        committing each batch unless *commit* is false.
+        """
+        select = ('SELECT %s FROM %s WHERE %s > ? ORDER BY %s LIMIT ?'
+                  % (', '.join(columns), table, columns[0], columns[0]))
+        insert = ('INSERT OR IGNORE INTO %s (%s) VALUES (%s)'
+                  % (table, ', '.join(columns), ', '.join('?' * len(columns))))
+        total = 0
+        while True:
+            cursor.execute(select, (last, self.batch_size))
+            rows = cursor.fetchall()
+            if rows:
+                local.executemany(insert, rows)
+                if commit:
+                    local.commit()
+                last = rows[-1][0]
+            total += len(rows)
+            if len(rows) < self.batch_size:
+                return total
+
+    def _copy_revisions(self, local, cursor, until):
+        """Copies revisions up to *until*, with their hashtag_recentchanges
+        and mention_recentchanges rows.
+        """
+        last = local.execute('SELECT MAX(htrc_id) '
+                             'FROM recentchanges').fetchone()[0] or 0
+        select_rc = ('SELECT %s FROM recentchanges '
+                     'WHERE htrc_id > ? AND htrc_id <= ? '
+                     'ORDER BY htrc_id LIMIT ?' % ', '.join(RC_COLUMNS))
+        select_htrc = ('SELECT %s FROM hashtag_recentchanges '
+                       'WHERE htrc_id > ? AND htrc_id <= ?'
+                       % ', '.join(HTRC_COLUMNS))
+        select_mnrc = ('SELECT %s FROM mention_recentchanges '
+                       'WHERE mnrc_id > ? AND mnrc_id <= ?'
+                       % ', '.join(MNRC_COLUMNS))
+        insert_rc = ('INSERT OR IGNORE INTO recentchanges (%s) VALUES (%s)'
+                     % (', '.join(RC_COLUMNS), ', '.join('?' * len(RC_COLUMNS))))
+        insert_htrc = ('INSERT OR IGNORE INTO hashtag_recentchanges (%s) '
+                       'VALUES (%s)' % (', '.join(HTRC_COLUMNS),
+                                        ', '.join('?' * len(HTRC_COLUMNS))))
+        insert_mnrc = ('INSERT OR IGNORE INTO mention_recentchanges (%s) '
+                       'VALUES (%s)' % (', '.join(MNRC_COLUMNS),
+                                        ', '.join('?' * len(MNRC_COLUMNS))))
+        total = 0
+        while last < until:
+            cursor.execute(select_rc, (last, until, self.batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            end = rows[-1][0] if len(rows) == self.batch_size else until
+            cursor.execute(select_htrc, (last, end))
+            links = cursor.fetchall()
+            cursor.execute(select_mnrc, (last, end))
+            mention_links = cursor.fetchall()
+            local.executemany(insert_rc, rows)
+            local.executemany(insert_htrc, links)
+            local.executemany(insert_mnrc, mention_links)
+            local.commit()
+            total += len(rows) + len(links) + len(mention_links)
+            last = end
+        return total
+
+    def _copy_log(self, local, cursor, table, columns):
+        "Copies run log rows newer than the newest here, by (timestamp, uuid)."
+        uuid, ts = columns[:2]
+        newest = local.execute('SELECT %s, %s FROM %s ORDER BY %s DESC, %s DESC '
+                               'LIMIT 1' % (ts, uuid, table, ts, uuid)).fetchone()
+        last_ts, last_uuid = newest or (_EPOCH, '')
+        select = ('SELECT %s FROM %s WHERE %s > ? OR (%s = ? AND %s > ?) '
+                  'ORDER BY %s, %s LIMIT ?'
+                  % (', '.join(columns), table, ts, ts, uuid, ts, uuid))
+        insert = ('INSERT OR REPLACE INTO %s (%s) VALUES (%s)'
+                  % (table, ', '.join(columns), ', '.join('?' * len(columns))))
+        total = 0
+        while True:
+            cursor.execute(select, (last_ts, last_ts, last_uuid,
+                                    self.batch_size))
+            rows = cursor.fetchall()
+            if rows:
+                local.executemany(insert, rows)
+                local.commit()
+                last_uuid, last_ts = rows[-1][:2]
+            total += len(rows)
+            if len(rows) < self.batch_size:
+                return total
+
+    def _index_comments(self, local):
+        "Indexes the comments of the revisions copied since the last sync."
+        last = self._load_state(local).get('indexed_htrc_id', 0)
+        total = 0
+        while True:
+            rows = local.execute('SELECT htrc_id, rc_comment '
+                                 'FROM recentchanges WHERE htrc_id > ? '
+                                 'ORDER BY htrc_id LIMIT ?',
+                                 (last, self.batch_size)).fetchall()
+            if not rows:
+                return total
+            local.executemany('INSERT OR IGNORE INTO %s (term, htrc_id) '
+                              'VALUES (?, ?)' % POSTINGS_TABLE,
+                              iter_postings(rows))
+            last = rows[-1][0]
+            self._set_state(local, indexed_htrc_id=last)
+            local.commit()
+            total += len(rows)
+
+    def _prune(self, local, oldest):
+        "Drops the revisions the source no longer has."
+        if oldest is None:
+            return
+        local.execute('DELETE FROM recentchanges WHERE htrc_id < ?', (oldest,))
+        local.execute('DELETE FROM hashtag_recentchanges WHERE htrc_id < ?',
+                      (oldest,))
+        local.execute('DELETE FROM mention_recentchanges WHERE mnrc_id < ?',
+                      (oldest,))
+        local.execute('DELETE FROM %s WHERE htrc_id < ?' % POSTINGS_TABLE,
+                      (oldest,))
+        local.commit()
+
+
+if __name__ == '__main__':
+    from dal import HashtagDatabaseConnection
+    replica = HashtagDatabaseConnection().replica
+    if replica is None:
+        raise SystemExit('Set HT_REPLICA_PATH to the file to sync')
+    replica.sync()
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+'''
+Daily rollups
+~~~~~~~~~~~~~
+Per-(hashtag, lang, day) aggregates of the stats shown on report
+pages, so that stats for a date range cost O(days) instead of
+re-aggregating every revision in it.
+
+Each rollup row holds the revision count, bytes changed, oldest and
+newest timestamps, and HyperLogLog sketches of the distinct users and
+pages, which merge across days. Rows for ``ALL_TAGS_ID`` aggregate
+every valid hashtag, matching get_all_hashtag_stats.
+
+The rollups are built incrementally: each update consumes the
+recentchanges rows past the stored ``htrc_id`` watermark. Rows past
+the watermark that haven't been rolled up yet (the "tail") are folded
+in live when reading, as long as there aren't too many of them.
+
+Run this module directly to backfill or catch up, e.g. from cron.
+'''
+import time
+import threading
+from datetime import datetime, timedelta
+
+from common import RULES_VERSION, is_valid_hashtag
+from log import tlog
+from query import Query
+from sketches import HyperLogLog
+from state import ensure_state, get_state, set_state
+from validity import VALID_TABLE
+
+
+ROLLUP_TABLE = 'hashtag_daily_rollups'
+WATERMARK_NAME = 'rollup_htrc_id'
+RULES_NAME = 'rollup_rules_version'
+ALL_TAGS_ID = 0
+BATCH_SIZE = 20000
+MAX_TAIL = 5000  # most un-rolled-up rows we'll fold in on read
+REFRESH_INTERVAL = 60  # seconds between background updates
+OPEN_END_SLACK = timedelta(minutes=5)  # end dates this recent mean "now"
+MIN_DAY, MAX_DAY = '00000000', '99999999'
+_DAY_FMT = '%Y%m%d'
+
+CREATE_ROLLUP_QUERY = '''
+        CREATE TABLE IF NOT EXISTS %s (
+          ht_id INT UNSIGNED NOT NULL,
+          htrc_lang VARBINARY(32) NOT NULL,
+          day CHAR(8) NOT NULL,
+          revisions INT UNSIGNED NOT NULL,
+          bytes BIGINT UNSIGNED NOT NULL,
+          oldest VARBINARY(14) NOT NULL,
+          newest VARBINARY(14) NOT NULL,
+          users_sketch BLOB NOT NULL,
+          pages_sketch BLOB NOT NULL,
+          PRIMARY KEY (ht_id, day, htrc_lang)
+        )''' % ROLLUP_TABLE
+
+
+def day_span(startdate, enddate, now=None):
+    """Returns the ``(first_day, last_day)`` covered by a date filter, or
+    None if the filter doesn't line up with whole days. An end date within
+    OPEN_END_SLACK of *now* (format_dates' default) is open-ended.
+    """
+    now = now or datetime.now()
+    if not startdate:
+        first_day = MIN_DAY
+    elif _is_midnight(startdate):
+        first_day = startdate.strftime(_DAY_FMT)
+    else:
+        return None
+    if not enddate or enddate >= now - OPEN_END_SLACK:
+        last_day = MAX_DAY
+    elif _is_midnight(enddate):
+        # format_dates makes the end date exclusive by adding a day
+        last_day = (enddate - timedelta(days=1)).strftime(_DAY_FMT)
+    else:
+        return None
+    return first_day, last_day
+
+
+def _is_midnight(date):
+    if not isinstance(date, datetime):
+        return False
+    return (date.hour, date.minute, date.second, date.microsecond) == (0, 0, 0, 0)
+
+
+class DailyRollup(object):
+    __slots__ = ('revisions', 'bytes', 'oldest', 'newest', 'users', 'pages')
+
+    def __init__(self, revisions=0, bytes=0, oldest=None, newest=None,
+                 users=None, pages=None):
+        self.revisions = revisions
+        self.bytes = bytes
+        self.oldest = oldest
+        self.newest = newest
+        self.users = users if users is not None else HyperLogLog()
+        self.pages = pages if pages is not None else HyperLogLog()
+
+    def add(self, timestamp, user, title, nbytes):
+        self.revisions += 1
+        self.bytes += nbytes or 0
+        if self.oldest is None or timestamp < self.oldest:
+            self.oldest = timestamp
+        if self.newest is None or timestamp > self.newest:
+            self.newest = timestamp
+        self.users.add(user)
+        self.pages.add(title)
+
+    def merge(self, other):
+        self.revisions += other.revisions
+        self.bytes += other.bytes
+        if other.oldest is not None and (self.oldest is None
+                                         or other.oldest < self.oldest):
+            self.oldest = other.oldest
+        if other.newest is not None and (self.newest is None
+                                         or other.newest > self.newest):
+            self.newest = other.newest
+        self.users.merge(other.users)
+        self.pages.merge(other.pages)
+        return self
+
+    @classmethod
+    def from_row(cls, revisions, nbytes, oldest, newest, users, pages):
+        return cls(revisions=revisions,
+                   bytes=nbytes,
+                   oldest=oldest,
+                   newest=newest,
+                   users=HyperLogLog.from_bytes(users),
+                   pages=HyperLogLog.from_bytes(pages))
+
+    def to_row(self):
+        return (self.revisions, self.bytes, self.oldest, self.newest,
+                self.users.to_bytes(), self.pages.to_bytes())
+
+
+class RollupStore(object):
+    def __init__(self, db,
+                 batch_size=BATCH_SIZE,
+                 max_tail=MAX_TAIL,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_tail = max_tail
+        self.refresh_interval = refresh_interval
+        self._last_update = 0
+        self._update_lock = threading.Lock()
+        self._tables_ready = False
+
+    def ensure_tables(self, cursor):
+        if self._tables_ready:
+            return
+        cursor.execute(CREATE_ROLLUP_QUERY, ())
+        ensure_state(cursor, WATERMARK_NAME, RULES_NAME)
+        self._tables_ready = True
+
+    def update(self, max_batches=None):
+        """Rolls up batches of rows past the watermark until caught up (or
+        *max_batches* have been done). Returns the number of rows consumed.
+        Concurrent updaters are serialized by locking the watermark row.
+        """
+        total = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            with tlog.critical('update_rollups') as rec:
+                count = self._update_batch()
+                rec.success('Rolled up {count} revisions', count=count)
+            total += count
+            batches += 1
+            if count < self.batch_size:
+                break
+        self._last_update = time.time()
+        return total
+
+    def _update_batch(self):
+        with self.db.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                self.ensure_tables(cursor)
+                connection.commit()
+                cursor.execute('START TRANSACTION', ())
+                watermark = get_state(cursor, WATERMARK_NAME, for_update=True)
+                if get_state(cursor, RULES_NAME) != RULES_VERSION:
+                    # the all-tags rollups depend on the validity rules
+                    cursor.execute('DELETE FROM %s' % ROLLUP_TABLE, ())
+                    set_state(cursor, RULES_NAME, RULES_VERSION)
+                    watermark = 0
+                cursor.execute('''
+                SELECT rc.htrc_id,
+                       htrc.ht_id,
+                       rc.htrc_lang,
+                       rc.rc_type,
+                       rc.rc_timestamp,
+                       rc.rc_user,
+                       rc.rc_title,
+                       ABS(rc.rc_new_len - rc.rc_old_len),
+                       ht.ht_text
+                FROM recentchanges AS rc
+                JOIN hashtag_recentchanges AS htrc
+                ON htrc.htrc_id = rc.htrc_id
+                JOIN hashtags AS ht
+                ON ht.ht_id = htrc.ht_id
+                WHERE rc.htrc_id > ?
+                ORDER BY rc.htrc_id
+                LIMIT ?''',
+                               (watermark, self.batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    connection.rollback()
+                    return 0
+                batch = {}
+                valid_ids = {}
+                for (htrc_id, ht_id, lang, rc_type, timestamp,
+                     user, title, nbytes, ht_text) in rows:
+                    if ht_id not in valid_ids:
+                        valid_ids[ht_id] = is_valid_hashtag(ht_text)
+                    valid = valid_ids[ht_id]
+                    key = (ht_id, lang, timestamp[:8])
+                    batch.setdefault(key, DailyRollup()).add(
+                        timestamp, user, title, nbytes)
+                    if valid and rc_type == 0:
+                        key = (ALL_TAGS_ID, lang, timestamp[:8])
+                        batch.setdefault(key, DailyRollup()).add(
+                            timestamp, user, title, nbytes)
+                self._merge_existing(cursor, batch)
+                cursor.executemany('''
+                REPLACE INTO %s
+                (ht_id, htrc_lang, day, revisions, bytes,
+                 oldest, newest, users_sketch, pages_sketch)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''' % ROLLUP_TABLE,
+                                   [key + rollup.to_row()
+                                    for key, rollup in batch.items()])
+                set_state(cursor, WATERMARK_NAME, rows[-1][0])
+                connection.commit()
+                return len(rows)
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def _merge_existing(self, cursor, batch, chunk_size=500):
+        keys = list(batch.keys())
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            where = ', '.join(['(?, ?, ?)'] * len(chunk))
+            params = tuple(v for key in chunk for v in key)
+            cursor.execute('''
+            SELECT ht_id, htrc_lang, day, revisions, bytes,
+                   oldest, newest, users_sketch, pages_sketch
+            FROM %s
+            WHERE (ht_id, htrc_lang, day) IN (%s)
+            FOR UPDATE''' % (ROLLUP_TABLE, where), params)
+            for row in cursor.fetchall():
+                batch[tuple(row[:3])].merge(DailyRollup.from_row(*row[3:]))
+
+    def maybe_update(self):
+        """Kicks off a background update if the last one is older than
+        refresh_interval, so no request waits on rolling up.
+        """
+        if time.time() - self._last_update < self.refresh_interval:
+            return
+        if not self._update_lock.acquire(False):
+            return
+        self._last_update = time.time()
+
+        def _run():
+            try:
+                self.update()
+            except Exception:
+                pass  # recorded by tlog; the next interval retries
+            finally:
+                self._update_lock.release()
+
+        thread = threading.Thread(target=_run, name='rollup-update')
+        thread.daemon = True
+        thread.start()
+
+    def get_stats(self, tag=None, lang=None, startdate=None, enddate=None):
+        """Stats in the same shape as get_hashtag_stats, built from the
+        daily rollups plus the live tail. Returns None if the range
+        doesn't line up with whole days, the rollups are too far behind
+        or can't be read, or the replica is fresh, in which case the
+        caller should query directly (and the query reads the replica).
+        """
+        span = day_span(startdate, enddate)
+        if span is None:
+            return None
+        replica = self.db.replica
+        if replica is not None and replica.is_fresh():
+            return None
+        self.maybe_update()
+        try:
+            with tlog.critical('read_rollups') as rec:
+                ret = self._read_stats(span, tag, lang, startdate, enddate)
+                rec.success('Read rollups for {tag}', tag=tag)
+        except Exception:
+            return None  # recorded by tlog; the caller queries directly
+        return ret
+
+    def _read_stats(self, span, tag, lang, startdate, enddate):
+        first_day, last_day = span
+        if tag:
+            rollup_where = 'r.ht_id IN (SELECT ht_id FROM hashtags WHERE ht_text = ?)'
+            rollup_params = (tag,)
+            tail_where = 'ht.ht_text = ?'
+            tail_params = (tag,)
+        else:
+            rollup_where = 'r.ht_id = ?'
+            rollup_params = (ALL_TAGS_ID,)
+            tail_where = ('rc.rc_type = 0 AND htrc.ht_id IN '
+                          '(SELECT ht_id FROM %s)' % VALID_TABLE)
+            tail_params = ()
+        with self.db.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                self.ensure_tables(cursor)
+                connection.commit()
+                # a consistent snapshot, so rows rolled up between these
+                # reads aren't also counted in the tail
+                cursor.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT', ())
+                watermark = get_state(cursor, WATERMARK_NAME)
+                if watermark is None \
+                        or get_state(cursor, RULES_NAME) != RULES_VERSION:
+                    return None
+                cursor.execute('SELECT COUNT(*) FROM (SELECT 1 FROM recentchanges '
+                               'WHERE htrc_id > ? LIMIT ?) AS tail',
+                               (watermark, self.max_tail + 1))
+                if cursor.fetchone()[0] > self.max_tail:
+                    return None
+                query = Query('%s AS r' % ROLLUP_TABLE)
+                query.select('r.htrc_lang', 'r.revisions', 'r.bytes',
+                             'r.oldest', 'r.newest',
+                             'r.users_sketch', 'r.pages_sketch')
+                query.where(rollup_where, *rollup_params)
+                query.where_lang('r.htrc_lang', lang)
+                query.where('r.day BETWEEN ? AND ?', first_day, last_day)
+                cursor.execute(*query.build())
+                total = DailyRollup()
+                langs = set()
+                for row in cursor.fetchall():
+                    langs.add(row[0])
+                    total.merge(DailyRollup.from_row(*row[1:]))
+                query = Query('recentchanges AS rc')
+                query.select('rc.htrc_lang', 'rc.rc_timestamp', 'rc.rc_user',
+                             'rc.rc_title', 'ABS(rc.rc_new_len - rc.rc_old_len)')
+                query.join('hashtag_recentchanges AS htrc',
+                           'htrc.htrc_id = rc.htrc_id')
+                query.join('hashtags AS ht', 'ht.ht_id = htrc.ht_id')
+                query.where('rc.htrc_id > ?', watermark)
+                query.where(tail_where, *tail_params)
+                query.where_lang('rc.htrc_lang', lang)
+                query.where_dates('rc.rc_timestamp', startdate, enddate)
+                cursor.execute(*query.build())
+                for tail_lang, timestamp, user, title, nbytes in cursor.fetchall():
+                    langs.add(tail_lang)
+                    total.add(timestamp, user, title, nbytes)
+            finally:
+                connection.rollback()
+                cursor.close()
+        return [{'revisions': total.revisions,
+                 'users': total.users.count(),
+                 'pages': total.pages.count(),
+                 'langs': len(langs),
+                 'oldest': total.oldest,
+                 'newest': total.newest,
+                 'bytes': total.bytes}]
+
+
+if __name__ == '__main__':
+    from dal import HashtagDatabaseConnection
+    store = HashtagDatabaseConnection().rollups
+    store.update()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+'''
+Run logs
+~~~~~~~~
+Running per-language totals of the update runs behind /logs and
+/logs/<lang>. Rather than re-reading and re-parsing three days of
+``start_log``/``complete_log`` on every hit, the aggregator consumes
+only the runs completed since its ``complete_timestamp`` watermark,
+parsing each run's output once, and subtracts runs back out of the
+totals as they fall out of the window.
+'''
+import json
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+
+from log import tlog
+
+
+WINDOW_DAYS = 3
+REFRESH_INTERVAL = 60
+BATCH_SIZE = 5000
+SLOW_INTERVAL = 1800  # seconds between runs before it's flagged
+COUNTERS = ('changes_added', 'tags_added', 'mentions_added',
+            'total_tags', 'total_mentions', 'total_changes')
+_TIME_FMT = '%e %b %Y %H:%M:%S'
+
+RUNS_QUERY = '''
+        SELECT cl.run_uuid, cl.lang, cl.complete_timestamp, cl.output,
+               sl.start_timestamp, sl.command
+        FROM start_log AS sl
+        JOIN complete_log AS cl
+        ON sl.run_uuid = cl.run_uuid
+        WHERE %s
+        ORDER BY cl.complete_timestamp, cl.run_uuid
+        LIMIT ?'''
+
+
+class Run(object):
+    __slots__ = ('uuid', 'lang', 'complete_timestamp', 'start_time',
+                 'end_time', 'command', 'output', 'counts', 'time_diff')
+
+    def __init__(self, row):
+        self.uuid = row['run_uuid']
+        self.lang = row['lang']
+        self.complete_timestamp = row['complete_timestamp']
+        self.start_time = row['start_timestamp'].strftime(_TIME_FMT)
+        self.end_time = self.complete_timestamp.strftime(_TIME_FMT)
+        self.command = row['command']
+        self.output = row['output']
+        try:
+            output = json.loads(self.output)
+        except ValueError:
+            output = {}
+        if not isinstance(output, dict):
+            output = {}
+        self.counts = tuple(output.get(name) or 0 for name in COUNTERS)
+        self.time_diff = None  # seconds since the language's previous run
+
+    def to_dict(self):
+        return {'uuid': self.uuid,
+                'start_time': self.start_time,
+                'end_time': self.end_time,
+                'command': self.command,
+                'output': self.output}
+
+
+class LangRuns(object):
+    "One language's runs in the window, oldest first, and their totals."
+    def __init__(self, lang):
+        self.lang = lang
+        self.runs = deque()
+        self.totals = [0] * len(COUNTERS)
+
+    def add(self, run):
+        if self.runs:
+            previous = self.runs[-1].complete_timestamp
+            run.time_diff = (run.complete_timestamp - previous).total_seconds()
+        self.runs.append(run)
+        for i, count in enumerate(run.counts):
+            self.totals[i] += count
+
+    def expire(self, cutoff):
+        runs = self.runs
+        while runs and runs[0].complete_timestamp <= cutoff:
+            run = runs.popleft()
+            for i, count in enumerate(run.counts):
+                self.totals[i] -= count
+        if runs:
+            runs[0].time_diff = None  # its predecessor is out of the window
+
+    def summary(self):
+        results = dict(zip(COUNTERS, self.totals))
+        results['newest'] = self.runs[-1].end_time
+        return {'lang': self.lang,
+                'count': len(self.runs),
+                'slow': [{'time_diff': run.time_diff} for run in self.runs
+                         if (run.time_diff or 0) > SLOW_INTERVAL],
+                'results': results}
+
+
+class RunLogAggregator(object):
+    def __init__(self, db,
+                 window_days=WINDOW_DAYS,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.db = db
+        self.window_days = window_days
+        self.refresh_interval = refresh_interval
+        self.watermark = None  # newest complete_timestamp consumed
+        self._at_watermark = set()  # uuids completed at the watermark
+        self._langs = {}  # lang -> LangRuns
+        self._now = None  # the database's clock at the last refresh
+        self._last_refresh = 0
+        self._lock = threading.Lock()  # held while refreshing
+        self._state_lock = threading.Lock()  # held while reading or updating
+
+    def get_summaries(self):
+        "Per-language totals for /logs, by language."
+        self.maybe_refresh()
+        with self._state_lock:
+            ret = [lang_runs.summary() for lang_runs in self._langs.values()
+                   if lang_runs.runs]
+        ret.sort(key=lambda s: s['lang'])
+        return ret
+
+    def get_runs(self, lang, limit=None, days=None):
+        "A language's runs over the last *days* of the window, newest first."
+        self.maybe_refresh()
+        with self._state_lock:
+            lang_runs = self._langs.get(lang)
+            runs = list(lang_runs.runs) if lang_runs else []
+        if days is not None and runs:
+            cutoff = self._now - timedelta(days=days)
+            runs = [run for run in runs if run.complete_timestamp > cutoff]
+        runs = runs[::-1]
+        if limit is not None:
+            runs = runs[:limit]
+        return [run.to_dict() for run in runs]
+
+    def maybe_refresh(self):
+        """Refreshes if the last refresh is older than refresh_interval.
+        Only the first load blocks; after that, requests that arrive
+        mid-refresh use the current totals.
+        """
+        if time.time() - self._last_refresh < self.refresh_interval:
+            return
+        if not self._lock.acquire(self.watermark is None):
+            return
+        try:
+            if time.time() - self._last_refresh >= self.refresh_interval:
+                self._refresh()
+        finally:
+            self._lock.release()
+
+    def _refresh(self):
+        with tlog.critical('refresh_run_logs') as rec:
+            now = self.db.execute('SELECT NOW() AS now', ())[0]['now']
+            cutoff = now - timedelta(days=self.window_days)
+            self._now = now
+            total = 0
+            while True:
+                if self.watermark is None:
+                    rows = self.db.execute(
+                        RUNS_QUERY % 'cl.complete_timestamp > ?',
+                        (cutoff, BATCH_SIZE), replica=True)
+                else:
+                    rows = self.db.execute(
+                        RUNS_QUERY % 'cl.complete_timestamp >= ?',
+                        (self.watermark, BATCH_SIZE + len(self._at_watermark)),
+                        replica=True)
+                new = [Run(row) for row in rows
+                       if row['run_uuid'] not in self._at_watermark]
+                with self._state_lock:
+                    for run in new:
+                        self._add(run)
+                total += len(new)
+                if len(new) < BATCH_SIZE:
+                    break
+            with self._state_lock:
+                for lang_runs in self._langs.values():
+                    lang_runs.expire(cutoff)
+            self._last_refresh = time.time()
+            rec.success('Added {count} runs', count=total)
+
+    def _add(self, run):
+        lang_runs = self._langs.get(run.lang)
+        if lang_runs is None:
+            lang_runs = self._langs[run.lang] = LangRuns(run.lang)
+        lang_runs.add(run)
+        if run.complete_timestamp != self.watermark:
+            self.watermark = run.complete_timestamp
+            self._at_watermark = set()
+        self._at_watermark.add(run.uuid)
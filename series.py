@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''
+Activity series
+~~~~~~~~~~~~~~~
+Helpers for time-bucketed tag activity. Buckets are keyed by a prefix
+of rc_timestamp (YYYYMMDDHH for hours, YYYYMMDD for days), so the
+database can group on ``SUBSTR(rc_timestamp, 1, width)``. Weeks are folded
+from days here rather than in SQL.
+
+A bucket is "closed" once it ended more than SETTLE_TIME ago; closed
+buckets never change, so they can be cached indefinitely and only the
+open tail needs to be re-queried.
+'''
+from datetime import datetime, timedelta
+
+from query import to_rc_timestamp
+
+
+UNIT_WIDTHS = {'hour': 10, 'day': 8}
+UNITS = ('hour', 'day', 'week')
+DEFAULT_UNIT = 'day'
+SETTLE_TIME = timedelta(hours=1)  # allowance for late-arriving rows
+
+
+def first_open_bucket(unit, now=None):
+    "Key of the oldest bucket that may still receive rows."
+    now = now or datetime.now()
+    return to_rc_timestamp(now - SETTLE_TIME)[:UNIT_WIDTHS[unit]]
+
+
+def fold_weeks(day_buckets):
+    """Folds ``(YYYYMMDD, revisions, bytes)`` day buckets into weeks,
+    keyed by the YYYYMMDD of the week's Monday.
+    """
+    weeks = {}
+    for day, revisions, nbytes in day_buckets:
+        date = datetime.strptime(day, '%Y%m%d')
+        monday = (date - timedelta(days=date.weekday())).strftime('%Y%m%d')
+        old_revisions, old_bytes = weeks.get(monday, (0, 0))
+        weeks[monday] = (old_revisions + revisions, old_bytes + nbytes)
+    return [(week,) + weeks[week] for week in sorted(weeks)]
+
+
+def filter_buckets(buckets, startdate=None, enddate=None):
+    "Keeps the buckets overlapping [startdate, enddate)."
+    start = to_rc_timestamp(startdate)
+    end = to_rc_timestamp(enddate)
+    ret = []
+    for bucket in buckets:
+        key = bucket[0]
+        if start and key < start[:len(key)]:
+            continue
+        if end and key + '0' * (14 - len(key)) >= end:
+            continue
+        ret.append(bucket)
+    return ret
+
+
+def format_bucket(key):
+    key = key + '0' * (14 - len(key))
+    return '%s-%s-%sT%s:%s:%s' % (key[:4], key[4:6], key[6:8],
+                                  key[8:10], key[10:12], key[12:14])
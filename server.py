@@ -2,72 +2,97 @@
 import os
 import io
 import csv
-import json
+import time
+from urllib import quote_plus
 from datetime import datetime, timedelta
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
-from clastic import Application, render_json, render_basic, Middleware
+from clastic import Application, Response, render_json, render_basic, Middleware
 from clastic.meta import MetaApplication
 from clastic.render import AshesRenderFactory
 from clastic.static import StaticApplication
 
-from ashes import escape_html
-
 from log import tlog
 
-from boltons.strutils import find_hashtags
 from boltons.tbutils import ExceptionInfo
 
-from dal import HashtagDatabaseConnection 
+from dal import (HashtagDatabaseConnection, LEADERBOARD_GROUPS,
+                 LEADERBOARD_ORDERS, LEADERBOARD_LIMIT, DB_ERRORS,
+                 SearchUnavailable, is_mention)
+from metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from middleware import ConditionalMiddleware, GzipMiddleware
+from topk import MAX_WINDOW as MAX_TOP_WINDOW
 from common import PAGINATION, MAX_DB_ROW
-from utils import encode_vals, to_unicode
+from series import UNITS, DEFAULT_UNIT, format_bucket
+from suggest import DEFAULT_LIMIT as SUGGEST_LIMIT, MAX_LIMIT as MAX_SUGGEST_LIMIT
+from formatting import (format_revs, format_revs_batch, format_stats,
+                        format_leaderboard)
+from utils import encode_vals, decode_cursor, paginate
 
 
 TEMPLATES_PATH = 'templates'
 STATIC_PATH = 'static'
 _CUR_PATH = os.path.dirname(__file__)
-
-
+CSV_BLOCK_SIZE = 64 * 1024
+QUERY_WORKERS = 16
+# Stats and leaderboards can outlive the page that asked for them (see
+# generate_report), so they get their own, smaller executor: page
+# queries never queue behind them, and they hold at most this many
+# pooled connections
+BACKGROUND_WORKERS = 4
+QUERY_TIMEOUT = 30  # seconds
+STATS_TIMEOUT = 2  # seconds, before the report renders without stats
+RETRY_AFTER = 60  # seconds, for pages that couldn't load their results
+MAX_LEADERBOARD_LIMIT = 100
+RUN_LOG_DAYS = 3
+MAX_RUN_LOG_DAYS = 30
+MAX_RUN_LOG_LIMIT = 50000
+TAG_LIST_LIMIT = 100
+MAX_TAG_LIST_LIMIT = 1000
+MAX_CSV_LIMIT = 1000000  # rows; without a limit, a CSV has every row
+# Routes answered with 304 when nothing relevant has changed, see
+# middleware.py. The tagged ones only depend on their tag's revisions.
+TAGGED_ROUTES = ('/search/<tag>', '/search/<tag>/<cursor>', '/csv/<tag>')
+CONDITIONAL_ROUTES = TAGGED_ROUTES + ('/', '/docs', '/tags/<limit>',
+                                      '/search/', '/search/all',
+                                      '/search/all/<cursor>')
+
+
+# Creating these is cheap: nothing connects until the first query, and
+# no threads start until the first request (see pool.py)
 Database = HashtagDatabaseConnection()
+QueryExecutor = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+BackgroundExecutor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS)
 
 
-def format_timestamp(timestamp, inc_time=True):
-    _timestamp_pattern = '%Y%m%d%H%M%S'
-    timestamp = datetime.strptime(timestamp, _timestamp_pattern)
-    if inc_time:
-        ret = timestamp.strftime('%e %b %Y %H:%M:%S')
+def normalize_tag(tag):
+    """Encodes a tag from a URL for the DAL. Hashtags are stored
+    lowercased, but mentions are user names, which are case-sensitive
+    and stored with underscores for spaces.
+    """
+    if tag.startswith('@'):
+        tag = tag.replace(' ', '_')
     else:
-        ret = timestamp.strftime('%e %b %Y')
-    return ret
+        tag = tag.lower()
+    return tag.encode('utf8')
 
 
-def format_revs(rev):
-    url_str = 'https://{lang}.wikipedia.org/wiki/?diff={this}&oldid={last}'
-    user_url = 'https://{lang}.wikipedia.org/wiki/User:{user}'
-    if rev['htrc_lang'] == 'wikidata':
-        url_str = 'https://www.wikidata.org/wiki/?diff={this}&oldid={last}'
-        user_url = 'https://www.wikidata.org/wiki/User:{user}'
-    rev['rc_user_url'] = user_url.format(lang=rev['htrc_lang'],
-                                         user=rev['rc_user_text'])
-    rev['spaced_title'] = rev.get('rc_title', '').replace('_', ' ')
-    rev['diff_size'] = rev['rc_new_len'] - rev['rc_old_len']
-    rev['date'] = format_timestamp(rev['rc_timestamp'])
-    rev['diff_url'] = url_str.format(lang=rev['htrc_lang'],
-                                     this=rev['rc_this_oldid'],
-                                     last=rev['rc_last_oldid'])
+def to_int(value, default, minimum, maximum):
+    """*value* (e.g. a URL segment) as an integer clamped between
+    *minimum* and *maximum*, or *default* if it's not a number.
+    """
     try:
-        rev['rc_comment'] = escape_html(rev['rc_comment'])
-    except Exception as e:
-        pass
-    rev['rc_comment_plain'] = rev['rc_comment']
-    rev['rc_comment'] = to_unicode(rev['rc_comment'])
-    rev['tags'] = find_hashtags(rev['rc_comment'])
-    for tag in rev['tags']:
-        # TODO: Turn @mentions into links
-        link = '<a href="/hashtags/search/%s">#%s</a>' % (tag, tag)
-        new_comment = rev['rc_comment'].replace('#%s' % tag, link)
-        rev['rc_comment'] = new_comment
-    return rev
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(min(value, maximum), minimum)
+
+
+def get_int_arg(request, name, default, minimum, maximum):
+    """The integer query parameter *name*, clamped between *minimum*
+    and *maximum*, or *default* if it's missing or not a number.
+    """
+    return to_int(request.values.get(name), default, minimum, maximum)
 
 
 def format_dates(startdate_str, enddate_str):
@@ -82,43 +107,100 @@ def format_dates(startdate_str, enddate_str):
         # if enddate_str doesn't specify time, assume they mean the full day
         enddate = datetime.strptime(enddate_str, _date_fmt) + timedelta(days=1)
     else:
-        enddate = datetime.now()
+        # rounded up to the minute, so repeated searches share cache keys
+        now = datetime.now()
+        enddate = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
 
     return startdate, enddate
 
 
-def calculate_pages(offset, total, pagination):
-    # Check if there is a previous page
-    if offset == 0:
-        prev = -1
-    elif (offset - pagination) < 0:
-        prev = 0
-    else:
-        prev = offset - pagination
-    # Check if there is a next page
-    if (offset + pagination) >= total:
-        next = -1
-    else:
-        next = offset + pagination
-    return prev, next
+def get_pool_stats():
+    return Database.get_pool_stats()
+
+
+def get_cache_stats():
+    return Database.get_cache_stats()
+
+
+def get_replica_stats():
+    return Database.get_replica_stats()
+
+
+def _get_stat_gauges():
+    ret = {}
+    for prefix, stats in (('ht_pool_', Database.get_pool_stats()),
+                          ('ht_cache_', Database.get_cache_stats()),
+                          ('ht_replica_', Database.get_replica_stats())):
+        for name, value in stats.items():
+            ret[prefix + name] = value
+    return ret
+
 
+Metrics.add_gauges(_get_stat_gauges)
 
-def format_stats(stats):
-    stats['bytes'] = '{:,}'.format(int(stats['bytes']))
-    stats['revisions'] = '{:,}'.format(stats['revisions'])
-    stats['pages'] = '{:,}'.format(stats['pages'])
-    stats['users'] = '{:,}'.format(stats['users'])
-    stats['newest'] = format_timestamp(stats['newest'], inc_time=False)
-    stats['oldest'] = format_timestamp(stats['oldest'], inc_time=False)
-    return stats
 
+def get_metrics():
+    return Response(Metrics.render(), mimetype=METRICS_CONTENT_TYPE)
 
-def generate_tag_list(limit=100):
-    recent_count = limit * 10000
+
+class MetricsMiddleware(Middleware):
+    "Times each request, labeled by the route pattern it matched."
+    def request(self, next, _route):
+        route = _route.pattern
+        start = time.time()
+        try:
+            resp = next()
+        except Exception:
+            Metrics.inc('ht_route_requests_total', route=route, status='error')
+            raise
+        finally:
+            Metrics.observe('ht_route_seconds', time.time() - start, route=route)
+        status = getattr(resp, 'status_code', 200)
+        Metrics.inc('ht_route_requests_total', route=route, status=status)
+        return resp
+
+
+def get_last_change(request, route):
+    tag = None
+    if route in TAGGED_ROUTES:
+        tag = normalize_tag(request.path.split('/')[2])
+    return Database.get_last_change(tag)
+
+
+class DegradedMiddleware(Middleware):
+    """Sends pages rendered with an 'error' in their context as 503s,
+    so they're neither validated nor cached, and clients retry.
+    """
+    def render(self, next, context):
+        resp = next()
+        if isinstance(context, dict) and context.get('error'):
+            resp.status_code = 503
+            resp.headers['Retry-After'] = str(RETRY_AFTER)
+        return resp
+
+
+class WarmupMiddleware(Middleware):
+    """Starts loading the homepage on a worker's first request. Doing it
+    in create_app would connect before a forking server forks.
+    """
+    def request(self, next):
+        Database.warm_homepage()
+        return next()
+
+
+def generate_tag_list(limit=TAG_LIST_LIMIT):
+    limit = to_int(limit, TAG_LIST_LIMIT, 1, MAX_TAG_LIST_LIMIT)
+    recent_count = min(limit * 10000, MAX_TOP_WINDOW)
     tags = Database.get_top_hashtags(limit=limit, recent_count=recent_count)
     return tags
 
 
+def generate_suggestions(request):
+    prefix = request.values.get('q', '')
+    limit = get_int_arg(request, 'limit', SUGGEST_LIMIT, 1, MAX_SUGGEST_LIMIT)
+    return Database.get_suggestions(prefix, limit=limit)
+
+
 def home():
     with tlog.critical('home') as rec:
         top_tags = Database.get_top_hashtags()
@@ -134,73 +216,31 @@ def home():
 
 
 def generate_lang_run_log(request, lang):
-    days = request.values.get('days', 3)
-    limit = request.values.get('limit', 50000)
-    run_logs = Database.get_lang_run_log(lang=lang,
-                                         limit=limit,
-                                         days=days)
+    days = get_int_arg(request, 'days', RUN_LOG_DAYS, 1, MAX_RUN_LOG_DAYS)
+    limit = get_int_arg(request, 'limit', MAX_RUN_LOG_LIMIT,
+                        1, MAX_RUN_LOG_LIMIT)
+    logs = Database.get_recent_lang_runs(lang, limit=limit, days=days)
+    if logs is None:
+        # older than the aggregator keeps; read them from the tables
+        run_logs = Database.get_lang_run_log(lang=lang,
+                                             limit=limit,
+                                             days=days)
+        logs = [{'uuid': l['cl.run_uuid'],
+                 'end_time': l['cl.complete_timestamp'].strftime('%e %b %Y %H:%M:%S'),
+                 'start_time': l['sl.start_timestamp'].strftime('%e %b %Y %H:%M:%S'),
+                 'command': l['sl.command'],
+                 'output': l['cl.output']} for l in run_logs]
     return {'lang': lang,
             'days': days,
-            'logs': [{'uuid': l['cl.run_uuid'],
-                      'end_time': l['cl.complete_timestamp'].strftime('%e %b %Y %H:%M:%S'),
-                      'start_time': l['sl.start_timestamp'].strftime('%e %b %Y %H:%M:%S'),
-                      'command': l['sl.command'],
-                      'output': l['cl.output']} for l in run_logs]}
+            'logs': logs}
 
 
 def generate_run_log():
-
-    ret = {'logs': [], 'date': datetime.now().strftime('%e %b %Y %H:%M:%S')}
-    run_logs = Database.get_run_log()
-    sorted_logs = defaultdict(list)
-    for run_log in run_logs:
-        lang = run_log['cl.lang']
-        if len(sorted_logs[lang]) > 0:
-            prev_log = sorted_logs[lang][-1]
-            prev_date = prev_log['cl.complete_timestamp']
-            prev_log['time_diff'] = (prev_date - run_log['cl.complete_timestamp']).total_seconds()
-        try:
-            run_log['json_output'] = json.loads(run_log['cl.output'])
-        except ValueError as e:
-            run_log['json_output'] = {}
-        sorted_logs[lang].append(run_log)
-    for lang, run_logs in sorted_logs.items():
-        run_logs.sort(key=lambda l: l['cl.complete_timestamp'])
-        newest = run_logs[-1]['cl.complete_timestamp'].strftime('%e %b %Y %H:%M:%S')
-        results = {'changes_added': 0,
-                   'tags_added': 0,
-                   'mentions_added': 0,
-                   'total_tags': 0,
-                   'total_mentions': 0,
-                   'total_changes': 0,
-                   'newest': newest}
-
-        for run_log in run_logs:
-           results['changes_added'] += run_log['json_output'].get('changes_added')
-           results['tags_added'] += run_log['json_output'].get('tags_added')
-           results['mentions_added'] += run_log['json_output'].get('mentions_added')
-           results['total_tags'] += run_log['json_output'].get('total_tags')
-           results['total_mentions'] += run_log['json_output'].get('total_mentions')
-           results['total_changes'] += run_log['json_output'].get('total_changes')
-        ret['logs'].append({'lang': lang,
-                            'count': len(run_logs),
-                            'slow': [l for l in run_logs if l.get('time_diff', 0) > 1800],
-                            'results': results})
-    return ret
+    return {'logs': Database.get_run_log_summaries(),
+            'date': datetime.now().strftime('%e %b %Y %H:%M:%S')}
 
 
-def generate_csv(request, tag):
-    lang = request.values.get('lang')
-    limit = request.values.get('limit', 20000)
-    startdate_str = request.values.get('startdate')
-    enddate_str = request.values.get('enddate')
-    startdate, enddate = format_dates(startdate_str, enddate_str)
-
-    tag = tag.lower()
-    tag = tag.encode('utf8')
-    revs = Database.get_hashtags(tag, lang=lang, end=limit, startdate=startdate, enddate=enddate)
-    output = io.BytesIO()
-    fieldnames = ['htrc_lang', 'date', 'diff_url', 'rc_user_text',
+CSV_FIELDNAMES = ['htrc_lang', 'date', 'diff_url', 'rc_user_text',
                   'spaced_title', 'tags', 'rc_comment_plain', 'diff_size',
                   'rc_cur_id', 'rc_last_oldid', 'rc_old_len',
                   'rc_this_oldid', 'rc_new_len', 'rc_id',
@@ -209,6 +249,16 @@ def generate_csv(request, tag):
                   'rc_bot', 'rc_patrolled', 'rc_params', 'rc_new',
                   'rc_deleted', 'rc_user', 'rc_timestamp', 'ht_text',
                   'ht_id']
+
+
+MENTION_CSV_FIELDNAMES = CSV_FIELDNAMES[:-2] + ['mn_text', 'mn_id']
+
+
+def iter_csv(revs, fieldnames=CSV_FIELDNAMES):
+    """Formats and encodes *revs* one at a time, yielding CSV text in
+    small blocks so the response can be sent as it's produced.
+    """
+    output = io.BytesIO()
     writer = csv.DictWriter(output, fieldnames=fieldnames, extrasaction='ignore')
     output.write('\xEF\xBB\xBF')
     writer.writeheader()
@@ -216,19 +266,121 @@ def generate_csv(request, tag):
         # TODO: better organization
         formatted_rev = format_revs(rev)
         writer.writerow(encode_vals(formatted_rev))
-    ret = output.getvalue()
-    return ret
+        if output.tell() >= CSV_BLOCK_SIZE:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
+
+def generate_csv(request, tag):
+    lang = request.values.get('lang')
+    limit = get_int_arg(request, 'limit', None, 1, MAX_CSV_LIMIT)
+    startdate_str = request.values.get('startdate')
+    enddate_str = request.values.get('enddate')
+    text = request.values.get('q')
+    startdate, enddate = format_dates(startdate_str, enddate_str)
+    if text and not Database.can_search_comments():
+        resp = Response('Searching edit summaries is unavailable right now.'
+                        ' Try again later, or leave out the q parameter.',
+                        status=503, mimetype='text/plain')
+        resp.headers['Retry-After'] = str(RETRY_AFTER)
+        return resp
+
+    tag = normalize_tag(tag)
+    revs = Database.iter_hashtags(tag, lang=lang, limit=limit, startdate=startdate, enddate=enddate, text=text)
+    fieldnames = MENTION_CSV_FIELDNAMES if is_mention(tag) else CSV_FIELDNAMES
+    return Response(iter_csv(revs, fieldnames),
+                    mimetype='text/csv',
+                    direct_passthrough=True)
+
+
+def generate_series(request, tag):
+    lang = request.values.get('lang')
+    unit = request.values.get('bucket', DEFAULT_UNIT)
+    startdate_str = request.values.get('startdate')
+    enddate_str = request.values.get('enddate')
+    startdate, enddate = format_dates(startdate_str, enddate_str)
+    if unit not in UNITS:
+        unit = DEFAULT_UNIT
+
+    tag = normalize_tag(tag)
+    buckets = Database.get_hashtag_series(tag,
+                                          lang=lang,
+                                          unit=unit,
+                                          startdate=startdate,
+                                          enddate=enddate)
+    return {'tag': tag,
+            'lang': lang,
+            'bucket': unit,
+            'startdate': startdate_str,
+            'enddate': enddate_str,
+            'series': [{'start': format_bucket(key),
+                        'revisions': revisions,
+                        'bytes': nbytes}
+                       for key, revisions, nbytes in buckets]}
 
 
-def generate_report(request, tag=None, offset=0):
+def generate_stats(request, tag=None):
     lang = request.values.get('lang')
     startdate_str = request.values.get('startdate')
     enddate_str = request.values.get('enddate')
+    startdate, enddate = format_dates(startdate_str, enddate_str)
+    if tag:
+        tag = normalize_tag(tag)
+    stats = Database.get_hashtag_stats(tag, lang=lang, startdate=startdate, enddate=enddate)
+    if not stats or not stats[0]['revisions']:
+        return {}
+    return format_stats(stats[0])
+
+
+def get_leaderboards(tag, order='revisions', limit=LEADERBOARD_LIMIT,
+                     lang=None, startdate=None, enddate=None):
+    """Both of *tag*'s leaderboards, formatted, keyed by group. Pass no
+    *enddate* for "until now", rather than format_dates' rounded one,
+    so the cached leaderboards aren't keyed by the minute.
+    """
+    return dict((group, format_leaderboard(Database.get_leaderboard(
+        tag,
+        group=group,
+        order=order,
+        limit=limit,
+        lang=lang,
+        startdate=startdate,
+        enddate=enddate), default_lang=lang))
+                for group in sorted(LEADERBOARD_GROUPS))
+
+
+def generate_leaderboards(request, tag):
+    lang = request.values.get('lang')
+    order = request.values.get('by', 'revisions')
+    limit = get_int_arg(request, 'limit', LEADERBOARD_LIMIT,
+                        1, MAX_LEADERBOARD_LIMIT)
+    startdate_str = request.values.get('startdate')
+    enddate_str = request.values.get('enddate')
+    startdate, enddate = format_dates(startdate_str, enddate_str)
+    if order not in LEADERBOARD_ORDERS:
+        order = 'revisions'
+    tag = normalize_tag(tag)
+    return get_leaderboards(tag,
+                            order=order,
+                            limit=limit,
+                            lang=lang,
+                            startdate=startdate,
+                            enddate=enddate if enddate_str else None)
+
+
+def generate_report(request, tag=None, cursor=None):
+    lang = request.values.get('lang')
+    startdate_str = request.values.get('startdate')
+    enddate_str = request.values.get('enddate')
+    text = request.values.get('q')
 
     url_structure = ''
     url_parameters = {'lang': lang,
                       'startdate': startdate_str,
-                      'enddate': enddate_str}
+                      'enddate': enddate_str,
+                      'q': text}
 
     for param_name, param in url_parameters.items():
         if param:
@@ -237,7 +389,8 @@ def generate_report(request, tag=None, offset=0):
             else:
                 separator = '&'
             
-            url_structure += separator + param_name + '=' + param
+            url_structure += (separator + param_name + '='
+                              + quote_plus(param.encode('utf8')))
 
     startdate, enddate = format_dates(startdate_str, enddate_str)
     if startdate_str or enddate_str:
@@ -245,44 +398,116 @@ def generate_report(request, tag=None, offset=0):
     else:
         date_filtered = False
 
-    offset = int(offset)
+    key, direction, _ = decode_cursor(cursor)
+    seek = {direction: key}
     if tag:
-        tag = tag.encode('utf8')
-        tag = tag.lower()
-    revs = Database.get_hashtags(tag, lang=lang, start=offset, startdate=startdate, enddate=enddate)
-    langs = Database.get_langs()
+        tag = normalize_tag(tag)
+    # The queries are independent, so they run concurrently and the
+    # page waits for roughly the slowest one. If the stats or top users
+    # and pages take longer than STATS_TIMEOUT, the page renders
+    # without them and report.html loads them from /stats/ and /top/
+    # afterwards.
+    revs_future = QueryExecutor.submit(Database.get_hashtags,
+                                       tag,
+                                       lang=lang,
+                                       limit=PAGINATION + 1,
+                                       startdate=startdate,
+                                       enddate=enddate,
+                                       text=text,
+                                       **seek)
+    langs_future = QueryExecutor.submit(Database.get_langs)
+    stats_future = BackgroundExecutor.submit(Database.get_hashtag_stats,
+                                             tag,
+                                             lang=lang,
+                                             startdate=startdate,
+                                             enddate=enddate)
+    # Leaderboards over every tag would group the whole table, so the
+    # all-tags view doesn't have them
+    leaders_future = None
+    if tag:
+        leaders_future = BackgroundExecutor.submit(
+            get_leaderboards,
+            tag,
+            lang=lang,
+            startdate=startdate,
+            enddate=enddate if enddate_str else None)
+    search_unavailable = False
+    try:
+        revs = revs_future.result(timeout=QUERY_TIMEOUT)
+        error = False
+    except SearchUnavailable:
+        # comments are only searched with the replica's index
+        revs = []
+        error = search_unavailable = True
+    except (FutureTimeoutError,) + DB_ERRORS:
+        # rendered as a "try again" page rather than an error
+        revs = []
+        error = True
+    try:
+        langs = langs_future.result(timeout=QUERY_TIMEOUT)
+    except (FutureTimeoutError,) + DB_ERRORS:
+        langs = []
 
     # TODO: Get RevScore per rev
     # https://meta.wikimedia.org/wiki/Objective_Revision_Evaluation_Service
     if not revs:
+        stats_future.cancel()
+        if leaders_future:
+            leaders_future.cancel()
         return {'revisions': [],
+                'error': error,
+                'search_unavailable': search_unavailable,
                 'tag': tag,
+                'mention': is_mention(tag),
                 'stats': {},
+                'leaders': {},
                 'page': {},
                 'lang': lang,
                 'langs': [l['htrc_lang'] for l in langs],
                 'startdate': startdate_str,
                 'enddate': enddate_str,
+                'q': text,
                 'url_structure': url_structure,
                 'filtered_by_date': date_filtered}
-    stats = Database.get_hashtag_stats(tag, lang=lang, startdate=startdate, enddate=enddate)
-    stats = format_stats(stats[0])
-    ret = [format_revs(rev) for rev in revs]
-    prev, next = calculate_pages(offset, 
-                                 int(stats['revisions'].replace(',', '')),
-                                 PAGINATION)
-    page = {'start': offset + 1, 
-            'end': offset + len(revs),
+    # Late or failed stats and leaderboards are left to report.html to
+    # load; if they haven't started, they're cancelled, since that
+    # request will compute them anyway
+    deadline = time.time() + STATS_TIMEOUT
+    try:
+        stats = format_stats(stats_future.result(
+            timeout=max(deadline - time.time(), 0))[0])
+        stats_pending = False
+    except (FutureTimeoutError,) + DB_ERRORS:
+        stats_future.cancel()
+        stats = {}
+        stats_pending = True
+    leaders, leaders_pending = {}, False
+    try:
+        if leaders_future:
+            leaders = leaders_future.result(
+                timeout=max(deadline - time.time(), 0))
+    except (FutureTimeoutError,) + DB_ERRORS:
+        leaders_future.cancel()
+        leaders_pending = True
+    revs, position, prev, next = paginate(revs, cursor, PAGINATION)
+    ret = format_revs_batch(revs)
+    page = {'start': position + 1,
+            'end': position + len(revs),
             'prev': prev,
             'next': next}
     return {'revisions': ret, 
             'tag': tag, 
+            'mention': is_mention(tag),
             'stats': stats,
+            'stats_pending': stats_pending,
+            'leaders': leaders,
+            'leaders_pending': leaders_pending,
             'page': page,
             'lang': lang,
             'langs': [l['htrc_lang'] for l in langs],
             'startdate': startdate_str,
             'enddate': enddate_str,
+            'q': text,
             'url_structure': url_structure,
             'filtered_by_date': date_filtered}
 
@@ -291,22 +516,35 @@ def create_app():
     _template_dir = os.path.join(_CUR_PATH, TEMPLATES_PATH)
     _static_dir = os.path.join(_CUR_PATH, STATIC_PATH)
     templater = AshesRenderFactory(_template_dir)
-    # TODO: Add support for @mentions
     routes = [('/', home, 'index.html'),
               ('/docs', home, 'docs.html'),
               ('/tags/<limit>', generate_tag_list, render_basic),
+              ('/suggest', generate_suggestions, render_json),
               ('/search/', generate_report, 'report.html'),
               ('/search/all', generate_report, 'report.html'),
-              ('/search/all/<offset>', generate_report, 'report.html'),
+              ('/search/all/<cursor>', generate_report, 'report.html'),
               ('/search/<tag>', generate_report, 'report.html'),
               ('/csv/<tag>', generate_csv, render_basic),
-              ('/search/<tag>/<offset>', generate_report, 'report.html'),
+              ('/series/<tag>', generate_series, render_json),
+              ('/stats/all', generate_stats, render_json),
+              ('/stats/<tag>', generate_stats, render_json),
+              ('/top/<tag>', generate_leaderboards, render_json),
+              ('/search/<tag>/<cursor>', generate_report, 'report.html'),
               ('/logs', generate_run_log, 'logs.html'),
               ('/logs/<lang>', generate_lang_run_log, 'lang_logs.html'),
               ('/static', StaticApplication(_static_dir)),
+              ('/meta/pool', get_pool_stats, render_json),
+              ('/meta/cache', get_cache_stats, render_json),
+              ('/meta/replica', get_replica_stats, render_json),
+              ('/meta/metrics', get_metrics),
               ('/meta/', MetaApplication())]
     return Application(routes, 
-                       middlewares=[],
+                       middlewares=[MetricsMiddleware(),
+                                    WarmupMiddleware(),
+                                    GzipMiddleware(),
+                                    ConditionalMiddleware(get_last_change,
+                                                          CONDITIONAL_ROUTES),
+                                    DegradedMiddleware()],
                        render_factory=templater)
 
 class FakeReq(object):
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+'''
+Sketches
+~~~~~~~~
+Small, mergeable summaries for counting things we can't afford to
+recount from scratch.
+
+HyperLogLog estimates the number of distinct values it has seen
+(COUNT(DISTINCT ...)) in a few kilobytes, with a standard error of
+about 1.04 / sqrt(2 ** precision). Two sketches of the same precision
+merge losslessly by taking the register-wise max, so per-day sketches
+can be combined into a sketch for any range of days.
+'''
+import math
+import struct
+import hashlib
+
+
+HLL_PRECISION = 12  # 4096 registers, ~1.6% standard error
+_SPARSE, _DENSE = b'S', b'D'
+
+
+def hash64(value):
+    if not isinstance(value, (bytes, type(u''))):
+        value = str(value)
+    if not isinstance(value, bytes):
+        value = value.encode('utf8')
+    return struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+
+
+def _alpha(m):
+    if m == 16:
+        return 0.673
+    elif m == 32:
+        return 0.697
+    elif m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+class HyperLogLog(object):
+    __slots__ = ('p', 'm', 'registers')
+
+    def __init__(self, p=HLL_PRECISION, registers=None):
+        self.p = p
+        self.m = 1 << p
+        if registers is None:
+            registers = bytearray(self.m)
+        self.registers = registers
+
+    def add(self, value):
+        x = hash64(value)
+        idx = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        # rank: position of the leftmost 1-bit in the remaining bits
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError('cannot merge sketches of different precision')
+        regs = self.registers
+        for i, val in enumerate(other.registers):
+            if val > regs[i]:
+                regs[i] = val
+        return self
+
+    def count(self):
+        m = self.m
+        regs = self.registers
+        zeros = regs.count(b'\x00')
+        if zeros == m:
+            return 0
+        estimate = _alpha(m) * m * m / sum(2.0 ** -r for r in regs)
+        if estimate <= 2.5 * m and zeros:
+            # small range correction: linear counting
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+    def to_bytes(self):
+        """Sparse encoding (index/value pairs) for sketches with few set
+        registers, which is most per-day sketches; dense otherwise.
+        """
+        regs = self.registers
+        nonzero = [(i, v) for i, v in enumerate(regs) if v]
+        header = struct.pack('<B', self.p)
+        if len(nonzero) * 3 < self.m:
+            body = b''.join(struct.pack('<HB', i, v) for i, v in nonzero)
+            return _SPARSE + header + body
+        return _DENSE + header + bytes(regs)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data:
+            return cls()
+        data = bytes(data)
+        kind, p = data[:1], struct.unpack('<B', data[1:2])[0]
+        body = data[2:]
+        if kind == _DENSE:
+            return cls(p, bytearray(body))
+        ret = cls(p)
+        for offset in range(0, len(body), 3):
+            i, v = struct.unpack('<HB', body[offset:offset + 3])
+            ret.registers[i] = v
+        return ret
+
+
+class SpaceSaving(object):
+    """Approximate counts of the most frequent items in a stream, in
+    memory bounded by *capacity*. Counts are overestimates by at most
+    the item's recorded error, and any item more frequent than
+    ``total / capacity`` is guaranteed to be tracked.
+
+    Updates are applied in batches: after a batch, the summary is
+    pruned back to *capacity* and the largest evicted count becomes
+    the floor (the error) for items first seen afterwards.
+    """
+    __slots__ = ('capacity', 'counts', 'errors', 'floor', 'total')
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.floor = 0
+        self.total = 0
+
+    def update(self, items):
+        "Adds an iterable of ``(item, count)`` pairs."
+        counts, errors, floor = self.counts, self.errors, self.floor
+        for item, count in items:
+            self.total += count
+            if item in counts:
+                counts[item] += count
+            else:
+                counts[item] = floor + count
+                if floor:
+                    errors[item] = floor
+        if len(counts) > self.capacity:
+            self._prune()
+
+    def _prune(self):
+        ranked = sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)
+        evicted = ranked[self.capacity:]
+        self.floor = max(self.floor, evicted[0][1])
+        for item, _ in evicted:
+            del self.counts[item]
+            self.errors.pop(item, None)
+
+    def merge(self, other):
+        self.update(other.counts.items())
+        for item, error in other.errors.items():
+            if item in self.counts:
+                self.errors[item] = self.errors.get(item, 0) + error
+        return self
+
+    def top(self, n):
+        ranked = sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)
+        return ranked[:n]
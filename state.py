@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+'''
+Search state
+~~~~~~~~~~~~
+A tiny name/value table in the tool database for the watermarks and
+versions that the precomputed tables (rollups, valid hashtags) keep
+track of between runs.
+'''
+
+STATE_TABLE = 'search_state'
+
+CREATE_STATE_QUERY = '''
+        CREATE TABLE IF NOT EXISTS %s (
+          name VARBINARY(64) NOT NULL PRIMARY KEY,
+          value BIGINT UNSIGNED NOT NULL
+        )''' % STATE_TABLE
+
+
+def ensure_state(cursor, *names):
+    cursor.execute(CREATE_STATE_QUERY, ())
+    for name in names:
+        cursor.execute('INSERT IGNORE INTO %s (name, value) VALUES (?, 0)'
+                       % STATE_TABLE, (name,))
+
+
+def get_state(cursor, name, for_update=False):
+    query = 'SELECT value FROM %s WHERE name = ?' % STATE_TABLE
+    if for_update:
+        query += ' FOR UPDATE'
+    cursor.execute(query, (name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def set_state(cursor, name, value):
+    cursor.execute('UPDATE %s SET value = ? WHERE name = ?' % STATE_TABLE,
+                   (value, name))
@@ -4,7 +4,8 @@ $(function() {
         var query_string = "";
         var parameters = {'lang': $('#lang').val(),
                           'startdate': $('#startdate').val(),
-                          'enddate': $('#enddate').val()}
+                          'enddate': $('#enddate').val(),
+                          'q': $('#q').val()}
 
         for (var item in parameters) {
             if (parameters[item]) {
@@ -13,7 +14,7 @@ $(function() {
                 } else {
                     separator = "&"
                 }
-                var query_string = query_string + separator + item + "=" + parameters[item]
+                var query_string = query_string + separator + item + "=" + encodeURIComponent(parameters[item])
             }
         }
 
@@ -24,4 +25,63 @@ $(function() {
         window.location.href = '/hashtags/search/' + tag + query_string;
         e.preventDefault();
     });
+
+    // Suggest tags as the user types, skipping @mentions
+    var suggest_timer = null;
+    var last_prefix = null;
+    $('#search').on('input', function() {
+        var prefix = $(this).val();
+        if (prefix.indexOf('#') == 0) {
+            prefix = prefix.substring(1, prefix.length);
+        }
+        if (!prefix || prefix.indexOf('@') == 0 || prefix == last_prefix) {
+            return;
+        }
+        clearTimeout(suggest_timer);
+        suggest_timer = setTimeout(function() {
+            last_prefix = prefix;
+            $.getJSON('/hashtags/suggest', {'q': prefix}, function(tags) {
+                var list = $('#tag-suggestions').empty();
+                $.each(tags, function(i, tag) {
+                    $('<option>').attr('value', tag.ht_text).appendTo(list);
+                });
+            });
+        }, 150);
+    });
+
+    // Stats that took too long to render with the page are loaded here
+    var pending = $('#stats-pending');
+    if (pending.length) {
+        $.getJSON(pending.data('src'), function(stats) {
+            $('[data-stat]').each(function() {
+                var name = $(this).data('stat');
+                if (stats[name] !== undefined) {
+                    $(this).text(stats[name]);
+                }
+            });
+        });
+    }
+
+    // Likewise for the top users and pages
+    var leaders_pending = $('#leaders-pending');
+    if (leaders_pending.length) {
+        $.getJSON(leaders_pending.data('src'), function(leaders) {
+            $('[data-leaders]').each(function() {
+                var group = $(this).data('leaders');
+                var body = $(this).find('tbody').empty();
+                $.each(leaders[group] || [], function(i, row) {
+                    var name = $('<td>').append(
+                        $('<a>').attr('href', row.url).text(row.name));
+                    if (row.htrc_lang) {
+                        name.append(' ', $('<span class="lang">')
+                                    .text('(' + row.htrc_lang + ')'));
+                    }
+                    $('<tr>').append(name,
+                                     $('<td class="right-align">').text(row.revisions),
+                                     $('<td class="right-align">').text(row.bytes))
+                        .appendTo(body);
+                });
+            });
+        });
+    }
 });
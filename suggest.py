@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+'''
+Hashtag suggestions
+~~~~~~~~~~~~~~~~~~~
+An in-process prefix index over ``hashtags.ht_text`` for /suggest.
+Valid tags (see common.is_valid_hashtag) are kept in a sorted array of
+lowercased keys, so the tags starting with a prefix are one bisect
+away. A second, much smaller sorted array holds the tags the top
+hashtags tracker has seen recently, with their counts, so the
+suggestions people most likely mean come first.
+
+The index grows incrementally from ``ht_id``s past its watermark, and
+is refreshed in the background; lookups never wait on the database.
+'''
+import time
+import threading
+from bisect import bisect_left
+
+from log import tlog
+from topk import MAX_WINDOW
+
+
+BATCH_SIZE = 50000
+REFRESH_INTERVAL = 60
+HOT_SIZE = 2000  # recently used tags ranked first
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+_END = u'\U0010ffff'  # sorts after every key with a given prefix
+
+
+def _to_key(text):
+    if isinstance(text, bytes):
+        text = text.decode('utf8', 'replace')
+    return text.lower()
+
+
+class SuggestIndex(object):
+    def __init__(self, db,
+                 batch_size=BATCH_SIZE,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.db = db
+        self.batch_size = batch_size
+        self.refresh_interval = refresh_interval
+        self.watermark = 0  # ht_ids up to here are indexed
+        # (sorted lowercased texts, original texts), swapped as a whole
+        self._index = ([], [])
+        # (sorted keys of recently used tags, (key, text, count) for each)
+        self._hot = ([], [])
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+
+    def suggest(self, prefix, limit=DEFAULT_LIMIT):
+        """Up to *limit* ``{'ht_text', 'count'}`` dicts for the tags
+        starting with *prefix*: recently used ones first, by count,
+        then the rest alphabetically.
+        """
+        self.maybe_refresh()
+        prefix = _to_key(prefix).lstrip(u'#＃')
+        if not prefix:
+            return []
+        limit = min(limit, MAX_LIMIT)
+        hot_keys, hot = self._hot
+        start = bisect_left(hot_keys, prefix)
+        end = bisect_left(hot_keys, prefix + _END, start)
+        matches = sorted(hot[start:end], key=lambda h: -h[2])[:limit]
+        ret = [{'ht_text': text, 'count': count} for _, text, count in matches]
+        if len(ret) < limit:
+            seen = set(key for key, _, _ in matches)
+            keys, texts = self._index
+            index = bisect_left(keys, prefix)
+            while len(ret) < limit and index < len(keys):
+                key = keys[index]
+                if not key.startswith(prefix):
+                    break
+                if key not in seen:
+                    seen.add(key)
+                    ret.append({'ht_text': texts[index], 'count': 0})
+                index += 1
+        return ret
+
+    def maybe_refresh(self):
+        "Refreshes in the background if the last one is older than refresh_interval."
+        if time.time() - self._last_refresh < self.refresh_interval:
+            return
+        if not self._lock.acquire(False):
+            return
+        self._last_refresh = time.time()
+
+        def _run():
+            try:
+                self.refresh()
+            except Exception:
+                pass  # recorded by tlog; retried next interval
+            finally:
+                self._lock.release()
+
+        thread = threading.Thread(target=_run, name='suggest-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self):
+        with tlog.critical('refresh_suggest_index') as rec:
+            valid_ids = self.db.valid_hashtags
+            valid_ids.maybe_refresh()
+            new = []
+            watermark = self.watermark
+            while True:
+                rows = self.db.execute('''
+                SELECT ht_id, ht_text
+                FROM hashtags
+                WHERE ht_id > ?
+                ORDER BY ht_id
+                LIMIT ?''', (watermark, self.batch_size))
+                for row in rows:
+                    ht_id, ht_text = row['ht_id'], row['ht_text']
+                    if valid_ids.is_valid(ht_id, ht_text):
+                        text = ht_text.decode('utf8', 'replace')
+                        new.append((_to_key(text), text))
+                if rows:
+                    watermark = rows[-1]['ht_id']
+                if len(rows) < self.batch_size:
+                    break
+            if new:
+                self._add(new)
+            self.watermark = watermark
+            self._load_counts()
+            rec.success('Indexed {count} new hashtags', count=len(new))
+
+    def _add(self, new):
+        keys, texts = self._index
+        # both runs are already sorted, which the sort takes advantage of
+        merged = sorted(list(zip(keys, texts)) + sorted(new))
+        self._index = ([m[0] for m in merged], [m[1] for m in merged])
+
+    def _load_counts(self):
+        top = self.db.top_hashtags.top(limit=HOT_SIZE, recent_count=MAX_WINDOW)
+        if top is None:
+            return  # the tracker is still warming up
+        hot = []
+        for tag in top:
+            text = tag['ht_text']
+            if isinstance(text, bytes):
+                text = text.decode('utf8', 'replace')
+            hot.append((_to_key(text), text, tag['count']))
+        hot.sort()
+        self._hot = ([h[0] for h in hot], hot)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+'''
+Tag expressions
+~~~~~~~~~~~~~~~
+Boolean searches over several hashtags: ``a+b`` (tagged with both),
+``a|b`` (either) and ``a-b`` (a, but not b). ``+`` and ``-`` bind
+tighter than ``|``, so ``a+b|c-d`` means (a and b) or (c and not d).
+Hashtags are runs of word characters, so the operators can't appear
+in them.
+
+Revisions are identified by ``(htrc_lang, rc_id)``, since a revision
+with two tags has a recentchanges row (and htrc_id) for each. Pages
+are found by find_page, as ``(rc_timestamp, rc_id, htrc_id)`` keys.
+Each AND clause is streamed from its smallest tag, BATCH_SIZE rows at a
+time from the page cursor, and larger tags are only probed for the
+revisions in each batch, so a page never reads more than it needs of
+any tag. A revision's key uses the lowest htrc_id of its rows for the
+tags that matched it, so it's the same from every clause and page.
+
+Stats and leaderboards need every match, and are aggregated by the
+database over matching_query instead, which drives each clause from
+its smallest tag the same way.
+'''
+import re
+
+from common import PAGINATION
+from query import Query
+
+
+OPERATORS = '+|-'
+BATCH_SIZE = 500  # rows of a clause's smallest tag read per query
+_SPLIT_RE = re.compile(r'([+|-])')
+
+
+def is_tag_expression(tag):
+    return bool(tag) and any(op in tag for op in OPERATORS)
+
+
+def parse_tag_expression(text):
+    """Parses *text* into a tuple of OR'd clauses, each a pair of
+    ``(tags, excluded_tags)`` tuples. Raises ValueError if an operator
+    is missing a tag, or a clause only excludes.
+    """
+    clauses = []
+    tags, excluded = [], []
+    parts = _SPLIT_RE.split(text)
+    ops = ['+'] + parts[1::2]
+    for op, tag in zip(ops, parts[::2]):
+        tag = tag.strip().lstrip('#')
+        if not tag:
+            raise ValueError('missing hashtag in %r' % text)
+        if op == '|':
+            clauses.append((tags, excluded))
+            tags, excluded = [], []
+        if op == '-':
+            excluded.append(tag)
+        else:
+            tags.append(tag)
+    clauses.append((tags, excluded))
+    for tags, excluded in clauses:
+        if not tags:
+            raise ValueError('nothing to exclude from in %r' % text)
+    return tuple((tuple(t), tuple(e)) for t, e in clauses)
+
+
+def get_tag_names(clauses):
+    ret = []
+    for tags, excluded in clauses:
+        for tag in tags + excluded:
+            if tag not in ret:
+                ret.append(tag)
+    return ret
+
+
+def find_page(db, clauses, lang=None, startdate=None, enddate=None,
+              after=None, before=None, limit=PAGINATION, keep=None):
+    """The keys of the *limit* revisions matching *clauses* that come
+    right after (are older than) *after*, right before *before*, or
+    else the newest, sorted newest first. *after* and *before* may be
+    ``(rc_timestamp, rc_id)`` pairs from old cursors. *keep*, if given,
+    takes a list of htrc_ids and returns the set of those to keep.
+    """
+    if not limit:
+        return []
+    cursor, newer = (before, True) if before else (after, False)
+    cursor = tuple(cursor) if cursor else None
+    names = get_tag_names(clauses)
+    ids = _get_tag_ids(db, names)
+    sizes = _get_tag_sizes(db, list(ids.values()))
+    filters = (lang, startdate, enddate)
+    matched = {}  # (htrc_lang, rc_id) -> (rc_timestamp, rc_id, htrc_id)
+    for tags, excluded in clauses:
+        if any(tag not in ids for tag in tags):
+            continue  # an unknown tag matches nothing
+        tags = sorted(tags, key=lambda t: sizes.get(ids[t], 0))
+        found = _match_clause(db, [ids[tag] for tag in tags],
+                              [ids[tag] for tag in excluded if tag in ids],
+                              filters, cursor, newer, limit, keep)
+        for rev, key in found.items():
+            if rev not in matched or key < matched[rev]:
+                matched[rev] = key
+    keys = [key for key in matched.values()
+            if cursor is None or _is_past(key, cursor, newer)]
+    keys.sort(reverse=not newer)
+    return sorted(keys[:limit], reverse=True)
+
+
+def _is_past(key, cursor, newer):
+    "Whether *key* comes after *cursor* in page order."
+    key = tuple(key[:len(cursor)])
+    return key > cursor if newer else key < cursor
+
+
+def _match_clause(db, tags, excluded, filters, cursor, newer, limit, keep):
+    """The revisions tagged with all of *tags* (ht_ids, smallest first)
+    and none of *excluded*, as a dict of their keys, read from *cursor*
+    in page order until *limit* of them are past the cursor's
+    ``(rc_timestamp, rc_id)``. Every revision sharing that of the last
+    one is included too, since their htrc_ids decide where they fall.
+    """
+    ret = {}
+    seek, inclusive = cursor, True
+    while True:
+        rows = _get_batch(db, tags[0], filters, seek, inclusive, newer)
+        batch = dict(_to_item(row) for row in rows)
+        for ht_id in tags[1:]:
+            found = _probe(db, ht_id, filters, batch)
+            batch = dict((rev, min(key, found[rev]))
+                         for rev, key in batch.items() if rev in found)
+        for ht_id in excluded:
+            found = _probe(db, ht_id, filters, batch)
+            batch = dict((rev, key) for rev, key in batch.items()
+                         if rev not in found)
+        if keep is not None and batch:
+            kept = keep([key[2] for key in batch.values()])
+            batch = dict((rev, key) for rev, key in batch.items()
+                         if key[2] in kept)
+        ret.update(batch)
+        if len(rows) < BATCH_SIZE:
+            return ret
+        last = rows[-1]
+        seek = (last['rc_timestamp'], last['rc_id'], last['htrc_id'])
+        inclusive = False
+        pairs = sorted(set(key[:2] for key in ret.values()
+                           if cursor is None
+                           or _is_past(key[:2], cursor[:2], newer)),
+                       reverse=not newer)
+        if len(pairs) >= limit and seek[:2] != pairs[limit - 1]:
+            return ret
+
+
+def _to_item(row):
+    return ((row['htrc_lang'], row['rc_id']),
+            (row['rc_timestamp'], row['rc_id'], row['htrc_id']))
+
+
+def _get_batch(db, ht_id, filters, seek, inclusive, newer):
+    """The next BATCH_SIZE rows of *ht_id* in page order past *seek*, a
+    key, or with *inclusive*, from its ``(rc_timestamp, rc_id)`` on.
+    """
+    query = _keys_query(ht_id, filters)
+    op, order = ('>', 'ASC') if newer else ('<', 'DESC')
+    if seek and inclusive:
+        query.where('(rc.rc_timestamp {op} ? OR (rc.rc_timestamp = ? '
+                    'AND rc.rc_id {op}= ?))'.format(op=op),
+                    seek[0], seek[0], seek[1])
+    elif seek:
+        query.where('(rc.rc_timestamp {op} ? OR (rc.rc_timestamp = ? '
+                    'AND (rc.rc_id {op} ? OR (rc.rc_id = ? '
+                    'AND rc.htrc_id {op} ?))))'.format(op=op),
+                    seek[0], seek[0], seek[1], seek[1], seek[2])
+    query.order_by('rc.rc_timestamp %s' % order, 'rc.rc_id %s' % order,
+                   'rc.htrc_id %s' % order)
+    query.limit(BATCH_SIZE)
+    return db.execute(*query.build(), replica=True)
+
+
+def _probe(db, ht_id, filters, batch):
+    "The keys of the revisions in *batch* that are tagged *ht_id*."
+    if not batch:
+        return {}
+    query = _keys_query(ht_id, filters)
+    query.where_in('rc.rc_id', sorted(set(rc_id for _, rc_id in batch)))
+    return dict(_to_item(row)
+                for row in db.execute(*query.build(), replica=True))
+
+
+def matching_query(db, clauses, lang=None, startdate=None, enddate=None):
+    """A query.Query for one htrc_id (as ``htrc_id``) of each revision
+    matching *clauses*, for aggregating over every match in the
+    database. Like paging, each clause is driven from its smallest tag,
+    and only the revisions of that tag are probed for the others (see
+    _PROBE), so a huge tag in a clause with a small one is never
+    scanned.
+    """
+    ids = _get_tag_ids(db, get_tag_names(clauses))
+    sizes = _get_tag_sizes(db, list(ids.values()))
+    parts, params = [], []
+    for tags, excluded in clauses:
+        if any(tag not in ids for tag in tags):
+            continue  # an unknown tag matches nothing
+        tags = sorted(tags, key=lambda t: sizes.get(ids[t], 0))
+        query = Query('recentchanges AS rc')
+        query.select('rc.htrc_id', 'rc.htrc_lang', 'rc.rc_id')
+        query.join('hashtag_recentchanges AS htrc',
+                   'htrc.htrc_id = rc.htrc_id')
+        query.where('htrc.ht_id = ?', ids[tags[0]])
+        query.where_lang('rc.htrc_lang', lang)
+        query.where_dates('rc.rc_timestamp', startdate, enddate)
+        for tag in tags[1:]:
+            query.where('EXISTS (%s)' % _PROBE, ids[tag])
+        for tag in excluded:
+            if tag in ids:
+                query.where('NOT EXISTS (%s)' % _PROBE, ids[tag])
+        sql, clause_params = query.build()
+        parts.append(sql)
+        params.extend(clause_params)
+    if not parts:
+        query = Query('recentchanges AS rc')
+        query.select('rc.htrc_id')
+        query.where('1 = 0')
+        return query
+    # a revision matching several clauses is only counted once
+    query = Query('(%s) AS m' % '\n        UNION ALL\n        '.join(parts),
+                  *params)
+    query.select('MIN(m.htrc_id) AS htrc_id')
+    query.group_by('m.htrc_lang', 'm.rc_id')
+    return query
+
+
+# Whether the revision of the row ``rc`` is also tagged with a ht_id.
+# Its rows are found by the rc_timestamp index, since they share it.
+_PROBE = """SELECT 1
+            FROM recentchanges AS probe_rc
+            JOIN hashtag_recentchanges AS probe
+            ON probe.htrc_id = probe_rc.htrc_id
+            WHERE probe_rc.rc_timestamp = rc.rc_timestamp
+            AND probe_rc.rc_id = rc.rc_id
+            AND probe_rc.htrc_lang = rc.htrc_lang
+            AND probe.ht_id = ?"""
+
+
+def _get_tag_ids(db, names):
+    if not names:
+        return {}
+    rows = db.execute('SELECT ht_id, ht_text FROM hashtags WHERE ht_text IN (%s)'
+                      % ', '.join(['?'] * len(names)), tuple(names),
+                      replica=True)
+    return dict((row['ht_text'], row['ht_id']) for row in rows)
+
+
+def _get_tag_sizes(db, ht_ids):
+    if not ht_ids:
+        return {}
+    rows = db.execute('''
+    SELECT ht_id, COUNT(*) AS count
+    FROM hashtag_recentchanges
+    WHERE ht_id IN (%s)
+    GROUP BY ht_id''' % ', '.join(['?'] * len(ht_ids)), tuple(ht_ids),
+                      cache_name='get_tag_sizes', replica=True)
+    return dict((row['ht_id'], row['count']) for row in rows)
+
+
+def _keys_query(ht_id, filters):
+    lang, startdate, enddate = filters
+    query = Query('recentchanges AS rc')
+    query.select('rc.htrc_lang', 'rc.rc_id', 'rc.rc_timestamp', 'rc.htrc_id')
+    query.join('hashtag_recentchanges AS htrc', 'htrc.htrc_id = rc.htrc_id')
+    query.where('htrc.ht_id = ?', ht_id)
+    query.where_lang('rc.htrc_lang', lang)
+    query.where_dates('rc.rc_timestamp', startdate, enddate)
+    return query
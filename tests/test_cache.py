@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+from cache import LRUCache, TieredCache, make_key
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return TieredCache(str(tmp_path / 'cache'))
+
+
+def test_lru_evicts_least_recently_used():
+    lru = LRUCache(max_entries=2, max_bytes=1000)
+    lru.set('a', 1, 60, 1)
+    lru.set('b', 2, 60, 1)
+    assert lru.get('a') == 1  # now b is the oldest
+    lru.set('c', 3, 60, 1)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1 and lru.get('c') == 3
+    assert lru.evictions == 1 and len(lru) == 2
+
+
+def test_lru_evicts_by_size():
+    lru = LRUCache(max_entries=10, max_bytes=10)
+    lru.set('a', 1, 60, 4)
+    lru.set('b', 2, 60, 4)
+    lru.set('c', 3, 60, 4)
+    assert lru.get('a') is None
+    assert lru.size_bytes == 8
+    lru.set('huge', 4, 60, 11)  # bigger than the whole cache
+    assert lru.get('huge') is None and lru.get('b') == 2
+
+
+def test_lru_expiry():
+    lru = LRUCache()
+    lru.set('a', 1, -1, 5)
+    assert lru.get('a', 'missing') == 'missing'
+    assert lru.size_bytes == 0
+
+
+def test_get_and_set(cache):
+    key = make_key('get_hashtags', u'caf\xe9', None)
+    assert cache.get(key) == (False, None)
+    rows = [{'ht_text': u'caf\xe9', 'when': datetime(2016, 1, 1)}]
+    cache.set(key, rows)
+    assert cache.get(key) == (True, rows)
+    assert cache.stats()['memory_hits'] == 1
+
+
+def test_results_are_copied(cache):
+    cache.set('k', [{'a': 1}])
+    cache.get('k')[1][0]['a'] = 2
+    assert cache.get('k') == (True, [{'a': 1}])
+
+
+def test_falls_back_to_files(cache, tmp_path):
+    rows = [(1, u'☺', None), (2, u'x', (3, 4))]
+    cache.set('k', rows)
+    cache.memory.clear()
+    assert cache.get('k') == (True, rows)
+    assert cache.stats()['file_hits'] == 1
+    # and was promoted back into memory
+    assert cache.get('k') == (True, rows)
+    assert cache.stats()['memory_hits'] == 1
+
+    # another process sharing the directory sees it too
+    other = TieredCache(str(tmp_path / 'cache'))
+    assert other.get('k') == (True, rows)
+
+
+def test_other_codec_versions_are_misses(cache):
+    cache.set('k', [1, 2])
+    cache.memory.clear()
+    path = cache.files._path('k')
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(b'\xff\xff' + data[2:])
+    assert cache.get('k') == (False, None)
+    assert not os.path.exists(path)
+
+
+def test_empty_results_expire_sooner(tmp_path):
+    cache = TieredCache(str(tmp_path / 'cache'), negative_timeout=-1)
+    cache.set('empty', [], timeout=60)
+    cache.set('full', [1], timeout=60)
+    assert cache.get('empty') == (False, None)
+    assert cache.get('full') == (True, [1])
+
+
+def test_get_or_compute_caches(cache):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return [u'caf\xe9']
+
+    assert cache.get_or_compute('k', compute) == [u'caf\xe9']
+    assert cache.get_or_compute('k', compute) == [u'caf\xe9']
+    assert len(calls) == 1
+
+
+def test_get_or_compute_doesnt_store_failures(cache):
+    def fail():
+        raise RuntimeError('database is down')
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute('k', fail)
+    assert cache.get('k') == (False, None)
+    assert cache.stats()['sets'] == 0
+    assert cache.get_or_compute('k', lambda: [1]) == [1]
+
+
+def test_get_or_compute_serves_stale(cache):
+    cache.set('k', [1], timeout=-1, stale_timeout=60)
+    refreshed = []
+
+    def compute():
+        refreshed.append(1)
+        return [2]
+
+    assert cache.get_or_compute('k', compute, timeout=60,
+                                stale_timeout=60) == [1]
+    for i in range(100):
+        if cache.get('k') == (True, [2]):
+            break
+        time.sleep(0.01)
+    assert cache.get('k') == (True, [2]) and refreshed == [1]
+
+
+def test_file_tier_is_pruned(tmp_path):
+    cache = TieredCache(str(tmp_path / 'cache'), max_file_bytes=2000)
+    for i in range(20):
+        cache.set('k%d' % i, [os.urandom(200)])
+    cache.files.prune()
+    assert cache.files.size_bytes <= 2000
+    assert cache.files.evictions > 0
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pytest
+
+from codec import encode, decode
+
+
+def round_trip(value):
+    payload, size = encode(value)
+    assert size > 0
+    return decode(payload)
+
+
+@pytest.mark.parametrize('value', [
+    None,
+    [],
+    {},
+    0,
+    u'caf\xe9',
+    b'raw bytes',
+    datetime(2016, 1, 2, 3, 4, 5),
+    {'revisions': 10, 'oldest': datetime(2016, 1, 1), 'newest': None},
+    [1, 2, 3],
+    [(1, (2, (3, None))), (4, (5, (6, u'☺')))],
+    [{'a': 1}, {'b': 2}],  # different keys
+    [{'a': 1}, (1,)],  # mixed rows
+    [(1, 2), (3,)],  # ragged tuples
+])
+def test_round_trip(value):
+    assert round_trip(value) == value
+
+
+def test_rows_of_dicts():
+    rows = [{'htrc_id': i,
+             'htrc_lang': [b'en', b'de'][i % 2],
+             'ht_text': u'рус' if i % 3 else u'caf\xe9',
+             'rc_timestamp': b'2016010100%04d' % i,
+             'rc_comment': None if i % 5 == 0 else u'edit %d ☺' % i,
+             'when': datetime(2016, 1, 1, 0, 0, i % 60)}
+            for i in range(300)]
+    assert round_trip(rows) == rows
+
+
+def test_rows_of_tuples():
+    rows = [(i, u'tag\xe9', (i, None), None) for i in range(50)]
+    assert round_trip(rows) == rows
+
+
+def test_interned_columns_shrink():
+    rows = [{'htrc_lang': b'en', 'ht_text': b'edit-a-thon'}
+            for i in range(1000)]
+    payload, size = encode(rows)
+    assert decode(payload) == rows
+    assert len(payload) < 1000
+
+
+def test_many_distinct_interned_values():
+    # more than 256 distinct values need wider indexes
+    values = [u'tag%d' % (i % 700) for i in range(2000)]
+    rows = [{'ht_text': value} for value in values]
+    assert round_trip(rows) == rows
+
+
+def test_mixed_type_columns_stay_plain():
+    rows = [{'value': value} for value in (1, u'one', b'one', None, 1.5) * 4]
+    assert round_trip(rows) == rows
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import base64
+import sqlite3
+
+import pytest
+
+from query import Query, seek_clause
+from utils import encode_cursor, decode_cursor, paginate
+
+
+def test_cursor_round_trip():
+    key = ('20160102030405', 12, 345)
+    for direction in ('after', 'before'):
+        cursor = encode_cursor(key, direction, 50)
+        assert decode_cursor(cursor) == (key, direction, 50)
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor(('20160102030405', 2 ** 31, 2 ** 40), 'after', 7)
+    assert all(c.isalnum() or c in '-_' for c in cursor)
+
+
+def test_old_two_part_cursor():
+    payload = b'["after",["20160102030405",12],25]'
+    cursor = base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+    assert decode_cursor(cursor) == (('20160102030405', 12), 'after', 25)
+
+
+@pytest.mark.parametrize('payload', [
+    b'not json',
+    b'["sideways",["20160102030405",12,3],0]',
+    b'["after",["20160102030405"],0]',
+    b'["after",["20160102030405",1,2,3],0]',
+    b'["after",["20160102030405","x",3],0]',
+    b'["after",null,0]',
+    b'["after",["20160102030405",12,3]]',
+    b'{"after":1}',
+    b'\xff\xfe',
+])
+def test_invalid_cursors_are_the_first_page(payload):
+    cursor = base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+    assert decode_cursor(cursor) == (None, 'after', 0)
+
+
+@pytest.mark.parametrize('cursor', [None, '', '!!!', 'a', 'a' * 5])
+def test_missing_or_garbled_cursors(cursor):
+    assert decode_cursor(cursor) == (None, 'after', 0)
+
+
+def test_tampered_cursor():
+    cursor = encode_cursor(('20160102030405', 12, 345), 'after', 50)
+    assert decode_cursor(cursor[:-3] + '***') == (None, 'after', 0)
+
+
+def test_seek_clause_without_a_key():
+    assert seek_clause() == (None, (), 'DESC')
+    assert seek_clause(after=None, before=None) == (None, (), 'DESC')
+
+
+def test_seek_clause_directions():
+    key = ('20160102030405', 12, 345)
+    seek, params, order = seek_clause(after=key)
+    assert order == 'DESC' and '<' in seek and '>' not in seek
+    assert params == ('20160102030405', '20160102030405', 12,
+                      '20160102030405', 12, 345)
+    seek, params, order = seek_clause(before=key)
+    assert order == 'ASC' and '>' in seek and '<' not in seek
+
+
+def test_seek_clause_old_key():
+    seek, params, order = seek_clause(after=('20160102030405', 12))
+    assert 'htrc_id' not in seek
+    assert params == ('20160102030405', '20160102030405', 12)
+
+
+def make_rows():
+    "Rows tied on rc_timestamp, and on rc_id across wikis and tags."
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE recentchanges (htrc_id INTEGER PRIMARY KEY, '
+                 'rc_id INTEGER, rc_timestamp TEXT)')
+    htrc_id = 0
+    for rc_id, timestamp, tags in [(1, '20160101000000', 1),
+                                   (2, '20160101000001', 3),
+                                   (1, '20160101000001', 2),  # another wiki
+                                   (3, '20160101000001', 1),
+                                   (4, '20160101000002', 2),
+                                   (2, '20160101000002', 1),
+                                   (5, '20160101000003', 1)]:
+        for i in range(tags):
+            htrc_id += 1
+            conn.execute('INSERT INTO recentchanges VALUES (?, ?, ?)',
+                         (htrc_id, rc_id, timestamp))
+    return conn
+
+
+def fetch(conn, after=None, before=None, limit=2):
+    seek, params, order = seek_clause(after, before)
+    query = Query('recentchanges AS rc')
+    query.select('rc.rc_timestamp', 'rc.rc_id', 'rc.htrc_id')
+    if seek:
+        query.where(seek, *params)
+    query.order_by('rc.rc_timestamp %s' % order, 'rc.rc_id %s' % order,
+                   'rc.htrc_id %s' % order)
+    query.limit(limit)
+    rows = conn.execute(*query.build()).fetchall()
+    return rows[::-1] if before else rows
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 5])
+def test_seek_pages_through_ties(limit):
+    conn = make_rows()
+    everything = conn.execute('SELECT rc_timestamp, rc_id, htrc_id '
+                              'FROM recentchanges ORDER BY 1 DESC, 2 DESC, '
+                              '3 DESC').fetchall()
+    pages, after = [], None
+    while True:
+        page = fetch(conn, after=after, limit=limit)
+        if not page:
+            break
+        pages.append(page)
+        after = page[-1]
+    assert [row for page in pages for row in page] == everything
+
+    # and back again, from the last page
+    before = pages[-1][0]
+    for page in reversed(pages[:-1]):
+        assert fetch(conn, before=before, limit=len(page)) == page
+        before = page[0]
+
+
+def revs(*htrc_ids):
+    return [{'rc_timestamp': '2016010100000%d' % i, 'rc_id': i,
+             'htrc_id': i} for i in htrc_ids]
+
+
+def test_paginate_first_page():
+    page, position, prev, next = paginate(revs(9, 8, 7), None, 2)
+    assert [r['htrc_id'] for r in page] == [9, 8]
+    assert position == 0 and prev is None
+    assert decode_cursor(next) == (('20160101000008', 8, 8), 'after', 2)
+
+
+def test_paginate_last_page():
+    cursor = encode_cursor(('20160101000008', 8, 8), 'after', 2)
+    page, position, prev, next = paginate(revs(7), cursor, 2)
+    assert [r['htrc_id'] for r in page] == [7]
+    assert position == 2 and next is None
+    assert decode_cursor(prev) == (('20160101000007', 7, 7), 'before', 2)
+
+
+def test_paginate_back_to_the_first_page():
+    cursor = encode_cursor(('20160101000007', 7, 7), 'before', 2)
+    page, position, prev, next = paginate(revs(9, 8), cursor, 2)
+    assert position == 0 and prev is None
+    assert decode_cursor(next) == (('20160101000008', 8, 8), 'after', 2)
+
+
+def test_paginate_back_with_more_before():
+    cursor = encode_cursor(('20160101000005', 5, 5), 'before', 4)
+    page, position, prev, next = paginate(revs(8, 7, 6), cursor, 2)
+    assert [r['htrc_id'] for r in page] == [7, 6]
+    assert position == 2
+    assert decode_cursor(prev) == (('20160101000007', 7, 7), 'before', 2)
+    assert decode_cursor(next) == (('20160101000006', 6, 6), 'after', 4)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import math
+import random
+
+import pytest
+
+from sketches import HLL_PRECISION, HyperLogLog, SpaceSaving
+
+
+STANDARD_ERROR = 1.04 / math.sqrt(2 ** HLL_PRECISION)
+
+
+def user_names(count, seed=0):
+    rng = random.Random(seed)
+    return [u'User %d' % rng.getrandbits(48) for i in range(count)]
+
+
+@pytest.mark.parametrize('count', [10, 1000, 20000, 100000])
+def test_hll_accuracy(count):
+    names = user_names(count)
+    sketch = HyperLogLog()
+    sketch.update(names)
+    sketch.update(names[:count // 2])  # repeats don't count
+    actual = len(set(names))
+    error = abs(sketch.count() - actual) / float(actual)
+    assert error < 4 * STANDARD_ERROR
+
+
+def test_hll_empty():
+    assert HyperLogLog().count() == 0
+
+
+def test_hll_merge_is_the_union():
+    names = user_names(30000, seed=1)
+    first, second, both = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    first.update(names[:20000])
+    second.update(names[10000:])
+    both.update(names)
+    assert first.merge(second).registers == both.registers
+
+
+def test_hll_merge_needs_the_same_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(10).merge(HyperLogLog(12))
+
+
+@pytest.mark.parametrize('count', [0, 5, 50000])
+def test_hll_bytes_round_trip(count):
+    sketch = HyperLogLog()
+    sketch.update(user_names(count, seed=2))
+    copy = HyperLogLog.from_bytes(sketch.to_bytes())
+    assert copy.registers == sketch.registers
+    assert copy.count() == sketch.count()
+
+
+def test_space_saving_keeps_the_heavy_hitters():
+    rng = random.Random(3)
+    counts = {u'heavy%d' % i: 1000 - i * 100 for i in range(5)}
+    items = [tag for tag, n in counts.items() for i in range(n)]
+    items += [u'rare%d' % rng.randint(0, 5000) for i in range(3000)]
+    rng.shuffle(items)
+    sketch = SpaceSaving(capacity=100)
+    for i in range(0, len(items), 500):
+        sketch.update((item, 1) for item in items[i:i + 500])
+    top = [row[0] for row in sketch.top(5)]
+    assert top == sorted(counts, key=counts.get, reverse=True)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import pytest
+
+import tagexpr
+from query import Query
+from tagexpr import (parse_tag_expression, is_tag_expression, find_page,
+                     matching_query)
+
+
+TAGS = {1: 'big', 2: 'small', 3: 'other'}
+
+
+class FakeDatabase(object):
+    "Just enough of the DAL for tagexpr, over an in-memory SQLite."
+    def __init__(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.executescript('''
+        CREATE TABLE recentchanges (htrc_id INTEGER PRIMARY KEY,
+                                    htrc_lang TEXT, rc_id INTEGER,
+                                    rc_timestamp TEXT);
+        CREATE TABLE hashtag_recentchanges (htrc_id INTEGER PRIMARY KEY,
+                                            ht_id INTEGER, rc_id INTEGER,
+                                            htrc_lang TEXT);
+        CREATE TABLE hashtags (ht_id INTEGER PRIMARY KEY, ht_text TEXT);
+        ''')
+        self.conn.executemany('INSERT INTO hashtags VALUES (?, ?)',
+                              TAGS.items())
+        self.queries = []
+        self.revisions = {}  # (lang, rc_id) -> {tag: htrc_id}
+        self._next_id = 0
+
+    def add(self, lang, rc_id, timestamp, tags):
+        for tag in tags:
+            self._next_id += 1
+            ht_id = [k for k, v in TAGS.items() if v == tag][0]
+            self.conn.execute('INSERT INTO recentchanges VALUES (?, ?, ?, ?)',
+                              (self._next_id, lang, rc_id, timestamp))
+            self.conn.execute('INSERT INTO hashtag_recentchanges '
+                              'VALUES (?, ?, ?, ?)',
+                              (self._next_id, ht_id, rc_id, lang))
+            self.revisions.setdefault((lang, rc_id), {})[tag] = self._next_id
+
+    def execute(self, query, params, cache_name=None, replica=False):
+        self.queries.append((query, params))
+        cursor = self.conn.execute(query, params)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def expected(self, clauses):
+        "The keys find_page should page through, newest first."
+        ret = []
+        for (lang, rc_id), rows in self.revisions.items():
+            ids = [min(rows[tag] for tag in tags)
+                   for tags, excluded in clauses
+                   if all(t in rows for t in tags)
+                   and not any(t in rows for t in excluded)]
+            if ids:
+                timestamp = self.conn.execute(
+                    'SELECT rc_timestamp FROM recentchanges WHERE htrc_id = ?',
+                    (min(ids),)).fetchone()[0]
+                ret.append((timestamp, rc_id, min(ids)))
+        return sorted(ret, reverse=True)
+
+
+@pytest.fixture
+def db():
+    ret = FakeDatabase()
+    for rc_id in range(1, 41):
+        # several revisions per second, and the same rc_ids on two wikis
+        timestamp = '201601010000%02d' % (rc_id // 3)
+        tags = ['big']
+        if rc_id % 4 == 0:
+            tags.append('small')
+        if rc_id % 5 == 0:
+            tags.append('other')
+        ret.add('en', rc_id, timestamp, tags)
+        if rc_id % 2:
+            ret.add('de', rc_id, timestamp, tags[::-1])
+    return ret
+
+
+def test_parse():
+    assert parse_tag_expression('a+b|c-d') == ((('a', 'b'), ()),
+                                               (('c',), ('d',)))
+    assert parse_tag_expression('#a | #b') == ((('a',), ()), (('b',), ()))
+    assert is_tag_expression('a-b')
+    assert not is_tag_expression('ab')
+
+
+@pytest.mark.parametrize('text', ['a+', '|a', 'a||b', '-a', 'a|-b'])
+def test_parse_errors(text):
+    with pytest.raises(ValueError):
+        parse_tag_expression(text)
+
+
+def _page_through(db, clauses, limit):
+    ret, after = [], None
+    while True:
+        page = find_page(db, clauses, after=after, limit=limit)
+        ret.extend(page)
+        if len(page) < limit:
+            return ret
+        after = page[-1]
+
+
+@pytest.mark.parametrize('text', ['big+small', 'big-small', 'small|other',
+                                  'big+small|other-small', 'small+nope',
+                                  'other|nope'])
+@pytest.mark.parametrize('batch_size', [1, 3, 500])
+@pytest.mark.parametrize('limit', [1, 4, 7])
+def test_find_page(db, monkeypatch, text, batch_size, limit):
+    monkeypatch.setattr(tagexpr, 'BATCH_SIZE', batch_size)
+    clauses = parse_tag_expression(text)
+    expected = db.expected(clauses)
+    assert _page_through(db, clauses, limit) == expected
+    if expected:
+        # and back again from the oldest
+        assert find_page(db, clauses, before=expected[-1],
+                         limit=limit) == expected[-limit - 1:-1]
+
+
+def test_find_page_old_cursor(db):
+    clauses = parse_tag_expression('big')
+    expected = db.expected(clauses)
+    # a (rc_timestamp, rc_id) pair skips every row of that revision
+    page = find_page(db, clauses, after=expected[2][:2], limit=2)
+    assert page == [key for key in expected
+                    if key[:2] < expected[2][:2]][:2]
+
+
+def test_find_page_drives_from_smallest_tag(db, monkeypatch):
+    monkeypatch.setattr(tagexpr, 'BATCH_SIZE', 500)
+    find_page(db, parse_tag_expression('big+small'), limit=3)
+    batches = [params for query, params in db.queries
+               if 'ORDER BY' in query and 'LIMIT' in query]
+    assert batches and all(params[0] == 2 for params in batches)
+
+
+def _matched_keys(db, matched):
+    sql, params = matched.build()
+    rows = db.execute('SELECT rc.rc_timestamp, rc.rc_id, rc.htrc_lang '
+                      'FROM recentchanges AS rc '
+                      'JOIN (%s) AS matched '
+                      'ON matched.htrc_id = rc.htrc_id' % sql, params)
+    return sorted((row['htrc_lang'], row['rc_id']) for row in rows)
+
+
+@pytest.mark.parametrize('text', ['big+small', 'big-small', 'small|other',
+                                  'big+small|other-small', 'small+nope',
+                                  'nope'])
+def test_matching_query(db, text):
+    if is_tag_expression(text):
+        clauses = parse_tag_expression(text)
+    else:
+        clauses = (((text,), ()),)
+    expected = sorted(rev for rev, rows in db.revisions.items()
+                      if any(all(t in rows for t in tags)
+                             and not any(t in rows for t in excluded)
+                             for tags, excluded in clauses))
+    assert _matched_keys(db, matching_query(db, clauses)) == expected
+
+
+def test_matching_query_filters(db):
+    clauses = parse_tag_expression('big-other')
+    matched = matching_query(db, clauses, lang='de',
+                             startdate='20160101000003',
+                             enddate='20160101000006')
+    assert _matched_keys(db, matched) == [('de', rc_id)
+                                          for rc_id in (9, 11, 13, 17)]
+
+
+def test_matching_query_drives_from_smallest_tag(db):
+    sql, params = matching_query(db, parse_tag_expression('big+small')).build()
+    # only the small tag is scanned; the big one is an EXISTS probe
+    assert params[0] == 2
+    assert 'EXISTS' in sql and params[-1] == 1
+
+
+def test_query_params_order():
+    query = Query('(SELECT ? AS x) AS t', 'table')
+    query.select('SUBSTR(t.x, ?) AS y', params=('select',))
+    query.join('u', 'u.x = ?', 'join')
+    query.where('t.x = ?', 'where')
+    query.group_by('y')
+    query.having('COUNT(*) > ?', 'having')
+    query.limit(5)
+    sql, params = query.build()
+    assert params == ('select', 'table', 'join', 'where', 'having', 5)
+    assert sql.index('WHERE') < sql.index('GROUP BY') < sql.index('HAVING')
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+Edit summary index
+~~~~~~~~~~~~~~~~~~
+An inverted index over the words of rc_comment, kept in the local
+replica (see replica.py), so that searching a tag's edit summaries
+doesn't scan every one of them with ``LIKE '%...%'``.
+
+Comments are split into lowercased words; each distinct word of a
+revision gets a posting, keyed by the revision's htrc_id (rc_id is
+only unique within one wiki). The replica indexes the revisions it
+copies as part of each sync, so the index is exactly as fresh as the
+mirror. A search for several words intersects their postings, and the
+tag's own rows are intersected with that.
+
+The shared database has no index, and matching substrings there would
+scan every comment, so when the mirror is disabled or isn't fresh,
+searches raise SearchUnavailable instead.
+'''
+import re
+
+
+POSTINGS_TABLE = 'comment_postings'
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+SCHEMA = ['''
+        CREATE TABLE IF NOT EXISTS %s (
+          term TEXT NOT NULL,
+          htrc_id INTEGER NOT NULL,
+          PRIMARY KEY (term, htrc_id)
+        ) WITHOUT ROWID''' % POSTINGS_TABLE,
+          # for pruning
+          'CREATE INDEX IF NOT EXISTS postings_htrc_id '
+          'ON %s (htrc_id)' % POSTINGS_TABLE]
+
+_POSTINGS_QUERY = 'SELECT htrc_id FROM %s WHERE term = ?' % POSTINGS_TABLE
+
+
+class SearchUnavailable(Exception):
+    "Raised for comment searches while there's no fresh index to use."
+
+
+def tokenize(text):
+    """The distinct lowercased words of *text*, in order. Bytestrings
+    are decoded as UTF-8.
+    """
+    if not text:
+        return []
+    if isinstance(text, bytes):
+        text = text.decode('utf8', 'replace')
+    ret, seen = [], set()
+    for term in TOKEN_RE.findall(text.lower()):
+        if (MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH
+                and term not in seen):
+            seen.add(term)
+            ret.append(term)
+    return ret
+
+
+def parse_terms(text):
+    "The terms to search for, from what a user typed. See tokenize."
+    return tuple(tokenize(text)[:MAX_QUERY_TERMS])
+
+
+def iter_postings(rows):
+    "Yields the ``(term, htrc_id)`` postings of ``(htrc_id, comment)`` rows."
+    for htrc_id, comment in rows:
+        for term in tokenize(comment):
+            yield term, htrc_id
+
+
+def match_terms(query, terms):
+    """Restricts *query* (a query.Query over ``recentchanges AS rc``) to
+    revisions whose comment has every one of *terms*, by intersecting
+    their postings, which only the replica has.
+    """
+    if not terms:
+        return
+    query.where('rc.htrc_id IN (%s)'
+                % ' INTERSECT '.join([_POSTINGS_QUERY] * len(terms)),
+                *terms)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+'''
+Top hashtags
+~~~~~~~~~~~~
+An incremental replacement for the GROUP BY behind get_top_hashtags.
+The tracker polls only the recentchanges rows past its ``htrc_id``
+watermark and counts valid, non-bot hashtags into fixed-size windows
+of ``BUCKET_SPAN`` htrc_ids, each summarized by a bounded Space-Saving
+sketch. Windows older than ``MAX_WINDOW`` ids are dropped.
+
+Asking for the top tags over the last N htrc_ids merges the windows
+covering them; the merged rankings are memoized, and recomputed by
+each poll, so the homepage and /tags/<limit> are answered from memory.
+'''
+import time
+import threading
+from collections import Counter, OrderedDict
+
+from log import tlog
+from sketches import SpaceSaving
+
+
+BUCKET_SPAN = 10000  # htrc_ids per window
+MAX_WINDOW = 1000000  # most recent htrc_ids we can answer for
+BUCKET_CAPACITY = 2000  # tags tracked per window
+POLL_BATCH_SIZE = 50000
+POLL_INTERVAL = 30
+
+
+class TopHashtagTracker(object):
+    def __init__(self, db,
+                 bucket_span=BUCKET_SPAN,
+                 max_window=MAX_WINDOW,
+                 bucket_capacity=BUCKET_CAPACITY,
+                 poll_interval=POLL_INTERVAL):
+        self.db = db
+        self.bucket_span = bucket_span
+        self.max_window = max_window
+        self.bucket_capacity = bucket_capacity
+        self.poll_interval = poll_interval
+        self.watermark = None
+        self.caught_up = False
+        self._buckets = OrderedDict()  # bucket index -> SpaceSaving
+        self._texts = {}  # ht_id -> ht_text, for tags currently tracked
+        self._memo = {}
+        self._memo_reads = set()  # memo keys read since the last poll
+        self._last_poll = 0
+        self._poll_lock = threading.Lock()
+        # guards _buckets and _texts, which the poll thread changes
+        # while requests merge them
+        self._lock = threading.Lock()
+
+    def top(self, limit=10, recent_count=100000):
+        """Top ``(ht_text, count)`` dicts over the last *recent_count*
+        htrc_ids, or None if the tracker can't answer (yet), in which
+        case the caller should run the query.
+        """
+        self.maybe_poll()
+        if not self.caught_up or recent_count > self.max_window:
+            return None
+        memo = self._memo
+        key = (limit, recent_count)
+        self._memo_reads.add(key)
+        if key not in memo:
+            memo[key] = self._top(limit, recent_count)
+        return [dict(tag) for tag in memo[key]]  # callers modify them
+
+    def _top(self, limit, recent_count):
+        with self._lock:
+            first_bucket = ((self.watermark - recent_count)
+                            // self.bucket_span)
+            merged = Counter()
+            for index, bucket in self._buckets.items():
+                if index >= first_bucket:
+                    merged.update(bucket.counts)
+            texts = self._texts
+            return [{'ht_text': texts[ht_id], 'count': count}
+                    for ht_id, count in merged.most_common(limit)
+                    if ht_id in texts]
+
+    def maybe_poll(self):
+        "Polls in the background if the last poll is older than poll_interval."
+        if time.time() - self._last_poll < self.poll_interval:
+            return
+        if not self._poll_lock.acquire(False):
+            return
+        self._last_poll = time.time()
+
+        def _run():
+            try:
+                self.poll()
+            except Exception:
+                pass  # recorded by tlog; retried next interval
+            finally:
+                self._poll_lock.release()
+
+        thread = threading.Thread(target=_run, name='top-hashtags-poll')
+        thread.daemon = True
+        thread.start()
+
+    def poll(self):
+        with tlog.critical('poll_top_hashtags') as rec:
+            if self.watermark is None:
+                newest = self.db.execute('SELECT MAX(htrc_id) AS max_id '
+                                         'FROM recentchanges', ())
+                newest = newest[0]['max_id'] or 0
+                self.watermark = max(newest - self.max_window, 0)
+            valid_ids = self.db.valid_hashtags
+            valid_ids.maybe_refresh()
+            total = 0
+            while True:
+                rows = self.db.execute('''
+                SELECT rc.htrc_id, rc.rc_bot, ht.ht_id, ht.ht_text
+                FROM recentchanges AS rc
+                JOIN hashtag_recentchanges AS htrc
+                ON htrc.htrc_id = rc.htrc_id
+                JOIN hashtags AS ht
+                ON ht.ht_id = htrc.ht_id
+                WHERE rc.htrc_id > ?
+                ORDER BY rc.htrc_id
+                LIMIT ?''', (self.watermark, POLL_BATCH_SIZE))
+                with self._lock:
+                    self._add_rows(rows, valid_ids)
+                total += len(rows)
+                if len(rows) < POLL_BATCH_SIZE:
+                    break
+            with self._lock:
+                self._expire()
+            self.caught_up = True
+            # rankings read since the last poll are recomputed here, so
+            # that readers don't pay for the merge after each poll
+            reads, self._memo_reads = self._memo_reads, set()
+            self._memo = dict((key, self._top(*key)) for key in reads)
+            rec.success('Counted {count} new revisions', count=total)
+        return total
+
+    def _add_rows(self, rows, valid_ids):
+        span = self.bucket_span
+        batches = {}
+        for row in rows:
+            ht_id = row['ht_id']
+            if row['rc_bot'] or not valid_ids.is_valid(ht_id, row['ht_text']):
+                continue
+            index = row['htrc_id'] // span
+            batches.setdefault(index, Counter())[ht_id] += 1
+            self._texts[ht_id] = row['ht_text']
+        for index in sorted(batches):
+            bucket = self._buckets.get(index)
+            if bucket is None:
+                bucket = self._buckets[index] = SpaceSaving(self.bucket_capacity)
+            bucket.update(batches[index].items())
+        if rows:
+            self.watermark = rows[-1]['htrc_id']
+
+    def _expire(self):
+        oldest = (self.watermark - self.max_window) // self.bucket_span
+        for index in list(self._buckets):
+            if index < oldest:
+                del self._buckets[index]
+        tracked = set()
+        for bucket in self._buckets.values():
+            tracked.update(bucket.counts)
+        for ht_id in list(self._texts):
+            if ht_id not in tracked:
+                del self._texts[ht_id]
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import json
+import base64
+
 
 def encode_vals(indict):
     ret = {}
@@ -15,3 +18,70 @@ def to_unicode(obj):
         return unicode(obj)
     except UnicodeDecodeError:
         return unicode(obj, encoding='utf8')
+
+
+def encode_cursor(key, direction, position=0):
+    """Pack a keyset pagination position into an opaque, URL-safe
+    string. *key* is the ``(rc_timestamp, rc_id, htrc_id)`` of the row
+    the next page seeks from, *direction* is ``'after'`` (older rows) or
+    ``'before'`` (newer rows), and *position* is only used for the
+    "X - Y of Z results" display.
+    """
+    payload = json.dumps([direction, list(key), position],
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor. Returns ``(key, direction, position)``,
+    or ``(None, 'after', 0)`` for a missing or malformed cursor, which
+    is the first page.
+    """
+    if not cursor:
+        return None, 'after', 0
+    try:
+        cursor = str(cursor)
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = base64.urlsafe_b64decode(padded)
+        direction, key, position = json.loads(payload.decode('utf8'))
+        if direction not in ('after', 'before'):
+            raise ValueError('unknown direction: %r' % direction)
+        if len(key) not in (2, 3):
+            # cursors from before htrc_id was part of the key have two parts
+            raise ValueError('bad key: %r' % (key,))
+        key = (str(key[0]),) + tuple(int(part) for part in key[1:])
+        return key, direction, int(position)
+    except (TypeError, ValueError, UnicodeError):
+        return None, 'after', 0
+
+
+def paginate(revs, cursor, pagination):
+    """Trims a page fetched with ``pagination + 1`` rows and derives the
+    opaque prev/next cursors for it from its first and last rows.
+    """
+    key, direction, position = decode_cursor(cursor)
+    has_more = len(revs) > pagination
+    if direction == 'before':
+        revs = revs[-pagination:] if has_more else revs
+        has_prev = has_more
+        has_next = True
+        if not has_prev:
+            position = 0
+        else:
+            position = max(position - len(revs), 0)
+    else:
+        revs = revs[:pagination]
+        has_prev = key is not None
+        has_next = has_more
+    prev = next = None
+    if revs and has_prev:
+        first = revs[0]
+        prev = encode_cursor((first['rc_timestamp'], first['rc_id'],
+                              first['htrc_id']),
+                             'before', position)
+    if revs and has_next:
+        last = revs[-1]
+        next = encode_cursor((last['rc_timestamp'], last['rc_id'],
+                              last['htrc_id']),
+                             'after', position + len(revs))
+    return revs, position, prev, next
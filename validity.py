@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+'''
+Valid hashtags
+~~~~~~~~~~~~~~
+The hashtag validity rules (common.is_valid_hashtag) evaluated once per
+``ht_id`` instead of on every joined row of every query. Valid ids are
+stored in the ``valid_hashtags`` table, which queries join against, and
+mirrored in an in-process set.
+
+Both are refreshed incrementally from ``ht_id``s past the stored
+watermark. When the rules (including common.EXCLUDED) change, or
+before the first build, the table is built from scratch in a staging
+table and swapped in with one RENAME TABLE, so it's never seen half
+built. RULES_NAME records the rules of the last complete build.
+
+Refreshes run in the background, so requests never wait on (or fail
+with) the shared database. Until one finds a complete build for the
+current rules, ``ready`` is false, and queries evaluate the rules
+inline instead (see match_rules).
+'''
+import time
+import threading
+
+from common import EXCLUDED, RULES_VERSION, is_valid_hashtag
+from log import tlog
+from state import ensure_state, get_state, set_state
+
+
+VALID_TABLE = 'valid_hashtags'
+STAGING_TABLE = 'valid_hashtags_new'
+OLD_TABLE = 'valid_hashtags_old'
+WATERMARK_NAME = 'valid_ht_id'
+RULES_NAME = 'valid_rules_version'
+REBUILD_LOCK = 'hashtags.valid_hashtags_rebuild'
+BATCH_SIZE = 10000
+REFRESH_INTERVAL = 60
+
+CREATE_VALID_QUERY = '''
+        CREATE TABLE IF NOT EXISTS %s (
+          ht_id INT UNSIGNED NOT NULL PRIMARY KEY
+        )'''
+
+
+def match_rules(query, column='ht.ht_text'):
+    """Restricts *query* to valid hashtags by checking the rules on
+    *column* in SQL, for while the table isn't ready. MySQL's REGEXP
+    only approximates is_valid_hashtag, and it's checked on every row.
+    """
+    query.where('%s NOT IN (%s)' % (column, ', '.join(['?'] * len(EXCLUDED))),
+                *EXCLUDED)
+    query.where("%s REGEXP '[[:alpha:]]+'" % column)
+    query.where('CHAR_LENGTH(%s) > 1' % column)
+
+
+class ValidHashtags(object):
+    def __init__(self, db,
+                 batch_size=BATCH_SIZE,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.db = db
+        self.batch_size = batch_size
+        self.refresh_interval = refresh_interval
+        self.ids = frozenset()
+        self.watermark = 0  # ht_ids up to here have been evaluated
+        self.ready = False  # the table is complete for RULES_VERSION
+        self._max_id = 0
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, ht_id):
+        self.maybe_refresh()
+        return ht_id in self.ids
+
+    def is_valid(self, ht_id, ht_text):
+        """Checks an ht_id against the set, evaluating the rules directly
+        for tags newer than the last refresh (or all of them, until the
+        table is ready).
+        """
+        if self.ready and ht_id <= self.watermark:
+            return ht_id in self.ids
+        return is_valid_hashtag(ht_text)
+
+    def maybe_refresh(self):
+        """Kicks off a background refresh if the last one is older than
+        refresh_interval. Callers go on with what we have.
+        """
+        if time.time() - self._last_refresh < self.refresh_interval:
+            return
+        if not self._lock.acquire(False):
+            return  # someone else is refreshing
+        self._last_refresh = time.time()
+
+        def _run():
+            try:
+                self._refresh()
+            except Exception:
+                pass  # recorded by tlog; the next interval retries
+            finally:
+                self._lock.release()
+
+        thread = threading.Thread(target=_run, name='valid-hashtags-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        with tlog.critical('refresh_valid_hashtags') as rec:
+            with self.db.pool.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(CREATE_VALID_QUERY % VALID_TABLE, ())
+                    ensure_state(cursor, WATERMARK_NAME, RULES_NAME)
+                    connection.commit()
+                    if get_state(cursor, RULES_NAME) != RULES_VERSION:
+                        self._rebuild(connection, cursor)
+                    # another process may be the one rebuilding
+                    if get_state(cursor, RULES_NAME) == RULES_VERSION:
+                        self._sync_table(connection, cursor)
+                        self._load_ids(cursor)
+                        self.watermark = get_state(cursor, WATERMARK_NAME)
+                        self.ready = True
+                    connection.commit()
+                finally:
+                    cursor.close()
+            self._last_refresh = time.time()
+            rec.success('{count} valid hashtags (ready: {ready})',
+                        count=len(self.ids), ready=self.ready)
+
+    def _rebuild(self, connection, cursor):
+        """Builds the table for the current rules in STAGING_TABLE, then
+        swaps it in. Skipped if another process holds the rebuild lock.
+        """
+        cursor.execute('SELECT GET_LOCK(?, 0)', (REBUILD_LOCK,))
+        if not cursor.fetchone()[0]:
+            return
+        try:
+            if get_state(cursor, RULES_NAME) == RULES_VERSION:
+                return  # built while we waited for the lock
+            cursor.execute('DROP TABLE IF EXISTS %s' % STAGING_TABLE, ())
+            cursor.execute(CREATE_VALID_QUERY % STAGING_TABLE, ())
+            last = 0
+            while True:
+                rows = self._evaluate(cursor, STAGING_TABLE, last)
+                connection.commit()
+                if rows:
+                    last = rows[-1][0]
+                if len(rows) < self.batch_size:
+                    break
+            cursor.execute('DROP TABLE IF EXISTS %s' % OLD_TABLE, ())
+            cursor.execute('RENAME TABLE %s TO %s, %s TO %s'
+                           % (VALID_TABLE, OLD_TABLE,
+                              STAGING_TABLE, VALID_TABLE), ())
+            cursor.execute('DROP TABLE %s' % OLD_TABLE, ())
+            # tags added since the last batch are caught up by _sync_table
+            set_state(cursor, WATERMARK_NAME, last)
+            set_state(cursor, RULES_NAME, RULES_VERSION)
+            connection.commit()
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(?)', (REBUILD_LOCK,))
+            cursor.fetchall()
+
+    def _sync_table(self, connection, cursor):
+        "Adds the valid tags past the watermark to the (complete) table."
+        while True:
+            cursor.execute('START TRANSACTION', ())
+            watermark = get_state(cursor, WATERMARK_NAME, for_update=True)
+            rows = self._evaluate(cursor, VALID_TABLE, watermark)
+            if rows:
+                set_state(cursor, WATERMARK_NAME, rows[-1][0])
+            connection.commit()
+            if len(rows) < self.batch_size:
+                return
+
+    def _evaluate(self, cursor, table, after):
+        """Inserts the valid tags of the batch of hashtags past *after*
+        into *table*. Returns the batch's ``(ht_id, ht_text)`` rows.
+        """
+        cursor.execute('''
+        SELECT ht_id, ht_text
+        FROM hashtags
+        WHERE ht_id > ?
+        ORDER BY ht_id
+        LIMIT ?''', (after, self.batch_size))
+        rows = cursor.fetchall()
+        valid = [(ht_id,) for ht_id, ht_text in rows
+                 if is_valid_hashtag(ht_text)]
+        if valid:
+            cursor.executemany('INSERT IGNORE INTO %s (ht_id) VALUES (?)'
+                               % table, valid)
+        return rows
+
+    def _load_ids(self, cursor):
+        cursor.execute('SELECT ht_id FROM %s WHERE ht_id > ?' % VALID_TABLE,
+                       (self._max_id,))
+        new_ids = [row[0] for row in cursor.fetchall()]
+        if new_ids:
+            self.ids = self.ids.union(new_ids)
+            self._max_id = max(new_ids)